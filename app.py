@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.openapi.utils import get_openapi
 from pydantic import BaseModel
@@ -6,10 +8,17 @@ from starlette.responses import PlainTextResponse
 
 import settings
 from router import api_logger
-from router.repository.google_compute_repository import GoogleComputeRepository
-from router.repository.token_usage_repository import TokenUsageRepositoryFirestore
+from router.domain.tokens.usage_ledger import TokenUsageLedger
 from router.routers import main_router
+from router.repository.user_repository import UserRepositoryFirebase
 from router.routers import routing_utils
+from router.service.auth.api_key_cache import UserApiKeyCache
+from router.service.auth.api_key_cache import UserByUidCache
+from router.service.auth.api_key_filter import api_key_filter
+from router.service.auth.signed_api_key import revoked_api_keys
+from router.service.completion import context_window
+from router.service.completion.upstream_client import UpstreamClient
+from router.service.completion.utils import get_chat_completion_endpoints
 from router.service.exception_handlers.exception_handlers import (
     custom_exception_handler,
 )
@@ -17,12 +26,43 @@ from router.service.middleware.main_middleware import MainMiddleware
 from router.service.middleware.request_enrichment_middleware import (
     RequestEnrichmentMiddleware,
 )
+from router.service.monitoring import app_metrics
 from router.service.monitoring.prometheus_metrics_endpoint import metrics
 from router.service.monitoring.prometheus_middleware import PrometheusMiddleware
 
 logger = api_logger.get()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    upstream_client = UpstreamClient.instance()
+    await upstream_client.start(get_chat_completion_endpoints())
+    context_window.warn_if_disabled()
+    token_usage_ledger = TokenUsageLedger.instance()
+    token_usage_ledger.start()
+    app_metrics.app_metrics_refresher.start()
+    user_repository = UserRepositoryFirebase.instance()
+    api_key_cache = UserApiKeyCache.instance()
+    api_key_cache.start(user_repository.listen_api_keys)
+    user_cache = UserByUidCache.instance()
+    user_cache.start(user_repository.listen_api_keys)
+    api_key_filter.start(user_repository.listen_api_keys)
+    revoked_api_keys.start(
+        user_repository.get_revoked_api_key_ids,
+        user_repository.listen_revoked_api_keys,
+    )
+    yield
+    revoked_api_keys.close()
+    api_key_filter.close()
+    user_cache.close()
+    api_key_cache.close()
+    await app_metrics.app_metrics_refresher.close()
+    # Queued token usage is written before the worker exits
+    await token_usage_ledger.close()
+    await upstream_client.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(
     main_router.router,
@@ -125,37 +165,5 @@ app.add_route("/metrics", metrics)
 
 
 @app.get("/metrics-app", response_class=PlainTextResponse, include_in_schema=False)
-def metrics_app():
-    model_name = "mistralai/Mistral-7B-Instruct-v0.1"
-
-    repo = TokenUsageRepositoryFirestore.instance()
-    usage = repo.get_usage_by_model(model_name)
-    result = ""
-    result += (
-        '\nllm_proxy_llm_total_tokens_grand_sum{model_name="'
-        + model_name
-        + '"} '
-        + str(usage["total_tokens"])
-    )
-    result += (
-        '\nllm_proxy_llm_completion_tokens_grand_sum{model_name="'
-        + model_name
-        + '"} '
-        + str(usage["completion_tokens"])
-    )
-    result += (
-        '\nllm_proxy_llm_prompt_tokens_grand_sum{model_name="'
-        + model_name
-        + '"} '
-        + str(usage["prompt_tokens"])
-    )
-    try:
-        compute_status = GoogleComputeRepository.instance().get_instance_group_status()
-        result += "\nllm_proxy_llm_autoscaler_target_size " + str(
-            compute_status.target_size
-        )
-        for name, value in compute_status.actions.items():
-            result += f"\nllm_proxy_llm_autoscaler_action_{name} " + str(value)
-    except:
-        logger.error("Failed to fetch autoscaler stats", exc_info=True)
-    return result
+async def metrics_app():
+    return app_metrics.render(app_metrics.app_metrics_refresher.snapshot)
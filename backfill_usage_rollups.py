@@ -0,0 +1,17 @@
+"""
+Adds the token usage records written before usage rollups existed to the
+rollups. Records are marked as they are added, rerunning it is safe.
+
+python backfill_usage_rollups.py
+"""
+from router.repository.token_usage_repository import TokenUsageRepositoryFirestore
+
+
+def main():
+    repo = TokenUsageRepositoryFirestore.instance()
+    count = repo.backfill_rollups()
+    print(f"Added {count} token usage records to the rollups")
+
+
+if __name__ == "__main__":
+    main()
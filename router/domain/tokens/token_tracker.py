@@ -1,7 +1,10 @@
+from typing import Callable
 from typing import Dict
+from typing import Optional
 
 from router import api_logger
-from router.repository.token_usage_repository import TokenUsageRepositoryFirestore
+from router.domain.tokens.usage_ledger import UsageLedger
+from router.repository.token_usage_repository import get_usage_record
 from router.service.monitoring.prometheus_middleware import (
     LLM_COMPLETION_TOKENS_GENERATED,
 )
@@ -16,13 +19,22 @@ class TokenTracker:
         self,
         method: str,  # GET || POST etc..
         path_template: str,  # /v1/endpoint
-        repository: TokenUsageRepositoryFirestore,
+        usage_ledger: UsageLedger,
+        # Called with the tokens used upstream once the usage is known
+        on_usage: Optional[Callable[[int], None]] = None,
     ):
         self.method = method
         self.path_template = path_template
-        self.repository = repository
+        self.usage_ledger = usage_ledger
+        self.on_usage = on_usage
 
-    def track(self, user_id: str, provider: str, response_dict: Dict):
+    async def track(
+        self, user_id: str, provider: str, response_dict: Dict, cached: bool = False
+    ):
+        """
+        cached - the response was served without an upstream call of its own,
+        from the response cache or shared with a coalesced identical request
+        """
         try:
             model_name = response_dict["model"]
             usage = response_dict["usage"]
@@ -45,7 +57,13 @@ class TokenTracker:
                 model_name=model_name,
             ).observe(usage["total_tokens"])
 
-            self.repository.track(user_id, provider, model_name, usage)
+            if self.on_usage:
+                # Cached responses did not use the upstream
+                self.on_usage(0 if cached else usage["total_tokens"])
+
+            await self.usage_ledger.put(
+                get_usage_record(user_id, provider, model_name, usage, cached)
+            )
         except Exception as exc:
             # Log exception
             logger.info(f"Token tracker exception: {exc}")
@@ -0,0 +1,148 @@
+import hashlib
+from collections import OrderedDict
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+
+import tokenizers
+from prometheus_client import Counter
+
+import settings
+from router import api_logger
+from router.service.completion.entities import BaseMessage
+
+TOKENIZER_CACHE_REQUESTS = Counter(
+    "llm_proxy_tokenizer_cache_requests_total",
+    "Total count of message token count cache lookups by result (hit or miss).",
+    ["result"],
+)
+
+RESULT_HIT = "hit"
+RESULT_MISS = "miss"
+
+# Mistral instruct chat template: <s> once, "[INST] ... [/INST]" around user
+# turns and </s> after assistant turns, about 4 tokens per message on average
+TOKENS_PER_REQUEST = 1
+TOKENS_PER_MESSAGE = 4
+
+# Used when no vocab file is configured
+CHARS_PER_TOKEN = 3
+
+logger = api_logger.get()
+
+
+class Tokenizer:
+    """
+    Counts tokens of the served Mistral models with the tokenizer.json vocab
+    file at tokenizer_path, falls back to an estimate of CHARS_PER_TOKEN
+    characters per token if there is none.
+
+    Message token counts are cached by a hash of the content, multi-turn chats
+    send the same messages again every turn.
+    """
+
+    def __init__(self, tokenizer_path: Optional[str], cache_max_entries: int):
+        self.cache_max_entries = cache_max_entries
+        self.cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self.tokenizer: Optional[tokenizers.Tokenizer] = None
+        if tokenizer_path:
+            try:
+                self.tokenizer = tokenizers.Tokenizer.from_file(tokenizer_path)
+            except Exception as exc:
+                logger.error(
+                    f"Failed to load tokenizer from {tokenizer_path}, token counts "
+                    f"are estimated: {exc!r}"
+                )
+
+    def is_loaded(self) -> bool:
+        return self.tokenizer is not None
+
+    def count(self, text: str) -> int:
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts: Sequence[str]) -> List[int]:
+        """Token counts of texts, not cached"""
+        if not texts:
+            return []
+        if self.tokenizer is None:
+            return [len(text) // CHARS_PER_TOKEN for text in texts]
+        encodings = self.tokenizer.encode_batch(list(texts), add_special_tokens=False)
+        return [len(encoding) for encoding in encodings]
+
+    def count_messages(self, messages: Sequence[BaseMessage]) -> int:
+        return self.count_messages_batch([messages])[0]
+
+    def count_messages_batch(
+        self, conversations: Sequence[Sequence[BaseMessage]]
+    ) -> List[int]:
+        """
+        Returns:
+            prompt token count of every conversation, chat template included
+        """
+        keys = [
+            [_get_key(message.content or "") for message in messages]
+            for messages in conversations
+        ]
+        counts = self._count_contents(
+            {
+                key: message.content or ""
+                for messages, message_keys in zip(conversations, keys)
+                for message, key in zip(messages, message_keys)
+            }
+        )
+        return [
+            TOKENS_PER_REQUEST
+            + sum(counts[key] + TOKENS_PER_MESSAGE for key in message_keys)
+            for message_keys in keys
+        ]
+
+    def count_each_message(self, messages: Sequence[BaseMessage]) -> List[int]:
+        """
+        Returns:
+            token count of every message, its part of the chat template included
+        """
+        keys = [_get_key(message.content or "") for message in messages]
+        counts = self._count_contents(
+            {key: message.content or "" for message, key in zip(messages, keys)}
+        )
+        return [counts[key] + TOKENS_PER_MESSAGE for key in keys]
+
+    def _count_contents(self, contents: Dict[bytes, str]) -> Dict[bytes, int]:
+        counts = {}
+        missing = {}
+        for key, content in contents.items():
+            count = self._get_cached(key)
+            if count is None:
+                missing[key] = content
+            else:
+                counts[key] = count
+        for key, count in zip(missing, self.count_batch(list(missing.values()))):
+            counts[key] = count
+            self._set_cached(key, count)
+        return counts
+
+    def _get_cached(self, key: bytes) -> Optional[int]:
+        count = self.cache.get(key)
+        if count is None:
+            TOKENIZER_CACHE_REQUESTS.labels(result=RESULT_MISS).inc()
+            return None
+        TOKENIZER_CACHE_REQUESTS.labels(result=RESULT_HIT).inc()
+        self.cache.move_to_end(key)
+        return count
+
+    def _set_cached(self, key: bytes, count: int) -> None:
+        self.cache[key] = count
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_max_entries:
+            self.cache.popitem(last=False)
+
+
+def _get_key(content: str) -> bytes:
+    return hashlib.blake2b(content.encode(), digest_size=16).digest()
+
+
+tokenizer = Tokenizer(
+    tokenizer_path=settings.TOKENIZER_PATH,
+    cache_max_entries=settings.TOKENIZER_CACHE_MAX_ENTRIES,
+)
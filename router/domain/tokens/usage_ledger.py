@@ -0,0 +1,144 @@
+import asyncio
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
+import settings
+from router import api_logger
+from router.repository.token_usage_repository import MAX_BATCH_SIZE
+from router.repository.token_usage_repository import TokenUsageRepositoryFirestore
+from router.repository.token_usage_repository import WRITES_PER_RECORD
+from router.singleton import Singleton
+
+USAGE_LEDGER_QUEUE_DEPTH = Gauge(
+    "llm_proxy_usage_ledger_queue_depth",
+    "Token usage records waiting to be written.",
+    multiprocess_mode="livesum",
+)
+USAGE_LEDGER_FLUSH_TIME = Histogram(
+    "llm_proxy_usage_ledger_flush_time_seconds",
+    "Histogram of token usage batch write time (in seconds)",
+)
+USAGE_LEDGER_RECORDS = Counter(
+    "llm_proxy_usage_ledger_records_total",
+    "Total count of token usage records flushed, by result (written or failed).",
+    ["result"],
+)
+USAGE_LEDGER_BACKPRESSURE = Counter(
+    "llm_proxy_usage_ledger_backpressure_total",
+    "Total count of token usage records that had to wait for room in the queue.",
+)
+
+RESULT_WRITTEN = "written"
+RESULT_FAILED = "failed"
+
+_STOP = object()
+
+logger = api_logger.get()
+
+
+class UsageLedger:
+    """
+    Write-behind buffer of token usage records: records are queued and a
+    background task writes them with write_batch (off the event loop), in
+    batches of up to batch_size or every flush_interval seconds.
+
+    The queue holds up to max_queue_size records, past that put() waits for
+    the writer to catch up.
+    """
+
+    def __init__(
+        self,
+        write_batch: Callable[[List[Dict]], None],
+        max_queue_size: int,
+        batch_size: int,
+        flush_interval: float,
+        max_retries: int = 3,
+    ):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def put(self, record: Dict) -> None:
+        self.start()
+        if self.queue.full():
+            USAGE_LEDGER_BACKPRESSURE.inc()
+        await self.queue.put(record)
+        USAGE_LEDGER_QUEUE_DEPTH.set(self.queue.qsize())
+
+    async def close(self) -> None:
+        """Writes every queued record and stops the writer"""
+        if self.task is None or self.task.done():
+            return
+        await self.queue.put(_STOP)
+        await self.task
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        is_stopped = False
+        while not is_stopped:
+            record = await self.queue.get()
+            if record is _STOP:
+                break
+            batch = [record]
+            flush_at = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = flush_at - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is _STOP:
+                    is_stopped = True
+                    break
+                batch.append(record)
+            USAGE_LEDGER_QUEUE_DEPTH.set(self.queue.qsize())
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Dict]) -> None:
+        for attempt in range(self.max_retries + 1):
+            started_at = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.write_batch, batch)
+                USAGE_LEDGER_FLUSH_TIME.observe(time.perf_counter() - started_at)
+                USAGE_LEDGER_RECORDS.labels(result=RESULT_WRITTEN).inc(len(batch))
+                return
+            except Exception as exc:
+                USAGE_LEDGER_FLUSH_TIME.observe(time.perf_counter() - started_at)
+                logger.info(
+                    f"Token usage batch write failed attempt={attempt} "
+                    f"records={len(batch)} error={exc!r}"
+                )
+                if attempt < self.max_retries:
+                    await asyncio.sleep(min(2**attempt, 30))
+        USAGE_LEDGER_RECORDS.labels(result=RESULT_FAILED).inc(len(batch))
+        # Logged in full so the usage can be recovered
+        logger.error(f"Token usage records lost: {batch}")
+
+
+@Singleton
+class TokenUsageLedger(UsageLedger):
+    def __init__(self):
+        super().__init__(
+            write_batch=TokenUsageRepositoryFirestore.instance().add_batch,
+            max_queue_size=settings.USAGE_LEDGER_MAX_QUEUE_SIZE,
+            batch_size=min(
+                settings.USAGE_LEDGER_BATCH_SIZE, MAX_BATCH_SIZE // WRITES_PER_RECORD
+            ),
+            flush_interval=settings.USAGE_LEDGER_FLUSH_INTERVAL,
+        )
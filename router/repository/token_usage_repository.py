@@ -1,92 +1,276 @@
 from datetime import datetime
+from typing import Any
 from typing import Dict
+from typing import List
 from typing import Optional
+from typing import Tuple
+from urllib.parse import quote
 
 from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1 import Increment
 
 from router.repository.firestore_initialiser import FirestoreInitializer
 from router.singleton import Singleton
 
 DB_KEY_TOKEN_USAGES = "token_usages"
 
+# Usage summed at write time, by model, by user and by user and model, in
+# total and per day and per hour
+DB_KEY_TOKEN_USAGES_BY_MODEL = "token_usages_by_model"
+DB_KEY_TOKEN_USAGES_BY_USER = "token_usages_by_user"
+DB_KEY_TOKEN_USAGES_BY_USER_MODEL = "token_usages_by_user_model"
+DB_KEY_TOKEN_USAGES_BY_USER_MODEL_DAY = "token_usages_by_user_model_day"
+DB_KEY_TOKEN_USAGES_BY_USER_MODEL_HOUR = "token_usages_by_user_model_hour"
+
+GRANULARITY_HOUR = "hour"
+GRANULARITY_DAY = "day"
+GRANULARITY_SECONDS = {GRANULARITY_HOUR: 3600, GRANULARITY_DAY: 86400}
+_BUCKET_COLLECTIONS = {
+    GRANULARITY_HOUR: DB_KEY_TOKEN_USAGES_BY_USER_MODEL_HOUR,
+    GRANULARITY_DAY: DB_KEY_TOKEN_USAGES_BY_USER_MODEL_DAY,
+}
+
+ROLLUP_COUNTERS = ("completion_tokens", "prompt_tokens", "total_tokens", "requests")
+
+# Firestore limit of writes per batch
+MAX_BATCH_SIZE = 500
+# The record itself and the 5 rollups it counts towards
+WRITES_PER_RECORD = 6
+
+
+def get_usage_record(
+    user_id: str,
+    provider: str,
+    model_name: str,
+    usage_dict: Dict,
+    cached: bool = False,
+) -> Dict:
+    return {
+        "provider": provider,
+        "model_name": model_name,
+        "completion_tokens": usage_dict["completion_tokens"],
+        "prompt_tokens": usage_dict["prompt_tokens"],
+        "total_tokens": usage_dict["total_tokens"],
+        "user_id": user_id,
+        "cached": cached,
+        "created_at": int(datetime.utcnow().timestamp()),
+    }
+
 
 @Singleton
 class TokenUsageRepositoryFirestore:
     def __init__(self):
         self.db = FirestoreInitializer.instance().get_db()
 
-    def track(self, user_id: str, provider: str, model_name: str, usage_dict: Dict):
-        data = {
-            "provider": provider,
-            "model_name": model_name,
-            "completion_tokens": usage_dict["completion_tokens"],
-            "prompt_tokens": usage_dict["prompt_tokens"],
-            "total_tokens": usage_dict["total_tokens"],
-            "user_id": user_id,
-            "created_at": int(datetime.utcnow().timestamp()),
-        }
-        self.db.collection(DB_KEY_TOKEN_USAGES).add(data)
+    def add_batch(self, records: List[Dict]) -> None:
+        """
+        Writes records made with get_usage_record and adds them to the usage
+        rollups in one atomic batch, up to MAX_BATCH_SIZE // WRITES_PER_RECORD
+        records at once
+        """
+        batch = self.db.batch()
+        collection = self.db.collection(DB_KEY_TOKEN_USAGES)
+        for record in records:
+            batch.set(collection.document(), {**record, "rolled_up": True})
+        self._add_rollup_increments(batch, records)
+        batch.commit()
+
+    def backfill_rollups(self, chunk_size: int = 100) -> int:
+        """
+        Adds the records written before rollups existed to the rollups and
+        marks them rolled up, so the backfill can be stopped and rerun.
+
+        Returns:
+            count of records added to the rollups
+        """
+        count = 0
+        chunk = []
+        for doc in self.db.collection(DB_KEY_TOKEN_USAGES).stream():
+            record = doc.to_dict()
+            if record.get("rolled_up"):
+                continue
+            chunk.append((doc.reference, record))
+            if len(chunk) >= min(chunk_size, MAX_BATCH_SIZE // WRITES_PER_RECORD):
+                count += self._backfill_chunk(chunk)
+                chunk = []
+        if chunk:
+            count += self._backfill_chunk(chunk)
+        return count
+
+    def _backfill_chunk(self, chunk: List[Tuple[Any, Dict]]) -> int:
+        batch = self.db.batch()
+        for reference, _ in chunk:
+            batch.update(reference, {"rolled_up": True})
+        self._add_rollup_increments(batch, [record for _, record in chunk])
+        batch.commit()
+        return len(chunk)
+
+    def _add_rollup_increments(self, batch, records: List[Dict]) -> None:
+        for (collection, document_id), rollup in get_rollups(records).items():
+            data = {
+                key: Increment(value) if key in ROLLUP_COUNTERS else value
+                for key, value in rollup.items()
+            }
+            batch.set(
+                self.db.collection(collection).document(document_id),
+                data,
+                merge=True,
+            )
 
     def get_usage_by_model(self, model_name: str) -> Dict:
-        docs = (
-            self.db.collection(DB_KEY_TOKEN_USAGES)
-            .where(filter=FieldFilter("model_name", "==", model_name))
-            .stream()
+        rollup = self._get_rollup(
+            DB_KEY_TOKEN_USAGES_BY_MODEL, _get_document_id(model_name)
         )
-
-        completion_tokens = 0
-        prompt_tokens = 0
-        total_tokens = 0
-        for doc in docs:
-            usage = doc.to_dict()
-            completion_tokens += usage["completion_tokens"]
-            prompt_tokens += usage["prompt_tokens"]
-            total_tokens += usage["total_tokens"]
         return {
             "model_name": model_name,
-            "completion_tokens": completion_tokens,
-            "prompt_tokens": prompt_tokens,
-            "total_tokens": total_tokens,
+            "completion_tokens": rollup.get("completion_tokens", 0),
+            "prompt_tokens": rollup.get("prompt_tokens", 0),
+            "total_tokens": rollup.get("total_tokens", 0),
         }
 
+    def get_usage_by_models(self) -> List[Dict]:
+        """Usage rollups of every model, one document per model"""
+        return [
+            {
+                "model_name": rollup["model_name"],
+                "completion_tokens": rollup.get("completion_tokens", 0),
+                "prompt_tokens": rollup.get("prompt_tokens", 0),
+                "total_tokens": rollup.get("total_tokens", 0),
+            }
+            for rollup in (
+                doc.to_dict()
+                for doc in self.db.collection(DB_KEY_TOKEN_USAGES_BY_MODEL).stream()
+            )
+        ]
+
     def get_usage_by_user(self, user_id: str, model_name: Optional[str]) -> Dict:
         if model_name:
-            docs = (
-                self.db.collection(DB_KEY_TOKEN_USAGES)
-                .where(filter=FieldFilter("model_name", "==", model_name))
-                .where(filter=FieldFilter("user_id", "==", user_id))
-                .stream()
+            rollup = self._get_rollup(
+                DB_KEY_TOKEN_USAGES_BY_USER_MODEL,
+                _get_document_id(user_id, model_name),
             )
         else:
-            docs = (
-                self.db.collection(DB_KEY_TOKEN_USAGES)
-                .where(filter=FieldFilter("user_id", "==", user_id))
-                .stream()
+            rollup = self._get_rollup(
+                DB_KEY_TOKEN_USAGES_BY_USER, _get_document_id(user_id)
             )
-
-        completion_tokens = 0
-        prompt_tokens = 0
-        total_tokens = 0
-        for doc in docs:
-            usage = doc.to_dict()
-            completion_tokens += usage["completion_tokens"]
-            prompt_tokens += usage["prompt_tokens"]
-            total_tokens += usage["total_tokens"]
         response: Dict = {
-            "completion_tokens": completion_tokens,
-            "prompt_tokens": prompt_tokens,
-            "total_tokens": total_tokens,
+            "completion_tokens": rollup.get("completion_tokens", 0),
+            "prompt_tokens": rollup.get("prompt_tokens", 0),
+            "total_tokens": rollup.get("total_tokens", 0),
         }
         if model_name:
             response["model_name"] = model_name
         return response
 
+    def get_usage_buckets(
+        self,
+        user_id: str,
+        granularity: str,
+        start: int,
+        end: int,
+        limit: int,
+        start_after: Optional[Tuple[int, str]] = None,
+    ) -> List[Dict]:
+        """
+        Returns:
+            rollups of the user per model and hour or day, of the buckets
+            starting in [start, end), ordered by bucket start and model name.
+            start_after is the (start, model_name) of the last bucket of the
+            previous page.
+        """
+        query = (
+            self.db.collection(_BUCKET_COLLECTIONS[granularity])
+            .where(filter=FieldFilter("user_id", "==", user_id))
+            .where(filter=FieldFilter("start", ">=", start))
+            .where(filter=FieldFilter("start", "<", end))
+            .order_by("start")
+            .order_by("model_name")
+        )
+        if start_after:
+            query = query.start_after(
+                {"start": start_after[0], "model_name": start_after[1]}
+            )
+        return [doc.to_dict() for doc in query.limit(limit).stream()]
+
+    def _get_rollup(self, collection: str, document_id: str) -> Dict:
+        doc = self.db.collection(collection).document(document_id).get()
+        return doc.to_dict() if doc.exists else {}
+
+
+def get_rollups(records: List[Dict]) -> Dict[Tuple[str, str], Dict]:
+    """
+    Sums records into the rollup documents they count towards
+
+    Returns:
+        (collection, document id) -> rollup fields, ROLLUP_COUNTERS are sums
+    """
+    rollups: Dict[Tuple[str, str], Dict] = {}
+    for record in records:
+        model_name = record["model_name"]
+        user_id = record["user_id"]
+        created_at = record["created_at"]
+        day = datetime.utcfromtimestamp(created_at).strftime("%Y-%m-%d")
+        hour = datetime.utcfromtimestamp(created_at).strftime("%Y-%m-%dT%H")
+        keys = {
+            (DB_KEY_TOKEN_USAGES_BY_MODEL, _get_document_id(model_name)): {
+                "model_name": model_name,
+            },
+            (DB_KEY_TOKEN_USAGES_BY_USER, _get_document_id(user_id)): {
+                "user_id": user_id,
+            },
+            (
+                DB_KEY_TOKEN_USAGES_BY_USER_MODEL,
+                _get_document_id(user_id, model_name),
+            ): {
+                "user_id": user_id,
+                "model_name": model_name,
+            },
+            (
+                DB_KEY_TOKEN_USAGES_BY_USER_MODEL_DAY,
+                _get_document_id(user_id, model_name, day),
+            ): {
+                "user_id": user_id,
+                "model_name": model_name,
+                "day": day,
+                "start": _get_bucket_start(created_at, GRANULARITY_DAY),
+            },
+            (
+                DB_KEY_TOKEN_USAGES_BY_USER_MODEL_HOUR,
+                _get_document_id(user_id, model_name, hour),
+            ): {
+                "user_id": user_id,
+                "model_name": model_name,
+                "hour": hour,
+                "start": _get_bucket_start(created_at, GRANULARITY_HOUR),
+            },
+        }
+        for key, fields in keys.items():
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = {**fields, **{counter: 0 for counter in ROLLUP_COUNTERS}}
+                rollups[key] = rollup
+            rollup["completion_tokens"] += record["completion_tokens"]
+            rollup["prompt_tokens"] += record["prompt_tokens"]
+            rollup["total_tokens"] += record["total_tokens"]
+            rollup["requests"] += 1
+    return rollups
+
+
+def _get_bucket_start(timestamp: int, granularity: str) -> int:
+    return timestamp - timestamp % GRANULARITY_SECONDS[granularity]
+
+
+def _get_document_id(*parts: str) -> str:
+    # Model names contain "/", which Firestore does not allow in document ids
+    return "|".join(quote(part, safe="") for part in parts)
+
 
 def example():
     repo = TokenUsageRepositoryFirestore.instance()
-    # repo.track(
-    #    "mock", {"completion_tokens": 223, "prompt_tokens": 224, "total_tokens": 447}
-    # )
+    # repo.add_batch([get_usage_record(
+    #    "mock", "mock", "mock",
+    #    {"completion_tokens": 223, "prompt_tokens": 224, "total_tokens": 447},
+    # )])
     usage = repo.get_usage_by_model("mistralai/Mistral-7B-Instruct-v0.1")
     print("\nUsage:")
     print(usage)
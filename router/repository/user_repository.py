@@ -1,16 +1,20 @@
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Callable
 from typing import Optional
+from typing import Set
 
 from firebase_admin import auth
 
 from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.watch import ChangeType
 
 from router.domain.user.entities import User
 from router.repository.firestore_initialiser import FirestoreInitializer
 from router.singleton import Singleton
 
 DB_USERS_KEY = "users"
+DB_REVOKED_API_KEYS_KEY = "revoked_api_keys"
 
 
 @dataclass(frozen=True)
@@ -39,6 +43,11 @@ class UserRepositoryFirebase:
         if user:
             return ValidatedUser(uid=user.uid, email=user.email)
 
+    def get_validated_user(self, user_uid: str) -> Optional[ValidatedUser]:
+        user = self.get_user(user_uid)
+        if user:
+            return ValidatedUser(uid=user.uid, email=user.email)
+
     def get_user(self, user_uid: str) -> Optional[User]:
         doc_ref = self.db.collection(DB_USERS_KEY).document(user_uid)
         doc = doc_ref.get()
@@ -58,6 +67,69 @@ class UserRepositoryFirebase:
         for doc in docs:
             return User.from_dict(uid=doc.id, user_dict=doc.to_dict())
 
+    def listen_api_keys(
+        self,
+        on_change: Callable[[str, Optional[str]], None],
+        include_existing: bool = False,
+        on_initial: Optional[Callable[[], None]] = None,
+    ):
+        """
+        Calls on_change(uid, api_key) from a listener thread for every user
+        created, updated or deleted (api_key is None), and for every existing
+        user first if include_existing. on_initial is called once the
+        existing users are done.
+
+        Returns:
+            watch, call unsubscribe() on it to stop listening
+        """
+        is_initial = True
+
+        def on_snapshot(_docs, changes, _read_time):
+            nonlocal is_initial
+            if is_initial and not include_existing:
+                changes = []
+            for change in changes:
+                if change.type == ChangeType.REMOVED:
+                    on_change(change.document.id, None)
+                else:
+                    user_dict = change.document.to_dict() or {}
+                    on_change(change.document.id, user_dict.get("api_key"))
+            if is_initial:
+                is_initial = False
+                if on_initial:
+                    on_initial()
+
+        return self.db.collection(DB_USERS_KEY).on_snapshot(on_snapshot)
+
+    def revoke_api_key(self, uid: str, key_id: str) -> None:
+        self.db.collection(DB_REVOKED_API_KEYS_KEY).document(key_id).set(
+            {"uid": uid, "revoked_at": int(datetime.utcnow().timestamp())}
+        )
+
+    def get_revoked_api_key_ids(self) -> Set[str]:
+        return {
+            doc.id
+            for doc in self.db.collection(DB_REVOKED_API_KEYS_KEY)
+            .select([])
+            .stream()
+        }
+
+    def listen_revoked_api_keys(self, on_revoked: Callable[[str], None]):
+        """
+        Calls on_revoked(key_id) from a listener thread for every revoked
+        signed key, existing ones included
+
+        Returns:
+            watch, call unsubscribe() on it to stop listening
+        """
+
+        def on_snapshot(_docs, changes, _read_time):
+            for change in changes:
+                if change.type == ChangeType.ADDED:
+                    on_revoked(change.document.id)
+
+        return self.db.collection(DB_REVOKED_API_KEYS_KEY).on_snapshot(on_snapshot)
+
 
 def _example_usage():
     repository = UserRepositoryFirebase.instance()
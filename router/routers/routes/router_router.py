@@ -1,17 +1,28 @@
+from typing import Optional
+
 from fastapi import APIRouter
 from fastapi import Depends
-from starlette.responses import StreamingResponse
+from fastapi import Header
 
 from router import api_logger
 from router.domain.tokens.token_tracker import TokenTracker
-from router.repository.token_usage_repository import TokenUsageRepositoryFirestore
-from router.repository.user_repository import UserRepositoryFirebase
+from router.domain.tokens.usage_ledger import TokenUsageLedger
 from router.repository.user_repository import ValidatedUser
+from router.service.auth.api_key_cache import UserApiKeyCache
+from router.service.auth.api_key_cache import UserByUidCache
+from router.service.auth.api_key_filter import api_key_filter
+from router.service.auth.signed_api_key import api_key_signer
+from router.service.auth.signed_api_key import revoked_api_keys
 from router.service.auth.validate_id_token import ApiKeyValidator
 from router.service.completion import completion_service, completion_stream_service
+from router.service.completion import context_window
+from router.service.completion import quotas
+from router.service.completion import stream_race
 from router.service.completion.entities import (
     ChatCompletionRequest,
 )
+from router.utils.streaming_response import ClosingStreamingResponse
+from router.utils.streaming_response import start_stream
 
 TAG = "Router"
 router = APIRouter()
@@ -19,9 +30,14 @@ router.tags = [TAG]
 
 logger = api_logger.get()
 
-user_repository = UserRepositoryFirebase.instance()
-api_key_validator = ApiKeyValidator(user_repository)
-token_usage_repository = TokenUsageRepositoryFirestore.instance()
+api_key_validator = ApiKeyValidator(
+    UserApiKeyCache.instance(),
+    api_key_signer,
+    revoked_api_keys,
+    api_key_filter,
+    UserByUidCache.instance(),
+)
+token_usage_ledger = TokenUsageLedger.instance()
 
 
 @router.post(
@@ -30,21 +46,51 @@ token_usage_repository = TokenUsageRepositoryFirestore.instance()
 async def endpoint(
         request: ChatCompletionRequest,
         validated_user: ValidatedUser = Depends(api_key_validator.validate),
+        x_stream_race: Optional[str] = Header(default=None, include_in_schema=False),
+        x_context_overflow: Optional[str] = Header(
+            default=None, include_in_schema=False
+        ),
 ):
+    context_window.apply(
+        request, is_trim_requested=context_window.is_trim_requested(x_context_overflow)
+    )
+    quota_lease = quotas.acquire(validated_user.uid, request)
     token_tracker = TokenTracker(
         method="POST",
         path_template="/v1/chat/completions",
-        repository=token_usage_repository,
+        usage_ledger=token_usage_ledger,
+        on_usage=quota_lease.reconcile,
     )
     if not request.stream:
-        return await completion_service.execute(request, token_tracker, validated_user)
+        try:
+            response = await completion_service.execute(
+                request, token_tracker, validated_user
+            )
+        finally:
+            quota_lease.close()
+        response.headers.update(quota_lease.headers)
+        return response
     else:
         headers = {
             "X-Content-Type-Options": "nosniff",
             "Connection": "keep-alive",
+            **quota_lease.headers,
         }
-        return StreamingResponse(
-            completion_stream_service.execute(request, token_tracker, validated_user),
+        chunks = await start_stream(
+            quotas.close_after(
+                completion_stream_service.execute(
+                    request,
+                    token_tracker,
+                    validated_user,
+                    is_race_requested=stream_race.is_race_requested(
+                        validated_user.uid, x_stream_race
+                    ),
+                ),
+                quota_lease,
+            )
+        )
+        return ClosingStreamingResponse(
+            chunks,
             headers=headers,
             media_type="text/event-stream",
         )
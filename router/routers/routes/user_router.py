@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 
 from fastapi import APIRouter
 
@@ -9,8 +10,10 @@ from router.repository.user_repository import ValidatedUser
 from router.service.auth.validate_id_token import SessionTokenValidator
 from router.service.auth.validate_id_token import StytchTokenValidator
 from router.service.user import create_user_service
+from router.service.user import get_usage_service
 from router.service.user import get_user_service
 from router.service.user.entities import CreateUserRequest
+from router.service.user.entities import GetUsageResponse
 from router.service.user.entities import GetUserResponse
 from fastapi import Depends
 
@@ -38,6 +41,25 @@ async def get_user(
     )
 
 
+@router.get("/v1/user/usage", response_model=GetUsageResponse)
+async def get_usage(
+        granularity: str = "day",
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        page_size: int = 100,
+        page_token: Optional[str] = None,
+        validated_user: ValidatedUser = Depends(session_token_validator.validate),
+):
+    return await get_usage_service.execute(
+        user_uid=validated_user.uid,
+        granularity=granularity,
+        start=start,
+        end=end,
+        page_size=page_size,
+        page_token=page_token,
+    )
+
+
 @router.post("/v1/user", response_model=GetUserResponse)
 async def update_user(
         payload: CreateUserRequest,
@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import time
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Set
+
+from prometheus_client import Counter
+
+import settings
+from router import api_logger
+from router.repository.user_repository import UserRepositoryFirebase
+from router.repository.user_repository import ValidatedUser
+from router.singleton import Singleton
+from router.utils.ttl_cache import TtlCache
+
+API_KEY_CACHE_REQUESTS = Counter(
+    "llm_proxy_api_key_cache_requests_total",
+    "Total count of API key cache lookups by result (hit, negative_hit or miss).",
+    ["result"],
+)
+API_KEY_CACHE_INVALIDATIONS = Counter(
+    "llm_proxy_api_key_cache_invalidations_total",
+    "Total count of user changes that invalidated cached API keys.",
+)
+
+RESULT_HIT = "hit"
+RESULT_NEGATIVE_HIT = "negative_hit"
+RESULT_MISS = "miss"
+
+# Cached for keys that were not found
+_NOT_FOUND = ValidatedUser(uid="", email="")
+
+logger = api_logger.get()
+
+
+def get_api_key_hash(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class ApiKeyCache:
+    """
+    Users of API keys, looked up with load (off the event loop) and cached
+    by the hash of the key for ttl_seconds, unknown keys for
+    negative_ttl_seconds. Concurrent lookups of the same key share one load.
+
+    invalidate() drops the entries of a user when it changes, start() hooks
+    it to a listener on the users collection.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[str], Optional[ValidatedUser]],
+        max_entries: int,
+        ttl_seconds: float,
+        negative_ttl_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.load = load
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.cache: TtlCache[ValidatedUser] = TtlCache(
+            max_entries=max_entries, ttl_seconds=ttl_seconds, clock=clock
+        )
+        # uid -> hashes of the keys cached for the user
+        self.user_keys: Dict[str, Set[str]] = {}
+        self.loads: Dict[str, asyncio.Future] = {}
+        # Loads that started before an invalidation are not cached
+        self.generation = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.watch = None
+
+    async def get(self, api_key: str) -> Optional[ValidatedUser]:
+        key_hash = get_api_key_hash(api_key)
+        user = self.cache.get(key_hash)
+        if user is _NOT_FOUND:
+            API_KEY_CACHE_REQUESTS.labels(result=RESULT_NEGATIVE_HIT).inc()
+            return None
+        if user is not None:
+            API_KEY_CACHE_REQUESTS.labels(result=RESULT_HIT).inc()
+            return user
+        API_KEY_CACHE_REQUESTS.labels(result=RESULT_MISS).inc()
+
+        load = self.loads.get(key_hash)
+        if load is None:
+            load = asyncio.ensure_future(self._load(key_hash, api_key))
+            self.loads[key_hash] = load
+            load.add_done_callback(lambda _: self.loads.pop(key_hash, None))
+        return await asyncio.shield(load)
+
+    def invalidate(self, uid: str, api_key: Optional[str] = None) -> None:
+        """
+        Drops the cached keys of the user, and the negative entry of its new
+        api_key so a new key works right away
+        """
+        API_KEY_CACHE_INVALIDATIONS.inc()
+        self.generation += 1
+        for key_hash in self.user_keys.pop(uid, set()):
+            self.cache.delete(key_hash)
+        if api_key:
+            self.cache.delete(get_api_key_hash(api_key))
+
+    def start(
+        self, listen: Callable[[Callable[[str, Optional[str]], None]], object]
+    ) -> None:
+        """
+        listen is called with a callback for every (uid, api_key) change, that
+        can be called from any thread, and returns a watch to unsubscribe
+        """
+        self.loop = asyncio.get_running_loop()
+        self.watch = listen(self._on_change)
+
+    def close(self) -> None:
+        if self.watch is not None:
+            self.watch.unsubscribe()
+            self.watch = None
+
+    def _on_change(self, uid: str, api_key: Optional[str]) -> None:
+        self.loop.call_soon_threadsafe(self.invalidate, uid, api_key)
+
+    async def _load(self, key_hash: str, api_key: str) -> Optional[ValidatedUser]:
+        generation = self.generation
+        user = await asyncio.to_thread(self.load, api_key)
+        if generation != self.generation:
+            return user
+        if user is None:
+            self.cache.set(key_hash, _NOT_FOUND, ttl_seconds=self.negative_ttl_seconds)
+            return None
+        self.cache.set(key_hash, user)
+        self.user_keys.setdefault(user.uid, set()).add(key_hash)
+        return user
+
+
+@Singleton
+class UserApiKeyCache(ApiKeyCache):
+    def __init__(self):
+        super().__init__(
+            load=UserRepositoryFirebase.instance().validate_api_key,
+            max_entries=settings.API_KEY_CACHE_MAX_ENTRIES,
+            ttl_seconds=settings.API_KEY_CACHE_TTL_SECONDS,
+            negative_ttl_seconds=settings.API_KEY_CACHE_NEGATIVE_TTL_SECONDS,
+        )
+
+
+@Singleton
+class UserByUidCache(ApiKeyCache):
+    """
+    Users by uid, for signed API keys that carry only the uid. A deleted
+    user is cached as unknown like a deleted key.
+    """
+
+    def __init__(self):
+        super().__init__(
+            load=UserRepositoryFirebase.instance().get_validated_user,
+            max_entries=settings.API_KEY_CACHE_MAX_ENTRIES,
+            ttl_seconds=settings.API_KEY_CACHE_TTL_SECONDS,
+            negative_ttl_seconds=settings.API_KEY_CACHE_NEGATIVE_TTL_SECONDS,
+        )
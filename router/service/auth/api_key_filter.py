@@ -0,0 +1,98 @@
+import hashlib
+from typing import Callable
+from typing import Optional
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+
+import settings
+from router import api_logger
+from router.utils.bloom_filter import BloomFilter
+
+API_KEY_FILTER_CHECKS = Counter(
+    "llm_proxy_api_key_filter_checks_total",
+    "Total count of API keys checked against the key filter, by result "
+    "(rejected or passed).",
+    ["result"],
+)
+API_KEY_FILTER_SIZE_BYTES = Gauge(
+    "llm_proxy_api_key_filter_size_bytes",
+    "Memory held by the API key filter.",
+    multiprocess_mode="livemax",
+)
+API_KEY_FILTER_KEYS = Gauge(
+    "llm_proxy_api_key_filter_keys",
+    "API keys added to the API key filter.",
+    multiprocess_mode="livemax",
+)
+API_KEY_FILTER_FALSE_POSITIVE_RATE = Gauge(
+    "llm_proxy_api_key_filter_false_positive_rate",
+    "Expected false positive rate of the API key filter with its current keys.",
+    multiprocess_mode="livemax",
+)
+
+RESULT_REJECTED = "rejected"
+RESULT_PASSED = "passed"
+
+logger = api_logger.get()
+
+
+class ApiKeyFilter:
+    """
+    Bloom filter of the hashes of every issued legacy API key, keys it does
+    not contain are rejected without a lookup. Every key passes until the
+    filter is loaded.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.filter = BloomFilter(capacity, false_positive_rate)
+        self.is_ready = False
+        self.watch = None
+        API_KEY_FILTER_SIZE_BYTES.set(self.filter.get_size_bytes())
+
+    def add(self, api_key: str) -> None:
+        self.filter.add(_get_hash(api_key))
+        API_KEY_FILTER_KEYS.set(self.filter.count)
+        API_KEY_FILTER_FALSE_POSITIVE_RATE.set(self.filter.get_false_positive_rate())
+
+    def might_contain(self, api_key: str) -> bool:
+        if not self.is_ready:
+            return True
+        is_contained = _get_hash(api_key) in self.filter
+        API_KEY_FILTER_CHECKS.labels(
+            result=RESULT_PASSED if is_contained else RESULT_REJECTED
+        ).inc()
+        return is_contained
+
+    def start(self, listen: Callable[..., object]) -> None:
+        """
+        listen(on_change, include_existing, on_initial) calls on_change for
+        every existing and new (uid, api_key) and on_initial once the
+        existing ones are done
+        """
+        self.watch = listen(
+            self._on_change, include_existing=True, on_initial=self._on_initial
+        )
+
+    def close(self) -> None:
+        if self.watch is not None:
+            self.watch.unsubscribe()
+            self.watch = None
+
+    def _on_change(self, _uid: str, api_key: Optional[str]) -> None:
+        if api_key:
+            self.add(api_key)
+
+    def _on_initial(self) -> None:
+        self.is_ready = True
+        logger.info(f"API key filter loaded keys={self.filter.count}")
+
+
+def _get_hash(api_key: str) -> bytes:
+    return hashlib.sha256(api_key.encode()).digest()
+
+
+api_key_filter = ApiKeyFilter(
+    capacity=settings.API_KEY_FILTER_CAPACITY,
+    false_positive_rate=settings.API_KEY_FILTER_FALSE_POSITIVE_RATE,
+)
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import jwt
+from prometheus_client import Counter
+
+from router import api_logger
+from router.repository.user_repository import ValidatedUser
+
+JWKS_REFRESHES = Counter(
+    "llm_proxy_jwks_refreshes_total",
+    "Total count of session JWKS refreshes by result (success or failure).",
+    ["result"],
+)
+
+RESULT_SUCCESS = "success"
+RESULT_FAILURE = "failure"
+
+SESSION_CLAIM = "https://stytch.com/session"
+# Unknown key ids refresh the keys at most this often
+MIN_REFRESH_INTERVAL = 30
+
+logger = api_logger.get()
+
+
+class JwksCache:
+    """
+    Signing keys of session JWTs, fetched with fetch (off the event loop)
+    and refreshed every refresh_interval seconds in a background task. A JWT
+    signed with an unknown key refreshes the keys right away, concurrent
+    refreshes share one fetch.
+    """
+
+    def __init__(self, fetch: Callable[[], Dict], refresh_interval: float):
+        self.fetch = fetch
+        self.refresh_interval = refresh_interval
+        self.keys: Dict[str, jwt.PyJWK] = {}
+        self.refreshed_at: Optional[float] = None
+        self.refresh_task: Optional[asyncio.Future] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def get_key(self, kid: str) -> Optional[jwt.PyJWK]:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        key = self.keys.get(kid)
+        if key is None and (
+            self.refreshed_at is None
+            or time.monotonic() - self.refreshed_at >= MIN_REFRESH_INTERVAL
+        ):
+            await self.refresh()
+            key = self.keys.get(kid)
+        return key
+
+    async def refresh(self) -> None:
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.ensure_future(self._refresh())
+            self.refresh_task.add_done_callback(self._on_refreshed)
+        await asyncio.shield(self.refresh_task)
+
+    def _on_refreshed(self, _task: asyncio.Future) -> None:
+        self.refresh_task = None
+
+    async def _refresh(self) -> None:
+        self.refreshed_at = time.monotonic()
+        try:
+            jwks = await asyncio.to_thread(self.fetch)
+            keys = {}
+            for key in jwt.PyJWKSet.from_dict(jwks).keys:
+                keys[key.key_id] = key
+            self.keys = keys
+            JWKS_REFRESHES.labels(result=RESULT_SUCCESS).inc()
+        except Exception:
+            JWKS_REFRESHES.labels(result=RESULT_FAILURE).inc()
+            logger.error("Failed to refresh session JWKS", exc_info=True)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+
+async def verify(
+    session_jwt: str, jwks_cache: JwksCache, project_id: str, issuers: List[str]
+) -> Optional[Tuple[ValidatedUser, float]]:
+    """
+    Checks the signature and claims of a Stytch session JWT locally
+
+    Returns:
+        user of the session and when the JWT expires, None if the JWT is
+        not valid, expired or has no email
+    """
+    try:
+        kid = jwt.get_unverified_header(session_jwt).get("kid")
+    except jwt.InvalidTokenError:
+        return None
+    key = await jwks_cache.get_key(kid) if kid else None
+    if key is None:
+        return None
+    try:
+        claims = jwt.decode(
+            session_jwt,
+            key.key,
+            algorithms=["RS256"],
+            audience=project_id,
+            issuer=issuers,
+            options={"require": ["aud", "iss", "exp", "iat", "nbf", "sub"]},
+        )
+    except jwt.InvalidTokenError:
+        return None
+    email = _get_email(claims.get(SESSION_CLAIM) or {})
+    if not email:
+        return None
+    return ValidatedUser(uid=claims["sub"], email=email), claims["exp"]
+
+
+def is_jwt(token: str) -> bool:
+    return token.startswith("eyJ") and token.count(".") == 2
+
+
+def _get_email(session: Dict) -> Optional[str]:
+    for factor in session.get("authentication_factors") or []:
+        email = (factor.get("email_factor") or {}).get("email_address")
+        if email:
+            return email
+    return None
@@ -0,0 +1,141 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import secrets
+from dataclasses import dataclass
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Set
+
+from prometheus_client import Counter
+
+import settings
+
+SIGNED_API_KEY_VALIDATIONS = Counter(
+    "llm_proxy_signed_api_key_validations_total",
+    "Total count of signed API key checks by result (valid, invalid or revoked).",
+    ["result"],
+)
+
+RESULT_VALID = "valid"
+RESULT_INVALID = "invalid"
+RESULT_REVOKED = "revoked"
+
+API_KEY_PREFIX = "lo-"
+# Legacy keys are secrets.token_urlsafe, which never contains "."
+SEPARATOR = "."
+SIGNATURE_BYTES = 16
+
+
+@dataclass(frozen=True)
+class SignedApiKey:
+    # Version of the signing secret
+    version: int
+    uid: str
+    # Random id of the key, used to revoke it
+    key_id: str
+
+
+class ApiKeySigner:
+    """
+    Signed API keys "lo-<version>.<uid>.<key id>.<signature>" carry the uid of
+    their user and an HMAC-SHA256 of it, so they are checked without a
+    lookup. Keys are signed with the newest version of secrets, older
+    versions are still accepted so secrets can be rotated.
+    """
+
+    def __init__(self, secrets_by_version: Dict[int, bytes]):
+        self.secrets_by_version = secrets_by_version
+
+    def is_enabled(self) -> bool:
+        return bool(self.secrets_by_version)
+
+    def create(self, uid: str) -> str:
+        version = max(self.secrets_by_version)
+        payload = SEPARATOR.join(
+            [str(version), _encode(uid.encode()), secrets.token_urlsafe(9)]
+        )
+        return API_KEY_PREFIX + payload + SEPARATOR + self._sign(version, payload)
+
+    def parse(self, api_key: str) -> Optional[SignedApiKey]:
+        """
+        Returns:
+            the key if it is well formed and its signature is valid
+        """
+        parts = api_key[len(API_KEY_PREFIX):].split(SEPARATOR)
+        if len(parts) != 4 or not parts[0].isdigit():
+            return None
+        version = int(parts[0])
+        if version not in self.secrets_by_version:
+            return None
+        payload = SEPARATOR.join(parts[:3])
+        if not hmac.compare_digest(self._sign(version, payload), parts[3]):
+            return None
+        try:
+            uid = _decode(parts[1]).decode()
+        except (binascii.Error, UnicodeDecodeError):
+            return None
+        return SignedApiKey(version=version, uid=uid, key_id=parts[2])
+
+    def _sign(self, version: int, payload: str) -> str:
+        digest = hmac.new(
+            self.secrets_by_version[version], payload.encode(), hashlib.sha256
+        ).digest()
+        return _encode(digest[:SIGNATURE_BYTES])
+
+
+def is_signed(api_key: str) -> bool:
+    return SEPARATOR in api_key
+
+
+class RevokedApiKeys:
+    """
+    Ids of revoked signed keys, loaded at start and kept up to date by a
+    listener
+    """
+
+    def __init__(self):
+        self.key_ids: Set[str] = set()
+        self.watch = None
+
+    def start(
+        self,
+        load: Callable[[], Set[str]],
+        listen: Callable[[Callable[[str], None]], object],
+    ) -> None:
+        self.key_ids |= load()
+        self.watch = listen(self.key_ids.add)
+
+    def close(self) -> None:
+        if self.watch is not None:
+            self.watch.unsubscribe()
+            self.watch = None
+
+    def is_revoked(self, key_id: str) -> bool:
+        return key_id in self.key_ids
+
+
+def get_secrets_by_version(value: Optional[str]) -> Dict[int, bytes]:
+    """
+    value - "<version>:<secret>" pairs separated by ",", eg "1:abc,2:def"
+    """
+    secrets_by_version = {}
+    for item in (value or "").split(","):
+        version, _, secret = item.strip().partition(":")
+        if version.isdigit() and secret:
+            secrets_by_version[int(version)] = secret.encode()
+    return secrets_by_version
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+api_key_signer = ApiKeySigner(get_secrets_by_version(settings.API_KEY_SIGNING_SECRETS))
+revoked_api_keys = RevokedApiKeys()
@@ -1,21 +1,43 @@
+import asyncio
+import hashlib
+import time
 from abc import ABC
 from abc import abstractmethod
 from typing import Optional
+from typing import Tuple
 
 from fastapi import Security
 from fastapi.security import APIKeyHeader
+from prometheus_client import Counter
 from stytch import Client
 from stytch.consumer.models.sessions import AuthenticateResponse
 
 import settings
 from router import api_logger
-from router.repository.user_repository import UserRepositoryFirebase
 from router.repository.user_repository import ValidatedUser
 from router.service import error_responses
+from router.service.auth import session_jwt
+from router.service.auth import signed_api_key
+from router.service.auth.api_key_cache import ApiKeyCache
+from router.service.auth.api_key_filter import ApiKeyFilter
+from router.service.auth.session_jwt import JwksCache
+from router.service.auth.signed_api_key import ApiKeySigner
+from router.service.auth.signed_api_key import RevokedApiKeys
+from router.utils.ttl_cache import TtlCache
 
 API_KEY_NAME = "Authorization"
 API_KEY_HEADER = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 
+SESSION_VALIDATIONS = Counter(
+    "llm_proxy_session_validations_total",
+    "Total count of validated user sessions by method (cache, local or remote).",
+    ["method"],
+)
+
+METHOD_CACHE = "cache"
+METHOD_LOCAL = "local"
+METHOD_REMOTE = "remote"
+
 logger = api_logger.get()
 
 
@@ -28,12 +50,32 @@ class SessionTokenValidator(ABC):
 
 
 class StytchTokenValidator(SessionTokenValidator):
+    """
+    Session JWTs are verified locally with the cached project JWKS, session
+    tokens and JWTs that are expired or can't be verified locally are
+    authenticated with Stytch. Validated sessions are cached until they
+    expire, at most settings.STYTCH_SESSION_CACHE_MAX_TTL_SECONDS.
+    """
+
     def __init__(self, project_id: str, secret: str, environment: str = "test"):
+        self.project_id = project_id
         self.client = Client(
             project_id=project_id,
             secret=secret,
             environment=environment,
         )
+        self.issuers = [
+            f"stytch.com/{project_id}",
+            self.client.api_base.base_url.rstrip("/"),
+        ]
+        self.jwks_cache = JwksCache(
+            fetch=self.client.jwks_client.fetch_data,
+            refresh_interval=settings.STYTCH_JWKS_REFRESH_INTERVAL,
+        )
+        self.sessions: TtlCache[ValidatedUser] = TtlCache(
+            max_entries=settings.STYTCH_SESSION_CACHE_MAX_ENTRIES,
+            ttl_seconds=settings.STYTCH_SESSION_CACHE_MAX_TTL_SECONDS,
+        )
 
     async def validate(
         self, api_key_header: str = Security(API_KEY_HEADER)
@@ -42,19 +84,62 @@ class StytchTokenValidator(SessionTokenValidator):
             if not api_key_header:
                 raise error_responses.AuthorizationMissingAPIError()
 
-            resp: AuthenticateResponse = self.client.sessions.authenticate(
-                session_token=api_key_header
+            session_key = hashlib.sha256(api_key_header.encode()).digest()
+            user = self.sessions.get(session_key)
+            if user:
+                SESSION_VALIDATIONS.labels(method=METHOD_CACHE).inc()
+                return user
+
+            result = None
+            if session_jwt.is_jwt(api_key_header):
+                result = await session_jwt.verify(
+                    api_key_header, self.jwks_cache, self.project_id, self.issuers
+                )
+            if result:
+                SESSION_VALIDATIONS.labels(method=METHOD_LOCAL).inc()
+            else:
+                SESSION_VALIDATIONS.labels(method=METHOD_REMOTE).inc()
+                result = await asyncio.to_thread(self._authenticate, api_key_header)
+            user, expires_at = result
+            ttl = min(
+                expires_at - time.time(), settings.STYTCH_SESSION_CACHE_MAX_TTL_SECONDS
             )
-            user = resp.user
-            return ValidatedUser(uid=user.user_id, email=user.emails[0].email)
+            if ttl > 0:
+                self.sessions.set(session_key, user, ttl_seconds=ttl)
+            return user
         except Exception as exc:
             logger.debug(f"StytchTokenValidator.validate exception: {exc}")
             raise error_responses.InvalidCredentialsAPIError()
 
+    def _authenticate(self, token: str) -> Tuple[ValidatedUser, float]:
+        if session_jwt.is_jwt(token):
+            resp: AuthenticateResponse = self.client.sessions.authenticate(
+                session_jwt=token
+            )
+        else:
+            resp = self.client.sessions.authenticate(session_token=token)
+        user = resp.user
+        return (
+            ValidatedUser(uid=user.user_id, email=user.emails[0].email),
+            resp.session.expires_at.timestamp(),
+        )
+
 
 class ApiKeyValidator:
-    def __init__(self, user_repository: UserRepositoryFirebase):
-        self.user_repository = user_repository
+    def __init__(
+        self,
+        api_key_cache: ApiKeyCache,
+        api_key_signer: ApiKeySigner,
+        revoked_api_keys: RevokedApiKeys,
+        api_key_filter: ApiKeyFilter,
+        user_cache: ApiKeyCache,
+    ):
+        self.api_key_cache = api_key_cache
+        self.api_key_signer = api_key_signer
+        self.revoked_api_keys = revoked_api_keys
+        self.api_key_filter = api_key_filter
+        # Users by uid, signed keys only carry the uid
+        self.user_cache = user_cache
 
     async def validate(
         self,
@@ -78,9 +163,39 @@ class ApiKeyValidator:
                 "you using llmos.dev API Key."
             )
 
-        result = self.user_repository.validate_api_key(api_key_header)
+        if signed_api_key.is_signed(api_key_header):
+            return await self._validate_signed(api_key_header)
+
+        result = None
+        if self.api_key_filter.might_contain(api_key_header):
+            result = await self.api_key_cache.get(api_key_header)
         if result:
             return result
         raise error_responses.InvalidCredentialsAPIError(
             message_extra="API Key not found."
         )
+
+    async def _validate_signed(self, api_key: str) -> ValidatedUser:
+        key = self.api_key_signer.parse(api_key)
+        if not key:
+            signed_api_key.SIGNED_API_KEY_VALIDATIONS.labels(
+                result=signed_api_key.RESULT_INVALID
+            ).inc()
+            raise error_responses.InvalidCredentialsAPIError(
+                message_extra="API Key is not valid."
+            )
+        user = None
+        if not self.revoked_api_keys.is_revoked(key.key_id):
+            user = await self.user_cache.get(key.uid)
+        if not user:
+            # Keys of a deleted user are revoked with it
+            signed_api_key.SIGNED_API_KEY_VALIDATIONS.labels(
+                result=signed_api_key.RESULT_REVOKED
+            ).inc()
+            raise error_responses.InvalidCredentialsAPIError(
+                message_extra="API Key has been revoked."
+            )
+        signed_api_key.SIGNED_API_KEY_VALIDATIONS.labels(
+            result=signed_api_key.RESULT_VALID
+        ).inc()
+        return user
@@ -0,0 +1,168 @@
+import time
+from collections import deque
+from enum import Enum
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+
+import settings
+from router import api_logger
+from router.service.completion.utils import ChatCompletionEndpoint
+
+UPSTREAM_CIRCUIT_STATE = Gauge(
+    "llm_proxy_upstream_circuit_state",
+    "Upstream circuit breaker state by endpoint: 0 - closed, 1 - half open, 2 - open.",
+    ["endpoint"],
+    multiprocess_mode="max",
+)
+UPSTREAM_CIRCUIT_TRANSITIONS = Counter(
+    "llm_proxy_upstream_circuit_transitions_total",
+    "Total count of upstream circuit breaker state changes by endpoint.",
+    ["endpoint", "from_state", "to_state"],
+)
+
+logger = api_logger.get()
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+
+_STATE_VALUES = {
+    CircuitState.CLOSED: 0,
+    CircuitState.HALF_OPEN: 1,
+    CircuitState.OPEN: 2,
+}
+
+
+class CircuitBreaker:
+    """
+    Opens when the failure rate over the last window_seconds reaches
+    failure_rate_threshold (with at least minimum_requests in the window).
+    After open_seconds it lets half_open_probes requests through, a successful
+    probe closes the circuit and a failed one opens it again.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = 0.5,
+        minimum_requests: int = 5,
+        window_seconds: float = 30,
+        open_seconds: float = 15,
+        half_open_probes: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_requests = minimum_requests
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.clock = clock
+
+        self.state = CircuitState.CLOSED
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        # (timestamp, is_failure)
+        self.outcomes: Deque[Tuple[float, bool]] = deque()
+        UPSTREAM_CIRCUIT_STATE.labels(endpoint=name).set(_STATE_VALUES[self.state])
+
+    def is_available(self) -> bool:
+        """Checks if a request would be allowed without reserving a probe."""
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN:
+            return self.clock() - self.opened_at >= self.open_seconds
+        return self.probes_in_flight < self.half_open_probes
+
+    def allow_request(self) -> bool:
+        if self.state == CircuitState.OPEN:
+            if self.clock() - self.opened_at < self.open_seconds:
+                return False
+            self._transition(CircuitState.HALF_OPEN)
+        if self.state == CircuitState.HALF_OPEN:
+            if self.probes_in_flight >= self.half_open_probes:
+                return False
+            self.probes_in_flight += 1
+        return True
+
+    def record_success(self) -> None:
+        if self.state == CircuitState.HALF_OPEN:
+            self._release_probe()
+            self.outcomes.clear()
+            self._transition(CircuitState.CLOSED)
+            return
+        self._add_outcome(is_failure=False)
+
+    def record_failure(self) -> None:
+        if self.state == CircuitState.HALF_OPEN:
+            self._release_probe()
+            self._open()
+            return
+        self._add_outcome(is_failure=True)
+        if self.state == CircuitState.CLOSED and self._is_failure_rate_exceeded():
+            self._open()
+
+    def release(self) -> None:
+        """For requests that ended without a verdict, eg. were cancelled."""
+        if self.state == CircuitState.HALF_OPEN:
+            self._release_probe()
+
+    def _add_outcome(self, is_failure: bool) -> None:
+        now = self.clock()
+        self.outcomes.append((now, is_failure))
+        while self.outcomes and now - self.outcomes[0][0] > self.window_seconds:
+            self.outcomes.popleft()
+
+    def _is_failure_rate_exceeded(self) -> bool:
+        if len(self.outcomes) < self.minimum_requests:
+            return False
+        failures = sum(1 for _, is_failure in self.outcomes if is_failure)
+        return failures / len(self.outcomes) >= self.failure_rate_threshold
+
+    def _open(self) -> None:
+        self.opened_at = self.clock()
+        self.outcomes.clear()
+        self._transition(CircuitState.OPEN)
+
+    def _release_probe(self) -> None:
+        self.probes_in_flight = max(0, self.probes_in_flight - 1)
+
+    def _transition(self, state: CircuitState) -> None:
+        if state == self.state:
+            return
+        logger.info(
+            f"Upstream circuit breaker state change endpoint={self.name} "
+            f"from={self.state.value} to={state.value}"
+        )
+        UPSTREAM_CIRCUIT_TRANSITIONS.labels(
+            endpoint=self.name, from_state=self.state.value, to_state=state.value
+        ).inc()
+        UPSTREAM_CIRCUIT_STATE.labels(endpoint=self.name).set(_STATE_VALUES[state])
+        self.state = state
+        if state != CircuitState.HALF_OPEN:
+            self.probes_in_flight = 0
+
+
+def get_circuit_breakers(
+    endpoints: List[ChatCompletionEndpoint],
+) -> Dict[str, CircuitBreaker]:
+    return {
+        endpoint.name: CircuitBreaker(
+            name=endpoint.name,
+            failure_rate_threshold=settings.CIRCUIT_BREAKER_FAILURE_RATE_THRESHOLD,
+            minimum_requests=settings.CIRCUIT_BREAKER_MINIMUM_REQUESTS,
+            window_seconds=settings.CIRCUIT_BREAKER_WINDOW_SECONDS,
+            open_seconds=settings.CIRCUIT_BREAKER_OPEN_SECONDS,
+            half_open_probes=settings.CIRCUIT_BREAKER_HALF_OPEN_PROBES,
+        )
+        for endpoint in endpoints
+    }
@@ -1,64 +1,309 @@
+import asyncio
+import time
+from dataclasses import dataclass
 from typing import Dict
+from typing import List
+from typing import Optional
 
-import aiohttp
+import orjson
 from router import api_logger
 from langsmith import traceable
-from starlette.responses import JSONResponse
+from starlette.responses import Response
 
+import settings
 from router import analytics
 from router.analytics import TrackingEventType
 from router.domain.pricing.entities import UsageDebug
 from router.domain.tokens.token_tracker import TokenTracker
+from router.domain.tokens.tokenizer import tokenizer
 from router.repository.user_repository import ValidatedUser
+from router.service import error_responses
+from router.service.completion import hedging
+from router.service.completion import json_bytes
+from router.service.completion import response_cache
+from router.service.completion.concurrency_limiter import concurrency_limiters
 from router.service.completion.entities import ChatCompletionRequest
-from router.service.completion.utils import get_chat_completion_endpoint
+from router.service.completion.load_balancer import get_chat_completion_endpoint
+from router.service.completion.load_balancer import load_balancer
+from router.service.completion.single_flight import single_flight
+from router.service.completion.upstream_client import UPSTREAM_ERRORS
+from router.service.completion.upstream_client import UpstreamClient
+from router.service.completion.upstream_client import post_json
+from router.service.completion.utils import ChatCompletionEndpoint
+from router.service.completion.utils import format_request
+from router.service.completion.utils import get_deterministic_request_key
 
 logger = api_logger.get()
 
+_MODEL_KEY = b'"model"'
+_USAGE_KEY = b'"usage"'
+_SERVED_MODEL = b'"mistralai/Mistral-7B-Instruct-v0.2"'
+
+
+@dataclass(frozen=True)
+class UpstreamResponse:
+    status: int
+    # Body sent to the client, the model is already rewritten
+    body: bytes
+    provider: str
+    # Model name reported by the upstream, used for token tracking
+    model: Optional[str]
+    usage: Optional[Dict]
+
 
 @traceable(run_type="chain", name="CompletionService")
 async def execute(
     request: ChatCompletionRequest,
     token_tracker: TokenTracker,
     validated_user: ValidatedUser,
-) -> JSONResponse:
-    # Clean up etc
-    request.model = "mistral-7b-instruct"
-    request_input = request.model_dump()
-
-    for m in request_input["messages"]:
-        if not m.get("function_call"):
-            m.pop("name", None)
-            m.pop("function_call", None)
-
-    # OpenAI API is annoying
-    formatted_dict = {}
-    for key, value in request_input.items():
-        if value:
-            formatted_dict[key] = value
-
-    status, response_dict, provider = await _get_oai_response(formatted_dict)
-    token_tracker.track(validated_user.uid, provider, response_dict)
+) -> Response:
+    formatted_dict = format_request(request)
+
+    cache_key = response_cache.get_cache_key(formatted_dict)
+    cached_response = response_cache.get(cache_key, is_stream=False)
+    if cached_response:
+        tracked_response = cached_response.get_tracked_response()
+        await token_tracker.track(
+            validated_user.uid, cached_response.provider, tracked_response, cached=True
+        )
+        analytics.track(
+            TrackingEventType.API_REQUEST,
+            validated_user.uid,
+            validated_user.email,
+            tokens=cached_response.usage,
+        )
+        return Response(content=cached_response.body, media_type="application/json")
+
+    is_leader = True
+    coalescing_key = _get_coalescing_key(formatted_dict)
+    if coalescing_key:
+        response, is_leader = await single_flight.do(
+            coalescing_key, lambda: _get_oai_response(formatted_dict)
+        )
+    else:
+        response = await _get_oai_response(formatted_dict)
+    usage = _get_usage(request, response)
+    # Every coalesced caller is billed, followers did not make an upstream call
+    await token_tracker.track(
+        validated_user.uid,
+        response.provider,
+        {"model": response.model, "usage": usage},
+        cached=not is_leader,
+    )
     analytics.track(
         TrackingEventType.API_REQUEST,
         validated_user.uid,
         validated_user.email,
-        tokens=response_dict.get("usage"),
+        tokens=usage,
+    )
+    if cache_key and is_leader and response.status == 200 and usage:
+        response_cache.response_cache.set(
+            cache_key,
+            response_cache.CachedResponse(
+                provider=response.provider,
+                model=response.model,
+                usage=usage,
+                body=response.body,
+            ),
+        )
+    return Response(
+        content=response.body,
+        status_code=response.status,
+        media_type="application/json",
     )
-    response_dict["model"] = "mistralai/Mistral-7B-Instruct-v0.2"
-    return JSONResponse(content=response_dict, status_code=status)
 
 
-@traceable(run_type="llm", name="openai.ChatCompletion.create")
-async def _get_oai_response(formatted_dict):
+def _get_usage(
+    request: ChatCompletionRequest, response: UpstreamResponse
+) -> Optional[Dict]:
+    if response.usage is not None or response.status != 200:
+        return response.usage
+    # The upstream left out usage, count the tokens locally
+    try:
+        choices = orjson.loads(response.body).get("choices") or []
+    except (orjson.JSONDecodeError, AttributeError):
+        return None
+    contents = [
+        (choice.get("message") or {}).get("content") or "" for choice in choices
+    ]
+    prompt_tokens = tokenizer.count_messages(request.messages)
+    completion_tokens = sum(tokenizer.count_batch(contents))
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _get_coalescing_key(formatted_dict: Dict) -> Optional[str]:
+    if not settings.SINGLE_FLIGHT_ENABLED:
+        return None
+    return get_deterministic_request_key(formatted_dict)
+
+
+def _get_traced_outputs(response: UpstreamResponse) -> Dict:
+    return {
+        "status": response.status,
+        "provider": response.provider,
+        "response": response.body.decode("utf-8", errors="replace"),
+    }
+
+
+@traceable(
+    run_type="llm",
+    name="openai.ChatCompletion.create",
+    process_outputs=_get_traced_outputs,
+)
+async def _get_oai_response(formatted_dict) -> UpstreamResponse:
     endpoint = get_chat_completion_endpoint()
-    async with aiohttp.ClientSession() as session:
-        res = await session.post(
-            endpoint.url,
-            headers=endpoint.headers,
-            json=formatted_dict,
+    if not endpoint:
+        raise error_responses.ServiceUnavailableAPIError()
+    if settings.HEDGING_ENABLED:
+        return await _get_hedged_response(endpoint, formatted_dict)
+    return await _get_response_with_failover(endpoint, formatted_dict, [])
+
+
+async def _get_hedged_response(
+    endpoint: ChatCompletionEndpoint, formatted_dict: Dict
+) -> UpstreamResponse:
+    """
+    If the primary endpoint has not answered within its observed latency
+    percentile, the same request is sent to another endpoint. The first
+    successful response wins and the other request is cancelled, so only
+    the winner's usage gets tracked.
+    """
+    hedging.hedge_budget.on_request()
+    tried: List[str] = [endpoint.name]
+    primary_task = asyncio.create_task(
+        _get_response_with_failover(endpoint, formatted_dict, tried)
+    )
+    delay = hedging.get_hedge_delay(load_balancer.stats[endpoint.name])
+    if delay is None:
+        return await primary_task
+    done, _ = await asyncio.wait({primary_task}, timeout=delay)
+    if done:
+        return primary_task.result()
+
+    if not hedging.hedge_budget.try_spend():
+        hedging.HEDGES_SKIPPED.labels(reason="budget").inc()
+        return await primary_task
+    hedge_endpoint = load_balancer.choose(exclude=tried)
+    if not hedge_endpoint:
+        hedging.HEDGES_SKIPPED.labels(reason="no_endpoint").inc()
+        return await primary_task
+    tried.append(hedge_endpoint.name)
+    hedge_task = asyncio.create_task(_post(hedge_endpoint, formatted_dict))
+
+    winner = hedging.WINNER_NONE
+    pending = {primary_task, hedge_task}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None and task.result().status < 500:
+                    winner = (
+                        hedging.WINNER_PRIMARY
+                        if task is primary_task
+                        else hedging.WINNER_HEDGE
+                    )
+                    return task.result()
+        # Both failed, answer like the request was not hedged
+        return await primary_task
+    finally:
+        for task in pending:
+            task.cancel()
+        # The loser releases its slots before the winner is returned
+        await asyncio.gather(*pending, return_exceptions=True)
+        hedging.HEDGED_REQUESTS.labels(
+            primary_endpoint=endpoint.name,
+            hedge_endpoint=hedge_endpoint.name,
+            winner=winner,
+        ).inc()
+
+
+async def _get_response_with_failover(
+    endpoint: ChatCompletionEndpoint, formatted_dict: Dict, tried: List[str]
+) -> UpstreamResponse:
+    while True:
+        tried.append(endpoint.name)
+        response, error = None, None
+        try:
+            response = await _post(endpoint, formatted_dict)
+            if response.status < 500:
+                return response
+        except UPSTREAM_ERRORS as exc:
+            error = exc
+        logger.info(
+            f"Upstream request failed endpoint={endpoint.name} "
+            f"status={response.status if response else None} error={error!r}"
         )
-        return res.status, await res.json(), endpoint.name
+        failover_endpoint = load_balancer.failover(endpoint, exclude=tried)
+        if not failover_endpoint:
+            if error:
+                raise error_responses.BadGatewayAPIError()
+            return response
+        endpoint = failover_endpoint
+
+
+async def _post(
+    endpoint: ChatCompletionEndpoint, formatted_dict: Dict
+) -> UpstreamResponse:
+    session = UpstreamClient.instance().get_session(endpoint)
+    concurrency_limiter = concurrency_limiters[endpoint.name]
+    started_at = load_balancer.on_request_start(endpoint)
+    is_success = None
+    admitted_at = None
+    latency = None
+    try:
+        admitted_at = await concurrency_limiter.acquire()
+        async with post_json(session, endpoint, formatted_dict) as res:
+            body = await res.read()
+            is_success = res.status < 500
+            response = _get_upstream_response(endpoint, res.status, body)
+            latency = _get_latency_per_token(
+                time.perf_counter() - admitted_at, response.usage
+            )
+            return response
+    except UPSTREAM_ERRORS:
+        is_success = False
+        raise
+    finally:
+        if admitted_at is not None:
+            concurrency_limiter.release(is_success, latency)
+        load_balancer.on_request_end(endpoint, started_at, is_success)
+
+
+def _get_latency_per_token(latency: float, usage: Optional[Dict]) -> Optional[float]:
+    """
+    Response time grows with the completion, so the concurrency limiter is
+    fed the time per completion token
+
+    Returns:
+        None if the upstream did not report the completion tokens
+    """
+    completion_tokens = (usage or {}).get("completion_tokens")
+    if not isinstance(completion_tokens, int):
+        return None
+    return latency / max(completion_tokens, 1)
+
+
+def _get_upstream_response(
+    endpoint: ChatCompletionEndpoint, status: int, body: bytes
+) -> UpstreamResponse:
+    """
+    The body is passed on as is apart from the model value, only the model
+    and usage values are decoded.
+    """
+    body, upstream_model = json_bytes.replace_value(body, _MODEL_KEY, _SERVED_MODEL)
+    return UpstreamResponse(
+        status=status,
+        body=body,
+        provider=endpoint.name,
+        model=json_bytes.decode_string(upstream_model) if upstream_model else None,
+        usage=json_bytes.get_object(body, _USAGE_KEY),
+    )
 
 
 def _get_usage_response(usage: UsageDebug, usage_type: str) -> Dict:
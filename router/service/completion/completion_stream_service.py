@@ -1,111 +1,381 @@
-import json
+import asyncio
+import time
+from contextlib import aclosing
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Dict
 from typing import List
 from typing import AsyncIterable
+from typing import Optional
+from typing import Tuple
 
-import aiohttp
 from langsmith import traceable
+from prometheus_client import Counter
 
 from router import analytics
+from router import api_logger
 from router.analytics import TrackingEventType
 from router.domain.tokens.token_tracker import TokenTracker
+from router.domain.tokens.tokenizer import tokenizer
 from router.repository.user_repository import ValidatedUser
-from router.service.completion.entities import Message
-from router.service.completion.entities import BaseMessage
+from router.service import error_responses
+from router.service.completion import response_cache
+from router.service.completion import stream_broadcast
+from router.service.completion import stream_race
+from router.service.completion.concurrency_limiter import concurrency_limiters
 from router.service.completion.entities import ChatCompletionRequest
-from router.service.completion.utils import get_chat_completion_endpoint
+from router.service.completion.load_balancer import get_chat_completion_endpoint
+from router.service.completion.load_balancer import load_balancer
+from router.service.completion.sse import SseFramer
+from router.service.completion.sse import SseLine
+from router.service.completion.stream_accumulator import StreamAccumulator
+from router.service.completion.upstream_client import UPSTREAM_ERRORS
+from router.service.completion.upstream_client import UpstreamClient
+from router.service.completion.upstream_client import UpstreamError
+from router.service.completion.upstream_client import post_json
+from router.service.completion.utils import ChatCompletionEndpoint
+from router.service.completion.utils import format_request
+
+ABORTED_STREAMS = Counter(
+    "llm_proxy_aborted_streams_total",
+    "Total count of upstream streams cancelled before the end because every "
+    "client reading them disconnected.",
+)
+ABORTED_STREAM_TOKENS_SAVED = Counter(
+    "llm_proxy_aborted_stream_tokens_saved_total",
+    "Completion tokens not generated because the upstream stream was cancelled "
+    "after the client disconnected, counted up to the max_tokens of the request.",
+)
+
+logger = api_logger.get()
+
+
+@dataclass
+class StreamResult:
+    endpoint: ChatCompletionEndpoint
+    accumulator: StreamAccumulator = field(default_factory=StreamAccumulator)
+    # True once the first token has been sent to the client
+    is_committed: bool = False
+    # Upstream server error response, passed on if no other endpoint is left
+    error_body: Optional[bytes] = None
+    first_token_at: Optional[float] = None
+    # Upstream response status, error responses below 500 are streamed as is
+    status: Optional[int] = None
 
 
 async def execute(
     request: ChatCompletionRequest,
     token_tracker: TokenTracker,
     validated_user: ValidatedUser,
+    is_race_requested: bool = False,
 ) -> AsyncIterable:
-    # Clean up etc
-    request.model = "mistral-7b-instruct"
-    request_input = request.model_dump()
-
-    for m in request_input["messages"]:
-        if not m.get("function_call"):
-            m.pop("name", None)
-            m.pop("function_call", None)
-
-    # OpenAI API is annoying
-    formatted_dict = {}
-    for key, value in request_input.items():
-        if value:
-            formatted_dict[key] = value
-
-    all_lines = []
-    endpoint = get_chat_completion_endpoint()
-    async with aiohttp.ClientSession() as session:
-        res = await session.post(
-            endpoint.url,
-            headers=endpoint.headers,
-            json=formatted_dict,
-        )
-        completion_tokens = 0
-        usage = None
-        async for line in res.content:
-            try:
-                decoded = line.decode()
-                if decoded[1] != "\n":
-                    decoded_line = json.loads(decoded.split("data: ")[-1])
-                    if await _has_token(decoded_line):
-                        completion_tokens += 1
-                    all_lines.append(decoded_line)
-                    if decoded_line.get("usage"):
-                        usage = decoded_line["usage"]
-            except:
-                pass
-
-            try:
-                decoded = line.decode()
-                decoded_line = json.loads(decoded.split("data: ")[-1])
-                decoded_line["model"] = "mistralai/Mistral-7B-Instruct-v0.2"
-                decoded = "data: " + json.dumps(decoded_line)
-                yield str.encode(decoded)
-            except:
-                yield line
-        if usage is None:
-            prompt_tokens = await _estimate_prompt_len(request.messages)
-            usage = {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": completion_tokens + prompt_tokens,
-            }
-        token_tracker.track(
-            validated_user.uid, endpoint.name, {
-                "model": "mistralai/Mistral-7B-Instruct-v0.2", "usage": usage
-            }
+    formatted_dict = format_request(request)
+
+    cache_key = response_cache.get_cache_key(formatted_dict)
+    cached_response = response_cache.get(cache_key, is_stream=True)
+    if cached_response:
+        for chunk in cached_response.chunks:
+            yield chunk
+        await token_tracker.track(
+            validated_user.uid,
+            cached_response.provider,
+            cached_response.get_tracked_response(),
+            cached=True,
         )
         analytics.track(
             TrackingEventType.API_REQUEST,
             validated_user.uid,
             validated_user.email,
-            tokens=usage,
+            tokens=cached_response.usage,
+        )
+        return
+
+    is_owner = True
+    broadcast_key = stream_broadcast.get_broadcast_key(formatted_dict)
+    if broadcast_key:
+        chunks, is_owner = stream_broadcast.stream_broadcaster.subscribe(
+            broadcast_key, lambda: _open_stream(formatted_dict, is_race_requested)
         )
+    else:
+        chunks = _open_stream(formatted_dict, is_race_requested)
+
+    result = None
+    # Chunks are collected for the cache until they get too big to cache
+    cached_chunks = [] if cache_key and is_owner else None
+    cached_size = 0
+    try:
+        async for result, chunk in chunks:
+            if cached_chunks is not None:
+                cached_size += len(chunk)
+                if cached_size > response_cache.response_cache.max_entry_bytes:
+                    cached_chunks = None
+                else:
+                    cached_chunks.append(chunk)
+            yield chunk
+    except (
+        asyncio.CancelledError,
+        GeneratorExit,
+        stream_broadcast.SubscriberLagError,
+    ):
+        # The client disconnected or fell behind a shared stream, closing
+        # chunks cancels the upstream request unless others still read it
+        await chunks.aclose()
+        if result is not None and result.error_body is None:
+            await token_tracker.track(
+                validated_user.uid,
+                result.endpoint.name,
+                {
+                    "model": "mistralai/Mistral-7B-Instruct-v0.2",
+                    "usage": await _get_usage(request, result),
+                },
+                cached=not is_owner,
+            )
+        raise
+    if result is None or result.error_body is not None:
+        return
+
+    usage = await _get_usage(request, result)
+    await token_tracker.track(
+        validated_user.uid,
+        result.endpoint.name,
+        {"model": "mistralai/Mistral-7B-Instruct-v0.2", "usage": usage},
+        cached=not is_owner,
+    )
+    if cached_chunks is not None and result.status == 200:
+        response_cache.response_cache.set(
+            cache_key,
+            response_cache.CachedResponse(
+                provider=result.endpoint.name,
+                model="mistralai/Mistral-7B-Instruct-v0.2",
+                usage=usage,
+                chunks=cached_chunks,
+            ),
+        )
+    analytics.track(
+        TrackingEventType.API_REQUEST,
+        validated_user.uid,
+        validated_user.email,
+        tokens=usage,
+    )
+
+    accumulator = result.accumulator
 
     @traceable(run_type="llm", name="stream_openai.ChatCompletion.create")
     def trace(r):
+        return accumulator.model or "", accumulator.get_content()
+
+    trace(request)
+
+
+async def _open_stream(
+    formatted_dict: Dict, is_race_requested: bool
+) -> AsyncIterable[Tuple[StreamResult, bytes]]:
+    endpoint = get_chat_completion_endpoint(is_stream=True)
+    if not endpoint:
+        raise error_responses.ServiceUnavailableAPIError()
+    race_endpoint = None
+    stream_race.stream_race_budget.on_request()
+    if is_race_requested:
+        race_endpoint = _get_race_endpoint(endpoint)
+    if race_endpoint:
+        chunks = _race_streams([endpoint, race_endpoint], formatted_dict)
+    else:
+        chunks = _stream_with_failover(endpoint, formatted_dict)
+    result = None
+    try:
+        async with aclosing(chunks):
+            async for result, chunk in chunks:
+                yield result, chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        # No one is reading the stream anymore
+        ABORTED_STREAMS.inc()
+        max_tokens = formatted_dict.get("max_tokens")
+        if max_tokens:
+            completion_tokens = (
+                result.accumulator.get_completion_tokens() if result else 0
+            )
+            ABORTED_STREAM_TOKENS_SAVED.inc(max(max_tokens - completion_tokens, 0))
+        raise
+
+
+def _get_race_endpoint(
+    endpoint: ChatCompletionEndpoint,
+) -> Optional[ChatCompletionEndpoint]:
+    if not stream_race.stream_race_budget.try_spend():
+        stream_race.STREAM_RACES_SKIPPED.labels(reason="budget").inc()
+        return None
+    race_endpoint = load_balancer.choose(is_stream=True, exclude=[endpoint.name])
+    if not race_endpoint:
+        stream_race.STREAM_RACES_SKIPPED.labels(reason="no_endpoint").inc()
+    return race_endpoint
+
+
+async def _stream_with_failover(
+    endpoint: ChatCompletionEndpoint, formatted_dict: Dict
+) -> AsyncIterable[Tuple[StreamResult, bytes]]:
+    tried: List[str] = []
+    while True:
+        tried.append(endpoint.name)
+        result = StreamResult(endpoint=endpoint)
         try:
-            model = all_lines[0]["model"]
-            content = "".join(
-                [l["choices"][0]["delta"].get("content", "") for l in all_lines]
+            async with aclosing(_stream(endpoint, formatted_dict, result)) as stream:
+                async for chunk in stream:
+                    yield result, chunk
+            return
+        except UPSTREAM_ERRORS as exc:
+            # Once the first token is out the client has the stream, no failover
+            if result.is_committed:
+                raise
+            logger.info(
+                f"Upstream stream failed before first token "
+                f"endpoint={endpoint.name} error={exc!r}"
             )
-            return model, content
-        except:
-            return "", ""
+            failover_endpoint = load_balancer.failover(
+                endpoint, exclude=tried, is_stream=True
+            )
+            if not failover_endpoint:
+                if result.error_body is not None:
+                    yield result, result.error_body
+                    return
+                raise error_responses.BadGatewayAPIError() from exc
+            endpoint = failover_endpoint
 
-    trace(request)
+
+async def _race_streams(
+    endpoints: List[ChatCompletionEndpoint], formatted_dict: Dict
+) -> AsyncIterable[Tuple[StreamResult, bytes]]:
+    """
+    Opens the stream on every endpoint and commits to the first one to emit
+    a token (_stream yields nothing before that), the others are aborted.
+    """
+    racers = {}
+    for endpoint in endpoints:
+        result = StreamResult(endpoint=endpoint)
+        stream = _stream(endpoint, formatted_dict, result)
+        racers[asyncio.ensure_future(stream.__anext__())] = (result, stream)
+
+    winner = None
+    first_chunk = None
+    failed = []
+    pending = set(racers)
+    try:
+        while pending and not winner:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                error = task.exception()
+                if winner or (error and not isinstance(error, StopAsyncIteration)):
+                    if error:
+                        failed.append((racers[task][0], error))
+                    else:
+                        # Lost a photo finish, abandon the stream
+                        await racers[task][1].aclose()
+                    continue
+                winner = racers[task]
+                first_chunk = None if error else task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    stream_race.STREAM_RACES.labels(
+        winner_endpoint=winner[0].endpoint.name if winner else stream_race.WINNER_NONE
+    ).inc()
+
+    if not winner:
+        for result, error in failed:
+            if result.error_body is not None:
+                yield result, result.error_body
+                return
+        error = failed[-1][1]
+        if isinstance(error, UPSTREAM_ERRORS):
+            raise error_responses.BadGatewayAPIError() from error
+        raise error
+    result, stream = winner
+    async with aclosing(stream):
+        if first_chunk is not None:
+            yield result, first_chunk
+            async for chunk in stream:
+                yield result, chunk
+
+
+async def _stream(
+    endpoint: ChatCompletionEndpoint, formatted_dict: Dict, result: StreamResult
+) -> AsyncIterable:
+    """
+    Lines are held back until the first token arrives, so a stream that fails
+    before that can still be retried on another endpoint unnoticed.
+    """
+    session = UpstreamClient.instance().get_session(endpoint)
+    concurrency_limiter = concurrency_limiters[endpoint.name]
+    started_at = load_balancer.on_request_start(endpoint)
+    is_success = None
+    admitted_at = None
+    pending: List[bytes] = []
+    framer = SseFramer(model="mistralai/Mistral-7B-Instruct-v0.2")
+    try:
+        admitted_at = await concurrency_limiter.acquire()
+        async with post_json(session, endpoint, formatted_dict) as res:
+            result.status = res.status
+            if res.status >= 500:
+                result.error_body = await res.read()
+                raise UpstreamError(endpoint.name, res.status)
+            is_success = True
+            async for data in res.content.iter_any():
+                for line in framer.feed(data):
+                    _on_line(endpoint, started_at, result, line)
+                    pending.append(line.data)
+                if result.accumulator.model is None:
+                    result.accumulator.model = framer.upstream_model
+                if result.is_committed and pending:
+                    yield b"".join(pending)
+                    pending = []
+            for line in framer.flush():
+                _on_line(endpoint, started_at, result, line)
+                pending.append(line.data)
+            if pending:
+                yield b"".join(pending)
+    except UPSTREAM_ERRORS:
+        is_success = False
+        raise
+    except (asyncio.CancelledError, GeneratorExit):
+        if not result.is_committed:
+            # Aborted before the endpoint got to prove itself
+            is_success = None
+        raise
+    finally:
+        if admitted_at is not None:
+            ttft = None
+            if result.first_token_at is not None:
+                ttft = result.first_token_at - admitted_at
+            concurrency_limiter.release(is_success, ttft, is_stream=True)
+        load_balancer.on_request_end(
+            endpoint, started_at, is_success, track_latency=False
+        )
 
 
-async def _estimate_prompt_len(messages: List[Message]) -> int:
-    token_count = 0
-    for message in messages:
-        if isinstance(message, BaseMessage):
-            token_count += len(message.content or "") // 3
-    return token_count
+async def _get_usage(request: ChatCompletionRequest, result: StreamResult) -> Dict:
+    accumulator = result.accumulator
+    if accumulator.usage is not None:
+        return accumulator.usage
+    prompt_tokens = tokenizer.count_messages(request.messages)
+    completion_tokens = accumulator.get_completion_tokens()
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": completion_tokens + prompt_tokens,
+    }
 
 
-async def _has_token(chunk: dict) -> bool:
-    return chunk["choices"][0]["delta"].get("content") is not None
+def _on_line(
+    endpoint: ChatCompletionEndpoint,
+    started_at: float,
+    result: StreamResult,
+    line: SseLine,
+) -> None:
+    # The first chunk of OpenAI style streams is a role delta with empty content
+    if line.content and not result.is_committed:
+        load_balancer.on_first_token(endpoint, started_at)
+        result.first_token_at = time.perf_counter()
+        result.is_committed = True
+    result.accumulator.add(line)
@@ -0,0 +1,291 @@
+import asyncio
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
+import settings
+from router import api_logger
+from router.service import error_responses
+from router.service.completion.utils import ChatCompletionEndpoint
+from router.service.completion.utils import get_chat_completion_endpoints
+
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "llm_proxy_upstream_concurrency_limit",
+    "Adaptive limit of requests in flight by endpoint.",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_QUEUE_DEPTH = Gauge(
+    "llm_proxy_upstream_queue_depth",
+    "Requests waiting for a slot by endpoint.",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_QUEUE_WAIT = Histogram(
+    "llm_proxy_upstream_queue_wait_seconds",
+    "Histogram of time waited for a slot before the upstream request (in seconds)",
+    ["endpoint"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0),
+)
+UPSTREAM_SHED_REQUESTS = Counter(
+    "llm_proxy_upstream_shed_requests_total",
+    "Total count of requests shed before reaching the endpoint, by reason.",
+    ["endpoint", "reason"],
+)
+
+REASON_QUEUE_FULL = "queue_full"
+REASON_QUEUE_TIME = "queue_time"
+REASON_TIMEOUT = "timeout"
+
+# Weights of a new latency sample in the recent and long term averages
+SHORT_WINDOW_ALPHA = 0.2
+LONG_WINDOW_ALPHA = 0.02
+
+logger = api_logger.get()
+
+
+@dataclass
+class _Latencies:
+    short: float
+    long: float
+
+    def add(self, latency: float) -> None:
+        self.short += SHORT_WINDOW_ALPHA * (latency - self.short)
+        self.long += LONG_WINDOW_ALPHA * (latency - self.long)
+
+
+@dataclass
+class _Waiter:
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class ConcurrencyLimiter:
+    """
+    Adaptive limit of the requests in flight to one endpoint, with a bounded
+    FIFO queue in front of it.
+
+    The limit follows the latency gradient, the long term average latency
+    over the recent one: while recent latency stays within latency_tolerance
+    of the long term average the limit grows by about sqrt(limit), past that
+    it shrinks in proportion. Failed requests cut it by backoff_ratio. TTFT
+    of streams and latency per completion token of plain requests are
+    averaged separately, neither depends on the length of the completion.
+
+    Queued requests are shed CoDel style: if no request got through the
+    queue in under queue_target during the last queue_interval, the queue is
+    standing and requests waiting longer than queue_target are shed,
+    otherwise they wait up to queue_timeout.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: int = 20,
+        min_limit: int = 4,
+        max_limit: int = 256,
+        latency_tolerance: float = 1.5,
+        backoff_ratio: float = 0.9,
+        smoothing: float = 0.2,
+        max_queue_size: int = 100,
+        queue_target: float = 1,
+        queue_interval: float = 10,
+        queue_timeout: float = 15,
+        clock: Callable[[], float] = time.perf_counter,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        self.smoothing = smoothing
+        self.max_queue_size = max_queue_size
+        self.queue_target = queue_target
+        self.queue_interval = queue_interval
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+
+        self.limit = 0.0
+        self.in_flight = 0
+        self.latencies: Dict[bool, _Latencies] = {}
+        self.waiters: Deque[_Waiter] = deque()
+        # CoDel state: the shortest wait of the current interval
+        self.min_wait = math.inf
+        self.interval_end = clock() + queue_interval
+        self.is_queue_standing = False
+        self._set_limit(initial_limit)
+
+    def get_limit(self) -> int:
+        return int(self.limit)
+
+    async def acquire(self) -> float:
+        """
+        Waits for a slot, release has to be called once the request ends
+
+        Returns:
+            admission time, as per clock
+        Raises:
+            ServiceUnavailableAPIError if the request is shed
+        """
+        now = self.clock()
+        self._shed_expired(now)
+        if not self.waiters and self.in_flight < self.get_limit():
+            self._admit(0.0)
+            return now
+        if len(self.waiters) >= self.max_queue_size:
+            self._shed(REASON_QUEUE_FULL)
+            raise error_responses.ServiceUnavailableAPIError(
+                retry_after=self.queue_target
+            )
+
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(future=loop.create_future(), enqueued_at=now)
+        self.waiters.append(waiter)
+        UPSTREAM_QUEUE_DEPTH.labels(endpoint=self.name).set(len(self.waiters))
+        timeout = loop.call_later(
+            self.queue_timeout, self._expire, waiter, REASON_TIMEOUT
+        )
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Got the slot just as the request was cancelled
+                if waiter.future.exception() is None:
+                    self.release(is_success=None)
+            raise
+        finally:
+            timeout.cancel()
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+                UPSTREAM_QUEUE_DEPTH.labels(endpoint=self.name).set(len(self.waiters))
+
+    def release(
+        self,
+        is_success: Optional[bool],
+        latency: Optional[float] = None,
+        is_stream: bool = False,
+    ) -> None:
+        """
+        is_success - None if the request was abandoned (eg. cancelled) before
+        the endpoint could succeed or fail
+        latency - since admission, TTFT for streams, response time per
+        completion token otherwise
+        """
+        if is_success is False:
+            self._set_limit(self.limit * self.backoff_ratio)
+        elif is_success and latency is not None:
+            self._on_latency(latency, is_stream)
+        self.in_flight = max(0, self.in_flight - 1)
+        self._dispatch()
+
+    def _on_latency(self, latency: float, is_stream: bool) -> None:
+        latencies = self.latencies.get(is_stream)
+        if latencies is None:
+            self.latencies[is_stream] = _Latencies(short=latency, long=latency)
+            return
+        latencies.add(latency)
+        if latencies.short <= 0:
+            return
+        gradient = max(
+            0.5, min(1.0, self.latency_tolerance * latencies.long / latencies.short)
+        )
+        if gradient == 1.0 and self.in_flight * 2 < self.limit:
+            # Far from the limit, latency says nothing about raising it
+            return
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        self._set_limit(self.limit * (1 - self.smoothing) + new_limit * self.smoothing)
+
+    def _set_limit(self, limit: float) -> None:
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+        UPSTREAM_CONCURRENCY_LIMIT.labels(endpoint=self.name).set(self.get_limit())
+
+    def _dispatch(self) -> None:
+        now = self.clock()
+        self._shed_expired(now)
+        while self.waiters and self.in_flight < self.get_limit():
+            waiter = self.waiters.popleft()
+            if waiter.future.done():
+                continue
+            self._admit(now - waiter.enqueued_at)
+            waiter.future.set_result(now)
+        UPSTREAM_QUEUE_DEPTH.labels(endpoint=self.name).set(len(self.waiters))
+
+    def _admit(self, wait: float) -> None:
+        self.in_flight += 1
+        self.min_wait = min(self.min_wait, wait)
+        UPSTREAM_QUEUE_WAIT.labels(endpoint=self.name).observe(wait)
+
+    def _shed_expired(self, now: float) -> None:
+        if self._is_queue_standing(now):
+            max_wait, reason = self.queue_target, REASON_QUEUE_TIME
+        else:
+            max_wait, reason = self.queue_timeout, REASON_TIMEOUT
+        while self.waiters and now - self.waiters[0].enqueued_at > max_wait:
+            self._expire(self.waiters[0], reason)
+
+    def _is_queue_standing(self, now: float) -> bool:
+        if now < self.interval_end:
+            return self.is_queue_standing
+        if self.min_wait == math.inf:
+            # Nothing got through during the interval
+            is_queue_standing = bool(self.waiters) and (
+                now - self.waiters[0].enqueued_at > self.queue_target
+            )
+        else:
+            is_queue_standing = self.min_wait > self.queue_target
+        if is_queue_standing != self.is_queue_standing:
+            logger.info(
+                f"Upstream queue endpoint={self.name} "
+                f"is_standing={is_queue_standing} limit={self.get_limit()} "
+                f"queued={len(self.waiters)}"
+            )
+        self.is_queue_standing = is_queue_standing
+        self.min_wait = math.inf
+        self.interval_end = now + self.queue_interval
+        return is_queue_standing
+
+    def _expire(self, waiter: _Waiter, reason: str) -> None:
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+            UPSTREAM_QUEUE_DEPTH.labels(endpoint=self.name).set(len(self.waiters))
+        if waiter.future.done():
+            return
+        self._shed(reason)
+        waiter.future.set_exception(
+            error_responses.ServiceUnavailableAPIError(retry_after=self.queue_target)
+        )
+
+    def _shed(self, reason: str) -> None:
+        UPSTREAM_SHED_REQUESTS.labels(endpoint=self.name, reason=reason).inc()
+
+
+def get_concurrency_limiters(
+    endpoints: List[ChatCompletionEndpoint],
+) -> Dict[str, ConcurrencyLimiter]:
+    return {
+        endpoint.name: ConcurrencyLimiter(
+            name=endpoint.name,
+            initial_limit=settings.UPSTREAM_CONCURRENCY_INITIAL_LIMIT,
+            min_limit=settings.UPSTREAM_CONCURRENCY_MIN_LIMIT,
+            max_limit=settings.UPSTREAM_CONCURRENCY_MAX_LIMIT,
+            latency_tolerance=settings.UPSTREAM_CONCURRENCY_LATENCY_TOLERANCE,
+            max_queue_size=settings.UPSTREAM_QUEUE_MAX_SIZE,
+            queue_target=settings.UPSTREAM_QUEUE_TARGET_SECONDS,
+            queue_interval=settings.UPSTREAM_QUEUE_INTERVAL_SECONDS,
+            queue_timeout=settings.UPSTREAM_QUEUE_TIMEOUT_SECONDS,
+        )
+        for endpoint in endpoints
+    }
+
+
+concurrency_limiters = get_concurrency_limiters(get_chat_completion_endpoints())
@@ -0,0 +1,110 @@
+from typing import List
+from typing import Optional
+
+from prometheus_client import Counter
+
+from router import api_logger
+from router.domain.tokens.tokenizer import TOKENS_PER_REQUEST
+from router.domain.tokens.tokenizer import tokenizer
+from router.service import error_responses
+from router.service.completion import model_registry
+from router.service.completion.entities import ChatCompletionRequest
+
+CONTEXT_WINDOW_OVERFLOWS = Counter(
+    "llm_proxy_context_window_overflows_total",
+    "Total count of requests that did not fit in the model context window, by "
+    "what was done about it (rejected or trimmed).",
+    ["action"],
+)
+CONTEXT_WINDOW_TRIMMED_MESSAGES = Counter(
+    "llm_proxy_context_window_trimmed_messages_total",
+    "Total count of messages dropped from requests to fit the context window.",
+)
+
+ACTION_REJECTED = "rejected"
+ACTION_TRIMMED = "trimmed"
+
+OVERFLOW_TRIM = "trim"
+
+logger = api_logger.get()
+
+
+def warn_if_disabled() -> None:
+    """Called at startup, without a vocab oversized prompts go upstream as is"""
+    if not tokenizer.is_loaded():
+        logger.warning(
+            "Context window is not enforced, set TOKENIZER_PATH to the "
+            "tokenizer.json of the served model to enable it"
+        )
+
+
+def is_trim_requested(overflow_header: Optional[str] = None) -> bool:
+    """
+    Oversized prompts are rejected unless the client sends
+    "X-Context-Overflow: trim"
+    """
+    return overflow_header is not None and overflow_header.lower() == OVERFLOW_TRIM
+
+
+def apply(request: ChatCompletionRequest, is_trim_requested: bool = False) -> None:
+    """
+    Makes sure the messages and max_tokens of the request fit in the context
+    window of the model, so an oversized request does not make an upstream
+    round trip just to fail. If trimming is requested the oldest non-system
+    messages are dropped from the request until it fits.
+
+    Token counts are only trusted with a tokenizer vocab, without one the
+    request is passed on as is.
+    """
+    if not tokenizer.is_loaded():
+        return
+    context_window = model_registry.get_model(request.model).context_window
+    # Without max_tokens the model needs room for at least one token
+    completion_tokens = request.max_tokens or 1
+    counts = tokenizer.count_each_message(request.messages)
+    prompt_tokens = TOKENS_PER_REQUEST + sum(counts)
+    if prompt_tokens + completion_tokens <= context_window:
+        return
+
+    kept = None
+    if is_trim_requested:
+        kept = _get_trimmed_indexes(
+            request, counts, context_window - completion_tokens - TOKENS_PER_REQUEST
+        )
+    if kept is None:
+        CONTEXT_WINDOW_OVERFLOWS.labels(action=ACTION_REJECTED).inc()
+        raise error_responses.ContextLengthExceededAPIError(
+            context_window=context_window,
+            prompt_tokens=prompt_tokens,
+            max_tokens=completion_tokens,
+        )
+    CONTEXT_WINDOW_OVERFLOWS.labels(action=ACTION_TRIMMED).inc()
+    CONTEXT_WINDOW_TRIMMED_MESSAGES.inc(len(request.messages) - len(kept))
+    request.messages = [request.messages[i] for i in kept]
+
+
+def _get_trimmed_indexes(
+    request: ChatCompletionRequest, counts: List[int], max_tokens: int
+) -> Optional[List[int]]:
+    """
+    Drops the oldest non-system messages, the last message is always kept
+    and the remaining conversation still starts with a user turn.
+
+    Returns:
+        indexes of the messages to keep, None if the request can't fit
+    """
+    messages = request.messages
+    kept = list(range(len(messages)))
+    total = sum(counts)
+    while total > max_tokens:
+        droppable = [i for i in kept[:-1] if messages[i].role != "system"]
+        if not droppable:
+            return None
+        dropped = [droppable[0]]
+        # Mistral expects the conversation to start with the user
+        if len(droppable) > 1 and messages[droppable[1]].role == "assistant":
+            dropped.append(droppable[1])
+        for i in dropped:
+            kept.remove(i)
+            total -= counts[i]
+    return kept
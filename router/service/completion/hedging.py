@@ -0,0 +1,60 @@
+from typing import Optional
+
+from prometheus_client import Counter
+
+import settings
+from router.service.completion.load_balancer import EndpointStats
+
+HEDGED_REQUESTS = Counter(
+    "llm_proxy_hedged_requests_total",
+    "Total count of hedge requests sent to a second endpoint, by which "
+    "request won.",
+    ["primary_endpoint", "hedge_endpoint", "winner"],
+)
+HEDGES_SKIPPED = Counter(
+    "llm_proxy_hedges_skipped_total",
+    "Total count of slow requests that were not hedged, by reason.",
+    ["reason"],
+)
+
+WINNER_PRIMARY = "primary"
+WINNER_HEDGE = "hedge"
+WINNER_NONE = "none"
+
+
+class HedgeBudget:
+    """
+    Caps hedges to max_rate of all requests: every request earns max_rate
+    tokens (up to max_tokens for bursts) and every hedge spends one.
+    """
+
+    def __init__(self, max_rate: float, max_tokens: float = 10):
+        self.max_rate = max_rate
+        self.max_tokens = max_tokens
+        self.tokens = 0.0
+
+    def on_request(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.max_rate)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def get_hedge_delay(endpoint_stats: EndpointStats) -> Optional[float]:
+    """
+    Returns:
+        seconds to wait for the primary endpoint before hedging, None if
+        there are not enough latency observations to tell what is slow
+    """
+    latency = endpoint_stats.get_latency_percentile(
+        settings.HEDGE_LATENCY_PERCENTILE, min_samples=settings.HEDGE_MIN_SAMPLES
+    )
+    if latency is None:
+        return None
+    return max(latency, settings.HEDGE_MIN_DELAY)
+
+
+hedge_budget = HedgeBudget(max_rate=settings.HEDGE_MAX_RATE)
@@ -0,0 +1,124 @@
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+import orjson
+
+_WHITESPACE = b" \t\r\n"
+
+
+def find_value(data: bytes, key: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Looks up a key in encoded JSON without parsing it, the first match wins
+    so keys of the top level object must come before nested ones.
+
+    Args:
+        key: quoted key, eg. b'"model"'
+    Returns:
+        start and end offsets of the value of the key, None if there is no
+        such key
+    """
+    index = data.find(key)
+    while index != -1:
+        position = _skip_whitespace(data, index + len(key))
+        # A quoted "key" inside a string value ends with an escaped quote and
+        # can't be followed by a colon, so this only matches real keys
+        is_key = position < len(data) and data[position] == 0x3A  # ':'
+        if is_key and data[index - 1] != 0x5C:
+            start = _skip_whitespace(data, position + 1)
+            if start >= len(data):
+                return None
+            return start, _find_value_end(data, start)
+        index = data.find(key, index + len(key))
+    return None
+
+
+def replace_value(data: bytes, key: bytes, value: bytes) -> Tuple[bytes, Optional[bytes]]:
+    """
+    Returns:
+        data with the value of the key replaced by the encoded value, and the
+        encoded value it replaced (None if there is no such key)
+    """
+    found = find_value(data, key)
+    if not found:
+        return data, None
+    start, end = found
+    return data[:start] + value + data[end:], data[start:end]
+
+
+def get_string(data: bytes, key: bytes) -> Optional[str]:
+    found = find_value(data, key)
+    if not found:
+        return None
+    return decode_string(data[found[0]:found[1]])
+
+
+def get_object(data: bytes, key: bytes) -> Optional[Dict]:
+    found = find_value(data, key)
+    if not found or data[found[0]] != 0x7B:  # not an object, ie. null
+        return None
+    try:
+        return orjson.loads(data[found[0]:found[1]])
+    except orjson.JSONDecodeError:
+        return None
+
+
+def decode_string(value: bytes) -> Optional[str]:
+    """
+    Returns:
+        the encoded JSON string, None if value is not a string
+    """
+    if len(value) < 2 or value[0] != 0x22:  # '"'
+        return None
+    if b"\\" not in value:
+        return value[1:-1].decode("utf-8", errors="replace")
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        return None
+
+
+def _find_value_end(data: bytes, start: int) -> int:
+    first = data[start]
+    if first == 0x22:  # '"'
+        return _find_string_end(data, start)
+    if first in b"{[":
+        depth = 0
+        position = start
+        while position < len(data):
+            char = data[position]
+            if char == 0x22:
+                position = _find_string_end(data, position)
+                continue
+            if char in b"{[":
+                depth += 1
+            elif char in b"}]":
+                depth -= 1
+                if depth == 0:
+                    return position + 1
+            position += 1
+        return len(data)
+    end = start
+    while end < len(data) and data[end] not in b",}] \t\r\n":
+        end += 1
+    return end
+
+
+def _find_string_end(data: bytes, start: int) -> int:
+    position = start + 1
+    while True:
+        position = data.find(b'"', position)
+        if position == -1:
+            return len(data)
+        backslashes = 0
+        while data[position - 1 - backslashes] == 0x5C:  # '\'
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return position + 1
+        position += 1
+
+
+def _skip_whitespace(data: bytes, position: int) -> int:
+    while position < len(data) and data[position] in _WHITESPACE:
+        position += 1
+    return position
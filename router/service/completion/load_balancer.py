@@ -0,0 +1,305 @@
+import random
+import time
+from abc import ABC
+from abc import abstractmethod
+from collections import deque
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Collection
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+
+import settings
+from router.service.completion.circuit_breaker import CircuitBreaker
+from router.service.completion.circuit_breaker import get_circuit_breakers
+from router.service.completion.utils import ChatCompletionEndpoint
+from router.service.completion.utils import get_chat_completion_endpoints
+from router.service.completion.utils import get_provider_weights
+
+UPSTREAM_IN_FLIGHT_REQUESTS = Gauge(
+    "llm_proxy_upstream_in_flight_requests",
+    "Requests currently sent to the upstream endpoint and not yet finished.",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_SELECTIONS = Counter(
+    "llm_proxy_upstream_selections_total",
+    "Total count of times the load balancer picked an endpoint.",
+    ["endpoint", "policy"],
+)
+UPSTREAM_FAILOVERS = Counter(
+    "llm_proxy_upstream_failovers_total",
+    "Total count of requests retried on another endpoint after an upstream failure.",
+    ["from_endpoint", "to_endpoint", "is_stream"],
+)
+
+POLICY_RANDOM = "random"
+POLICY_LEAST_OUTSTANDING_REQUESTS = "least_outstanding_requests"
+POLICY_POWER_OF_TWO_CHOICES = "power_of_two_choices"
+
+# Recent successful non-streaming latencies kept per endpoint for percentiles
+LATENCY_SAMPLES = 256
+
+
+@dataclass
+class EndpointStats:
+    # Seconds, None until the first observation
+    ewma_latency: Optional[float] = None
+    ewma_ttft: Optional[float] = None
+    ewma_error_rate: float = 0.0
+    in_flight: int = 0
+    latencies: Deque[float] = field(
+        default_factory=lambda: deque(maxlen=LATENCY_SAMPLES)
+    )
+
+    def get_latency(self, is_stream: bool) -> Optional[float]:
+        # Streams are judged on time-to-first-token, the rest on full latency
+        if is_stream:
+            return self.ewma_ttft
+        return self.ewma_latency
+
+    def get_latency_percentile(
+        self, percentile: float, min_samples: int = 1
+    ) -> Optional[float]:
+        if len(self.latencies) < max(min_samples, 1):
+            return None
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+
+class BalancingPolicy(ABC):
+    name: str
+
+    @abstractmethod
+    def choose(
+        self,
+        candidates: List[ChatCompletionEndpoint],
+        stats: Dict[str, EndpointStats],
+        weights: Dict[str, float],
+        is_stream: bool,
+    ) -> ChatCompletionEndpoint:
+        pass
+
+
+class RandomPolicy(BalancingPolicy):
+    """Static weighted random choice, the original PROVIDER_RATIO coin flip."""
+
+    name = POLICY_RANDOM
+
+    def choose(self, candidates, stats, weights, is_stream):
+        return _weighted_choice(candidates, weights)
+
+
+class LeastOutstandingRequestsPolicy(BalancingPolicy):
+    """
+    Picks the endpoint with the fewest in-flight requests relative to its
+    weight, ties are broken by the lower observed latency.
+    """
+
+    name = POLICY_LEAST_OUTSTANDING_REQUESTS
+
+    def choose(self, candidates, stats, weights, is_stream):
+        weighted = [c for c in candidates if weights.get(c.name, 0) > 0] or candidates
+
+        def _key(endpoint: ChatCompletionEndpoint):
+            endpoint_stats = stats[endpoint.name]
+            weight = weights.get(endpoint.name) or 1.0
+            return (
+                (endpoint_stats.in_flight + 1) / weight,
+                endpoint_stats.get_latency(is_stream) or 0.0,
+            )
+
+        return min(weighted, key=_key)
+
+
+class PowerOfTwoChoicesPolicy(BalancingPolicy):
+    """
+    Samples two endpoints by weight (with replacement, so every endpoint with
+    a weight keeps receiving some traffic and fresh stats) and picks the one
+    with the lower expected cost.
+    """
+
+    name = POLICY_POWER_OF_TWO_CHOICES
+
+    def choose(self, candidates, stats, weights, is_stream):
+        first = _weighted_choice(candidates, weights)
+        second = _weighted_choice(candidates, weights)
+        if first.name == second.name:
+            return first
+        return min(
+            [first, second],
+            key=lambda endpoint: _get_cost(stats[endpoint.name], is_stream),
+        )
+
+
+class LoadBalancer:
+    def __init__(
+        self,
+        endpoints: List[ChatCompletionEndpoint],
+        weights: Dict[str, float],
+        policy: BalancingPolicy,
+        ewma_alpha: float = 0.3,
+        circuit_breakers: Optional[Dict[str, CircuitBreaker]] = None,
+    ):
+        self.endpoints = endpoints
+        self.weights = weights
+        self.policy = policy
+        self.ewma_alpha = ewma_alpha
+        self.circuit_breakers = circuit_breakers or {}
+        self.stats: Dict[str, EndpointStats] = {
+            endpoint.name: EndpointStats() for endpoint in endpoints
+        }
+
+    def choose(
+        self, is_stream: bool = False, exclude: Collection[str] = ()
+    ) -> Optional[ChatCompletionEndpoint]:
+        """
+        exclude - names of endpoints already tried for this request
+
+        Returns:
+            None if every endpoint is excluded or has an open circuit
+        """
+        candidates = [
+            endpoint
+            for endpoint in self.endpoints
+            if endpoint.name not in exclude and self._is_available(endpoint)
+        ]
+        while candidates:
+            endpoint = self.policy.choose(
+                candidates, self.stats, self.weights, is_stream
+            )
+            circuit_breaker = self.circuit_breakers.get(endpoint.name)
+            if circuit_breaker is None or circuit_breaker.allow_request():
+                UPSTREAM_SELECTIONS.labels(
+                    endpoint=endpoint.name, policy=self.policy.name
+                ).inc()
+                return endpoint
+            candidates.remove(endpoint)
+        return None
+
+    def failover(
+        self,
+        failed_endpoint: ChatCompletionEndpoint,
+        exclude: Collection[str],
+        is_stream: bool = False,
+    ) -> Optional[ChatCompletionEndpoint]:
+        endpoint = self.choose(is_stream=is_stream, exclude=exclude)
+        if endpoint:
+            UPSTREAM_FAILOVERS.labels(
+                from_endpoint=failed_endpoint.name,
+                to_endpoint=endpoint.name,
+                is_stream=is_stream,
+            ).inc()
+        return endpoint
+
+    def on_request_start(self, endpoint: ChatCompletionEndpoint) -> float:
+        """
+        Returns:
+            start time to pass to on_first_token and on_request_end
+        """
+        self.stats[endpoint.name].in_flight += 1
+        UPSTREAM_IN_FLIGHT_REQUESTS.labels(endpoint=endpoint.name).inc()
+        return time.perf_counter()
+
+    def on_first_token(self, endpoint: ChatCompletionEndpoint, started_at: float):
+        endpoint_stats = self.stats[endpoint.name]
+        endpoint_stats.ewma_ttft = self._ewma(
+            endpoint_stats.ewma_ttft, time.perf_counter() - started_at
+        )
+
+    def on_request_end(
+        self,
+        endpoint: ChatCompletionEndpoint,
+        started_at: float,
+        is_success: Optional[bool],
+        track_latency: bool = True,
+    ):
+        """
+        is_success - None if the request was abandoned (eg. cancelled) before
+        the endpoint could succeed or fail
+        track_latency - False for streams, whose total duration depends on
+        the completion length rather than on the endpoint
+        """
+        endpoint_stats = self.stats[endpoint.name]
+        endpoint_stats.in_flight = max(0, endpoint_stats.in_flight - 1)
+        UPSTREAM_IN_FLIGHT_REQUESTS.labels(endpoint=endpoint.name).dec()
+
+        circuit_breaker = self.circuit_breakers.get(endpoint.name)
+        if is_success is None:
+            if circuit_breaker:
+                circuit_breaker.release()
+            return
+        if circuit_breaker:
+            if is_success:
+                circuit_breaker.record_success()
+            else:
+                circuit_breaker.record_failure()
+
+        endpoint_stats.ewma_error_rate = self._ewma(
+            endpoint_stats.ewma_error_rate, 0.0 if is_success else 1.0
+        )
+        if track_latency and is_success:
+            latency = time.perf_counter() - started_at
+            endpoint_stats.ewma_latency = self._ewma(
+                endpoint_stats.ewma_latency, latency
+            )
+            endpoint_stats.latencies.append(latency)
+
+    def _is_available(self, endpoint: ChatCompletionEndpoint) -> bool:
+        circuit_breaker = self.circuit_breakers.get(endpoint.name)
+        return circuit_breaker is None or circuit_breaker.is_available()
+
+    def _ewma(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return self.ewma_alpha * value + (1 - self.ewma_alpha) * current
+
+
+def _weighted_choice(
+    candidates: List[ChatCompletionEndpoint], weights: Dict[str, float]
+) -> ChatCompletionEndpoint:
+    candidate_weights = [weights.get(c.name, 0) for c in candidates]
+    if sum(candidate_weights) <= 0:
+        return random.choice(candidates)
+    return random.choices(candidates, weights=candidate_weights)[0]
+
+
+def _get_cost(endpoint_stats: EndpointStats, is_stream: bool) -> float:
+    latency = endpoint_stats.get_latency(is_stream)
+    if latency is None:
+        # No observations yet, prefer it to get some
+        return 0.0
+    error_penalty = 1 - min(endpoint_stats.ewma_error_rate, 0.99)
+    return latency * (endpoint_stats.in_flight + 1) / error_penalty
+
+
+def get_policy(name: str) -> BalancingPolicy:
+    policies = {
+        POLICY_RANDOM: RandomPolicy,
+        POLICY_LEAST_OUTSTANDING_REQUESTS: LeastOutstandingRequestsPolicy,
+        POLICY_POWER_OF_TWO_CHOICES: PowerOfTwoChoicesPolicy,
+    }
+    if name not in policies:
+        raise ValueError(f"Unknown load balancer policy: {name}")
+    return policies[name]()
+
+
+load_balancer = LoadBalancer(
+    endpoints=get_chat_completion_endpoints(),
+    weights=get_provider_weights(),
+    policy=get_policy(settings.LOAD_BALANCER_POLICY),
+    ewma_alpha=settings.LOAD_BALANCER_EWMA_ALPHA,
+    circuit_breakers=get_circuit_breakers(get_chat_completion_endpoints()),
+)
+
+
+def get_chat_completion_endpoint(
+    is_stream: bool = False,
+) -> Optional[ChatCompletionEndpoint]:
+    return load_balancer.choose(is_stream=is_stream)
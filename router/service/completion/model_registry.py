@@ -0,0 +1,32 @@
+from dataclasses import dataclass
+from typing import Dict
+from typing import List
+
+import settings
+
+
+@dataclass(frozen=True)
+class ModelInfo:
+    # Name returned to clients
+    name: str
+    # Tokens of prompt and completion together
+    context_window: int
+
+
+MISTRAL_7B_INSTRUCT = ModelInfo(
+    name="mistralai/Mistral-7B-Instruct-v0.2",
+    context_window=settings.MISTRAL_7B_INSTRUCT_CONTEXT_WINDOW,
+)
+
+_MODELS: Dict[str, ModelInfo] = {model.name: model for model in [MISTRAL_7B_INSTRUCT]}
+
+
+def get_models() -> List[ModelInfo]:
+    return list(_MODELS.values())
+
+
+def get_model(name: str) -> ModelInfo:
+    """
+    Every request is served by Mistral 7B Instruct whatever model it asks for
+    """
+    return _MODELS.get(name, MISTRAL_7B_INSTRUCT)
@@ -0,0 +1,228 @@
+import json
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+from dataclasses import replace
+from typing import AsyncIterator
+from typing import Dict
+from typing import Optional
+
+from prometheus_client import Counter
+
+import settings
+from router.domain.tokens.tokenizer import tokenizer
+from router.service import error_responses
+from router.service.completion.entities import ChatCompletionRequest
+from router.service.middleware.rate_limiter import rate_limiter
+from router.utils.shared_gcra import RateLimit
+from router.utils.shared_gcra import RateLimitDecision
+
+QUOTA_EXCEEDED = Counter(
+    "llm_proxy_quota_exceeded_total",
+    "Total count of requests rejected by a per-user quota (requests, tokens or "
+    "streams).",
+    ["quota"],
+)
+
+QUOTA_REQUESTS = "requests"
+QUOTA_TOKENS = "tokens"
+QUOTA_STREAMS = "streams"
+
+# Concurrent streams are counted by each worker, so the limit applies per
+# worker process
+_active_streams: Dict[str, int] = defaultdict(int)
+
+
+@dataclass(frozen=True)
+class Quota:
+    # 0 is unlimited
+    requests_per_minute: int
+    tokens_per_minute: int
+    max_concurrent_streams: int
+
+
+DEFAULT_QUOTA = Quota(
+    requests_per_minute=settings.QUOTA_REQUESTS_PER_MINUTE,
+    tokens_per_minute=settings.QUOTA_TOKENS_PER_MINUTE,
+    max_concurrent_streams=settings.QUOTA_MAX_CONCURRENT_STREAMS,
+)
+
+
+def get_quotas_by_user(overrides: Optional[str]) -> Dict[str, Quota]:
+    """
+    overrides - JSON object of uid to the Quota fields that differ from the
+    default quota, eg {"uid": {"tokens_per_minute": 500000}}
+
+    Raises:
+        ValueError: if overrides is not such an object
+    """
+    try:
+        overrides_by_user = json.loads(overrides or "{}")
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"QUOTA_OVERRIDES is not valid JSON: {exc}") from None
+    if not isinstance(overrides_by_user, dict):
+        raise ValueError("QUOTA_OVERRIDES has to be a JSON object of uid to quota")
+    quota_fields = set(Quota.__dataclass_fields__)
+    quotas_by_user = {}
+    for uid, fields in overrides_by_user.items():
+        if not isinstance(fields, dict) or not set(fields) <= quota_fields:
+            raise ValueError(
+                f"QUOTA_OVERRIDES of {uid} has to be an object with some of "
+                f"{', '.join(sorted(quota_fields))}"
+            )
+        if not all(isinstance(value, int) and value >= 0 for value in fields.values()):
+            raise ValueError(
+                f"QUOTA_OVERRIDES of {uid} has to have non-negative integer values"
+            )
+        quotas_by_user[uid] = replace(DEFAULT_QUOTA, **fields)
+    return quotas_by_user
+
+
+_quotas_by_user = get_quotas_by_user(settings.QUOTA_OVERRIDES)
+
+
+class QuotaLease:
+    """
+    Quota taken by one request: its stream slot and the tokens debited up
+    front from an estimate, reconciled with the real usage once known
+    """
+
+    def __init__(
+        self,
+        uid: str,
+        quota: Quota,
+        debited_tokens: int,
+        is_stream: bool,
+        headers: Dict[str, str],
+    ):
+        self.uid = uid
+        self.quota = quota
+        self.debited_tokens = debited_tokens
+        self.is_stream = is_stream
+        self.headers = headers
+        self.is_reconciled = False
+        self.is_closed = False
+
+    def reconcile(self, total_tokens: int) -> None:
+        if self.is_reconciled:
+            return
+        self.is_reconciled = True
+        if not self.quota.tokens_per_minute:
+            return
+        rate_limit = _get_tokens_rate_limit(self.quota)
+        difference = total_tokens - self.debited_tokens
+        if difference < 0:
+            rate_limiter.refund(self.uid, rate_limit, -difference)
+        elif difference > 0:
+            rate_limiter.acquire(self.uid, rate_limit, difference, is_forced=True)
+
+    def close(self) -> None:
+        """
+        Frees the stream slot, the token estimate is given back if the usage
+        was never tracked, eg the upstream call failed
+        """
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.reconcile(0)
+        if self.is_stream and self.quota.max_concurrent_streams:
+            _active_streams[self.uid] -= 1
+            if _active_streams[self.uid] <= 0:
+                del _active_streams[self.uid]
+
+
+def acquire(uid: str, request: ChatCompletionRequest) -> QuotaLease:
+    """
+    Takes a request, the estimated tokens and a stream slot from the quota of
+    the user
+
+    Raises:
+        RateLimitExceededAPIError: if any of them is used up
+    """
+    quota = _quotas_by_user.get(uid, DEFAULT_QUOTA)
+    headers = {}
+    if (
+        request.stream
+        and quota.max_concurrent_streams
+        and _active_streams[uid] >= quota.max_concurrent_streams
+    ):
+        QUOTA_EXCEEDED.labels(quota=QUOTA_STREAMS).inc()
+        raise error_responses.RateLimitExceededAPIError(
+            f"at most {quota.max_concurrent_streams} concurrent streams are allowed",
+            retry_after=1,
+        )
+
+    requests_decision = None
+    if quota.requests_per_minute:
+        rate_limit = _get_requests_rate_limit(quota)
+        requests_decision = rate_limiter.acquire(uid, rate_limit)
+        headers.update(_get_headers(QUOTA_REQUESTS, rate_limit, requests_decision))
+        if not requests_decision.is_allowed:
+            QUOTA_EXCEEDED.labels(quota=QUOTA_REQUESTS).inc()
+            raise error_responses.RateLimitExceededAPIError(
+                f"{quota.requests_per_minute} requests per minute allowed",
+                retry_after=requests_decision.retry_after,
+                headers=headers,
+            )
+
+    debited_tokens = 0
+    if quota.tokens_per_minute:
+        rate_limit = _get_tokens_rate_limit(quota)
+        # A request bigger than the whole quota goes through with a full bucket
+        debited_tokens = min(_estimate_tokens(request), quota.tokens_per_minute)
+        decision = rate_limiter.acquire(uid, rate_limit, debited_tokens)
+        headers.update(_get_headers(QUOTA_TOKENS, rate_limit, decision))
+        if not decision.is_allowed:
+            if requests_decision:
+                rate_limiter.refund(uid, _get_requests_rate_limit(quota), 1)
+            QUOTA_EXCEEDED.labels(quota=QUOTA_TOKENS).inc()
+            raise error_responses.RateLimitExceededAPIError(
+                f"{quota.tokens_per_minute} tokens per minute allowed",
+                retry_after=decision.retry_after,
+                headers=headers,
+            )
+
+    if request.stream and quota.max_concurrent_streams:
+        _active_streams[uid] += 1
+    return QuotaLease(
+        uid=uid,
+        quota=quota,
+        debited_tokens=debited_tokens,
+        is_stream=bool(request.stream),
+        headers=headers,
+    )
+
+
+async def close_after(chunks: AsyncIterator[bytes], lease: QuotaLease):
+    """Streams chunks and closes the lease once the stream is done"""
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+        lease.close()
+
+
+def _estimate_tokens(request: ChatCompletionRequest) -> int:
+    completion_tokens = request.max_tokens or settings.QUOTA_DEFAULT_COMPLETION_TOKENS
+    return tokenizer.count_messages(request.messages) + completion_tokens
+
+
+def _get_requests_rate_limit(quota: Quota) -> RateLimit:
+    return RateLimit(name=QUOTA_REQUESTS, limit=quota.requests_per_minute, period=60)
+
+
+def _get_tokens_rate_limit(quota: Quota) -> RateLimit:
+    return RateLimit(name=QUOTA_TOKENS, limit=quota.tokens_per_minute, period=60)
+
+
+def _get_headers(
+    name: str, rate_limit: RateLimit, decision: RateLimitDecision
+) -> Dict[str, str]:
+    return {
+        f"X-RateLimit-Limit-{name.capitalize()}": str(int(rate_limit.limit)),
+        f"X-RateLimit-Remaining-{name.capitalize()}": str(
+            math.floor(decision.remaining)
+        ),
+        f"X-RateLimit-Reset-{name.capitalize()}": f"{math.ceil(decision.reset_after)}s",
+    }
@@ -0,0 +1,145 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+
+import settings
+from router.service.completion.utils import get_deterministic_request_key
+
+RESPONSE_CACHE_REQUESTS = Counter(
+    "llm_proxy_response_cache_requests_total",
+    "Total count of response cache lookups by result (hit or miss).",
+    ["result", "is_stream"],
+)
+RESPONSE_CACHE_EVICTIONS = Counter(
+    "llm_proxy_response_cache_evictions_total",
+    "Total count of response cache evictions by reason (expired or capacity).",
+    ["reason"],
+)
+RESPONSE_CACHE_SIZE_BYTES = Gauge(
+    "llm_proxy_response_cache_size_bytes",
+    "Approximate memory held by cached responses.",
+    multiprocess_mode="livesum",
+)
+
+RESULT_HIT = "hit"
+RESULT_MISS = "miss"
+EVICTION_EXPIRED = "expired"
+EVICTION_CAPACITY = "capacity"
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    provider: str
+    # Model name reported by the upstream, used for token tracking
+    model: str
+    usage: Dict
+    # Non-streaming responses keep the encoded JSON body
+    body: Optional[bytes] = None
+    # Streaming responses keep the SSE chunks sent to the client
+    chunks: Optional[List[bytes]] = None
+
+    def get_size(self) -> int:
+        if self.body is not None:
+            return len(self.body)
+        return sum(len(chunk) for chunk in self.chunks or [])
+
+    def get_tracked_response(self) -> Dict:
+        return {"model": self.model, "usage": self.usage}
+
+
+@dataclass(frozen=True)
+class _CacheEntry:
+    response: CachedResponse
+    size: int
+    expires_at: float
+
+
+class ResponseCache:
+    """
+    LRU cache with a TTL, bounded by the number of entries and by the total
+    size of the cached bodies.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        max_bytes: int,
+        max_entry_bytes: int,
+        ttl_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self.size = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= self.clock():
+            self._remove(key, EVICTION_EXPIRED)
+            return None
+        self.entries.move_to_end(key)
+        return entry.response
+
+    def set(self, key: str, response: CachedResponse) -> None:
+        size = response.get_size()
+        if size > self.max_entry_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = _CacheEntry(
+            response=response, size=size, expires_at=self.clock() + self.ttl_seconds
+        )
+        self.size += size
+        while self.entries and (
+            len(self.entries) > self.max_entries or self.size > self.max_bytes
+        ):
+            self._remove(next(iter(self.entries)), EVICTION_CAPACITY)
+        RESPONSE_CACHE_SIZE_BYTES.set(self.size)
+
+    def _remove(self, key: str, eviction_reason: Optional[str] = None) -> None:
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        if eviction_reason:
+            RESPONSE_CACHE_EVICTIONS.labels(reason=eviction_reason).inc()
+        RESPONSE_CACHE_SIZE_BYTES.set(self.size)
+
+
+def get_cache_key(formatted_dict: Dict) -> Optional[str]:
+    """
+    Returns:
+        None if the request is not deterministic and can't be cached
+    """
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None
+    return get_deterministic_request_key(formatted_dict)
+
+
+def get(key: Optional[str], is_stream: bool) -> Optional[CachedResponse]:
+    if key is None:
+        return None
+    response = response_cache.get(key)
+    RESPONSE_CACHE_REQUESTS.labels(
+        result=RESULT_HIT if response else RESULT_MISS, is_stream=is_stream
+    ).inc()
+    return response
+
+
+response_cache = ResponseCache(
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=settings.RESPONSE_CACHE_MAX_BYTES,
+    max_entry_bytes=settings.RESPONSE_CACHE_MAX_ENTRY_BYTES,
+    ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+)
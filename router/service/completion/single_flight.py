@@ -0,0 +1,68 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Tuple
+
+from prometheus_client import Counter
+
+COALESCED_REQUESTS = Counter(
+    "llm_proxy_coalesced_requests_total",
+    "Total count of requests that went through single-flight coalescing, by "
+    "whether they made the upstream call (leader) or shared it (follower).",
+    ["role"],
+)
+
+ROLE_LEADER = "leader"
+ROLE_FOLLOWER = "follower"
+
+
+@dataclass
+class _Call:
+    task: asyncio.Future
+    waiters: int = 0
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one execution. The shared call
+    keeps running when a waiter is cancelled and is only cancelled once no
+    waiter is left.
+    """
+
+    def __init__(self):
+        self.calls: Dict[str, _Call] = {}
+
+    async def do(
+        self, key: str, fn: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """
+        Returns:
+            result of fn and True if this caller started the call (leader)
+        """
+        call = self.calls.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = _Call(task=asyncio.ensure_future(fn()))
+            self.calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        COALESCED_REQUESTS.labels(
+            role=ROLE_LEADER if is_leader else ROLE_FOLLOWER
+        ).inc()
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), is_leader
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call) -> None:
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+
+single_flight = SingleFlight()
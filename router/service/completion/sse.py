@@ -0,0 +1,91 @@
+import json
+from dataclasses import dataclass
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from router.service.completion import json_bytes
+
+DATA_PREFIX = b"data: "
+DONE_PAYLOAD = b"[DONE]"
+
+_MODEL_KEY = b'"model"'
+_CONTENT_KEY = b'"content"'
+_DELTA_KEY = b'"delta"'
+_USAGE_KEY = b'"usage"'
+
+
+@dataclass(slots=True)
+class SseLine:
+    # Line to send to the client, model already rewritten
+    data: bytes
+    # Delta content of a completion chunk, None if the chunk has no token
+    content: Optional[str] = None
+    usage: Optional[Dict] = None
+
+
+class SseFramer:
+    """
+    Splits upstream bytes into SSE lines and rewrites the "model" value of
+    every data line in place. Content and usage are read by looking up their
+    keys in the line, without parsing the whole JSON chunk.
+
+    Lines keep their line endings, so the SSE framing of the upstream is
+    passed on to the client unchanged.
+    """
+
+    def __init__(self, model: str):
+        self.model = json.dumps(model).encode()
+        # Model reported by the upstream in the first chunk, for tracing
+        self.upstream_model: Optional[str] = None
+        self.buffer = b""
+
+    def feed(self, data: bytes) -> List[SseLine]:
+        if self.buffer:
+            data = self.buffer + data
+        lines = []
+        start = 0
+        end = data.find(b"\n")
+        while end != -1:
+            lines.append(self._frame(data[start:end + 1]))
+            start = end + 1
+            end = data.find(b"\n", start)
+        self.buffer = data[start:]
+        return lines
+
+    def flush(self) -> List[SseLine]:
+        """Frames the last line if the upstream did not terminate it."""
+        if not self.buffer:
+            return []
+        line = self._frame(self.buffer)
+        self.buffer = b""
+        return [line]
+
+    def _frame(self, line: bytes) -> SseLine:
+        if not line.startswith(DATA_PREFIX):
+            # Blank separator, comment or other field
+            return SseLine(data=line)
+        if line[len(DATA_PREFIX):].strip() == DONE_PAYLOAD:
+            return SseLine(data=line)
+
+        line, upstream_model = json_bytes.replace_value(line, _MODEL_KEY, self.model)
+        if self.upstream_model is None and upstream_model is not None:
+            self.upstream_model = json_bytes.decode_string(upstream_model)
+        return SseLine(
+            data=line,
+            content=_get_content(line),
+            usage=json_bytes.get_object(line, _USAGE_KEY),
+        )
+
+
+def _get_content(line: bytes) -> Optional[str]:
+    # Looked up in the delta only, perplexity chunks also have the cumulative
+    # message content and it can come first
+    delta = json_bytes.find_value(line, _DELTA_KEY)
+    if not delta or line[delta[0]] != 0x7B:  # not an object, ie. null
+        return None
+    delta = line[delta[0]:delta[1]]
+    value = json_bytes.find_value(delta, _CONTENT_KEY)
+    if not value or delta[value[0]] != 0x22:  # not a string, ie. null
+        return None
+    return json_bytes.decode_string(delta[value[0]:value[1]])
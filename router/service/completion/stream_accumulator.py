@@ -0,0 +1,105 @@
+import io
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from prometheus_client import Counter
+
+import settings
+from router.domain.tokens.tokenizer import Tokenizer
+from router.domain.tokens.tokenizer import tokenizer as default_tokenizer
+from router.service.completion.sse import SseLine
+
+STREAM_CONTENT_OVER_CAP = Counter(
+    "llm_proxy_stream_content_over_cap_total",
+    "Total count of streams whose content went over the accumulator cap, the "
+    "content past it is not traced.",
+)
+
+# Completion tokens are counted every this many characters of content
+COUNT_BATCH_CHARS = 4096
+
+
+class StreamAccumulator:
+    """
+    Keeps what is needed of a completion stream once it has been sent: the
+    running content, the model of the first chunk, the usage frame and the
+    completion token count. Content is held in memory up to max_content_chars,
+    the rest is dropped and only counted.
+
+    Completion tokens are counted with the tokenizer on batches of content as
+    it arrives, so the count does not depend on the content cap. Without a
+    tokenizer vocab every content chunk counts as one token.
+    """
+
+    def __init__(
+        self,
+        max_content_chars: int = settings.STREAM_ACCUMULATOR_MAX_CONTENT_CHARS,
+        tokenizer: Tokenizer = default_tokenizer,
+    ):
+        self.max_content_chars = max_content_chars
+        self.tokenizer = tokenizer
+        # Model reported by the upstream in the first chunk
+        self.model: Optional[str] = None
+        self.usage: Optional[Dict] = None
+        self.content_chunks = 0
+        self.counted_tokens = 0
+        # Content not counted yet
+        self.uncounted: List[str] = []
+        self.uncounted_chars = 0
+        self.content_chars = 0
+        self.dropped_chars = 0
+        self.content = io.StringIO()
+
+    def add(self, line: SseLine) -> None:
+        if line.usage:
+            self.usage = line.usage
+        if line.content is None:
+            return
+        self.content_chunks += 1
+        self._add_content(line.content)
+        if self.tokenizer.is_loaded():
+            self.uncounted.append(line.content)
+            self.uncounted_chars += len(line.content)
+            if self.uncounted_chars >= COUNT_BATCH_CHARS:
+                self._count_uncounted(is_final=False)
+
+    def get_completion_tokens(self) -> int:
+        if not self.tokenizer.is_loaded():
+            return self.content_chunks
+        self._count_uncounted(is_final=True)
+        return self.counted_tokens
+
+    def get_content(self) -> str:
+        """
+        Returns:
+            the content up to max_content_chars
+        """
+        return self.content.getvalue()
+
+    def is_over_cap(self) -> bool:
+        return self.dropped_chars > 0
+
+    def _count_uncounted(self, is_final: bool) -> None:
+        text = "".join(self.uncounted)
+        self.uncounted = []
+        if not is_final:
+            # Tokens start with their leading space, split the text before one
+            split = text.rfind(" ")
+            if split > 0:
+                self.uncounted = [text[split:]]
+                text = text[:split]
+        self.uncounted_chars = len(self.uncounted[0]) if self.uncounted else 0
+        if text:
+            self.counted_tokens += self.tokenizer.count(text)
+
+    def _add_content(self, content: str) -> None:
+        was_over_cap = self.is_over_cap()
+        free_chars = max(self.max_content_chars - self.content_chars, 0)
+        if free_chars:
+            self.content.write(content[:free_chars])
+        over_cap = content[free_chars:]
+        self.content_chars += len(content) - len(over_cap)
+        self.dropped_chars += len(over_cap)
+        if not was_over_cap and self.is_over_cap():
+            STREAM_CONTENT_OVER_CAP.inc()
@@ -0,0 +1,247 @@
+import asyncio
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Any
+from typing import AsyncGenerator
+from typing import AsyncIterable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from prometheus_client import Counter
+
+import settings
+from router import api_logger
+from router.service.completion.utils import get_deterministic_request_key
+
+STREAM_BROADCAST_SUBSCRIBERS = Counter(
+    "llm_proxy_stream_broadcast_subscribers_total",
+    "Total count of streams served through the broadcast layer, by whether "
+    "they opened the upstream stream (owner) or joined one (subscriber).",
+    ["role"],
+)
+STREAM_BROADCAST_DROPPED_SUBSCRIBERS = Counter(
+    "llm_proxy_stream_broadcast_dropped_subscribers_total",
+    "Total count of subscribers dropped for falling too far behind the upstream stream.",
+)
+
+ROLE_OWNER = "owner"
+ROLE_SUBSCRIBER = "subscriber"
+
+logger = api_logger.get()
+
+
+class SubscriberLagError(Exception):
+    """Raised to a subscriber that fell too far behind the shared stream."""
+
+
+@dataclass(eq=False)
+class _Subscriber:
+    # Absolute index of the next item to read
+    position: int = 0
+    is_dropped: bool = False
+
+
+class BroadcastStream:
+    """
+    Reads the source in its own task and buffers the items, every subscriber
+    reads the buffer at its own pace from the first item.
+
+    Memory is bounded by max_buffer_bytes: once the buffer is bigger than
+    that no one can join anymore and items read by every subscriber are
+    released. The source is read no further ahead of the fastest subscriber
+    than max_buffer_bytes, a slower subscriber lagging more than that behind
+    is dropped instead of holding the others back.
+    """
+
+    def __init__(
+        self,
+        source: AsyncGenerator,
+        get_size: Callable[[Any], int],
+        max_buffer_bytes: int,
+        on_done: Callable[[], None] = None,
+    ):
+        self.source = source
+        self.get_size = get_size
+        self.max_buffer_bytes = max_buffer_bytes
+        self.on_done = on_done
+
+        self.items: List[Any] = []
+        # Cumulative bytes at the end of each buffered item
+        self.item_ends: List[int] = []
+        # Absolute index of self.items[0]
+        self.base_index = 0
+        self.size = 0
+        self.released_size = 0
+        self.is_joinable = True
+        self.is_done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers: Set[_Subscriber] = set()
+        self._changed = asyncio.Event()
+        # Set when a subscriber reads or leaves, for the backpressured pump
+        self._advanced = asyncio.Event()
+        self._task = asyncio.ensure_future(self._pump())
+
+    def subscribe(self) -> AsyncIterable:
+        """
+        The subscriber counts from now on, not from when it starts reading,
+        so nothing it has not read is released.
+        """
+        subscriber = _Subscriber()
+        self.subscribers.add(subscriber)
+        return self._iterate(subscriber)
+
+    async def _iterate(self, subscriber: _Subscriber) -> AsyncIterable:
+        try:
+            while True:
+                if subscriber.is_dropped:
+                    raise SubscriberLagError()
+                index = subscriber.position - self.base_index
+                if index < len(self.items):
+                    item = self.items[index]
+                    subscriber.position += 1
+                    self._on_read()
+                    yield item
+                    continue
+                if self.is_done:
+                    if self.error:
+                        raise self.error
+                    return
+                changed = self._changed
+                await changed.wait()
+        finally:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers and not self.is_done:
+                # No one is listening anymore
+                self._task.cancel()
+            else:
+                self._on_read()
+
+    async def _pump(self) -> None:
+        try:
+            # Closed even when cancelled while held back, not at loop shutdown
+            async with aclosing(self.source) as source:
+                async for item in source:
+                    self._append(item)
+                    while self._get_lag(self._get_leader()) > self.max_buffer_bytes:
+                        advanced = self._advanced
+                        await advanced.wait()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.is_done = True
+            self.is_joinable = False
+            self._notify()
+            if self.on_done:
+                self.on_done()
+
+    def _append(self, item: Any) -> None:
+        self.size += self.get_size(item)
+        self.items.append(item)
+        self.item_ends.append(self.size)
+        if self.size - self.released_size > self.max_buffer_bytes:
+            self.is_joinable = False
+            self._drop_lagging_subscribers()
+            self._release()
+        self._notify()
+
+    def _drop_lagging_subscribers(self) -> None:
+        # The fastest subscribers hold the source back instead
+        leader = self._get_leader()
+        for subscriber in self.subscribers:
+            if subscriber.is_dropped or subscriber.position >= leader.position:
+                continue
+            if self._get_lag(subscriber) > self.max_buffer_bytes:
+                subscriber.is_dropped = True
+                STREAM_BROADCAST_DROPPED_SUBSCRIBERS.inc()
+                logger.info("Dropped lagging stream broadcast subscriber")
+
+    def _get_leader(self) -> Optional[_Subscriber]:
+        active = [s for s in self.subscribers if not s.is_dropped]
+        return max(active, key=lambda s: s.position, default=None)
+
+    def _get_lag(self, subscriber: Optional[_Subscriber]) -> int:
+        """Bytes buffered that the subscriber has not read yet"""
+        if subscriber is None:
+            return 0
+        index = subscriber.position - self.base_index
+        read_size = self.item_ends[index - 1] if index > 0 else self.released_size
+        return self.size - read_size
+
+    def _on_read(self) -> None:
+        self._release()
+        self._advanced.set()
+        self._advanced = asyncio.Event()
+
+    def _release(self) -> None:
+        """Frees the items every subscriber has read, once no one can join."""
+        if self.is_joinable:
+            return
+        active = [s.position for s in self.subscribers if not s.is_dropped]
+        read_count = (min(active) if active else self.base_index + len(self.items))
+        read_count -= self.base_index
+        if read_count <= 0:
+            return
+        self.released_size = self.item_ends[read_count - 1]
+        del self.items[:read_count]
+        del self.item_ends[:read_count]
+        self.base_index += read_count
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+class StreamBroadcaster:
+    def __init__(self, get_size: Callable[[Any], int], max_buffer_bytes: int):
+        self.get_size = get_size
+        self.max_buffer_bytes = max_buffer_bytes
+        self.streams: Dict[str, BroadcastStream] = {}
+
+    def subscribe(
+        self, key: str, source_factory: Callable[[], AsyncGenerator]
+    ) -> Tuple[AsyncIterable, bool]:
+        """
+        Returns:
+            items of the stream for the key, and True if this caller opened it
+        """
+        stream = self.streams.get(key)
+        is_owner = stream is None or not stream.is_joinable
+        if is_owner:
+            stream = BroadcastStream(
+                source_factory(),
+                get_size=self.get_size,
+                max_buffer_bytes=self.max_buffer_bytes,
+            )
+            stream.on_done = lambda: self._forget(key, stream)
+            self.streams[key] = stream
+        STREAM_BROADCAST_SUBSCRIBERS.labels(
+            role=ROLE_OWNER if is_owner else ROLE_SUBSCRIBER
+        ).inc()
+        return stream.subscribe(), is_owner
+
+    def _forget(self, key: str, stream: BroadcastStream) -> None:
+        if self.streams.get(key) is stream:
+            del self.streams[key]
+
+
+def get_broadcast_key(formatted_dict: Dict) -> Optional[str]:
+    """
+    Returns:
+        None if the request is not deterministic and can't share a stream
+    """
+    if not settings.STREAM_BROADCAST_ENABLED:
+        return None
+    return get_deterministic_request_key(formatted_dict)
+
+
+# Items are (StreamResult, chunk) pairs of the completion stream service
+stream_broadcaster = StreamBroadcaster(
+    get_size=lambda item: len(item[1]),
+    max_buffer_bytes=settings.STREAM_BROADCAST_MAX_BUFFER_BYTES,
+)
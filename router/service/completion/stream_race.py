@@ -0,0 +1,31 @@
+from prometheus_client import Counter
+
+import settings
+from router.service.completion.hedging import HedgeBudget
+
+STREAM_RACES = Counter(
+    "llm_proxy_stream_races_total",
+    "Total count of streams opened on two endpoints, by the endpoint that "
+    "emitted the first token.",
+    ["winner_endpoint"],
+)
+STREAM_RACES_SKIPPED = Counter(
+    "llm_proxy_stream_races_skipped_total",
+    "Total count of streams that asked for a race but were not raced, by reason.",
+    ["reason"],
+)
+
+WINNER_NONE = "none"
+
+# Races open a second upstream stream, cap them like hedges
+stream_race_budget = HedgeBudget(max_rate=settings.STREAM_RACE_MAX_RATE)
+
+
+def is_race_requested(user_uid: str, race_header: str = None) -> bool:
+    """
+    Racing is enabled per user (settings.STREAM_RACE_USER_IDS) or per request
+    with the "X-Stream-Race: true" header.
+    """
+    if race_header is not None and race_header.lower() == "true":
+        return True
+    return user_uid in settings.STREAM_RACE_USER_IDS
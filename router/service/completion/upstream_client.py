@@ -0,0 +1,197 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import aiohttp
+import orjson
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
+import settings
+from router import api_logger
+from router.service.completion.utils import ChatCompletionEndpoint
+from router.singleton import Singleton
+
+UPSTREAM_POOL_CONNECTIONS_IN_USE = Gauge(
+    "llm_proxy_upstream_pool_connections_in_use",
+    "Upstream connections currently acquired by requests, by endpoint.",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_POOL_CONNECTIONS_IDLE = Gauge(
+    "llm_proxy_upstream_pool_connections_idle",
+    "Upstream keep-alive connections waiting in the pool, by endpoint.",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_POOL_WAIT_TIME = Histogram(
+    "llm_proxy_upstream_pool_wait_time_seconds",
+    "Histogram of time requests waited for a free upstream connection (in seconds)",
+    ["endpoint"],
+)
+UPSTREAM_POOL_CONNECTIONS = Counter(
+    "llm_proxy_upstream_pool_connections_total",
+    "Total count of upstream connections handed out by endpoint and whether "
+    "a pooled connection was reused.",
+    ["endpoint", "reused"],
+)
+
+logger = api_logger.get()
+
+
+class UpstreamError(Exception):
+    """Raised when an upstream endpoint responds with a server error."""
+
+    def __init__(self, endpoint_name: str, status: int):
+        super().__init__(f"endpoint={endpoint_name} status={status}")
+        self.endpoint_name = endpoint_name
+        self.status = status
+
+
+# Errors after which the request can be retried on another endpoint
+UPSTREAM_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, UpstreamError)
+
+
+@Singleton
+class UpstreamClient:
+    """
+    Owns one keep-alive aiohttp.ClientSession (and connection pool) per
+    ChatCompletionEndpoint. Started and closed by the app lifespan, sessions
+    are created lazily if used before start().
+    """
+
+    def __init__(self):
+        self.sessions: Dict[str, aiohttp.ClientSession] = {}
+
+    async def start(self, endpoints: List[ChatCompletionEndpoint]) -> None:
+        for endpoint in endpoints:
+            self.get_session(endpoint)
+        await asyncio.gather(*[self._prewarm(endpoint) for endpoint in endpoints])
+
+    def get_session(self, endpoint: ChatCompletionEndpoint) -> aiohttp.ClientSession:
+        session = self.sessions.get(endpoint.name)
+        if session is None or session.closed:
+            session = _create_session(endpoint)
+            self.sessions[endpoint.name] = session
+        _observe_pool(endpoint.name, session.connector)
+        return session
+
+    async def close(self) -> None:
+        sessions = list(self.sessions.values())
+        self.sessions = {}
+        for session in sessions:
+            await session.close()
+
+    async def _prewarm(self, endpoint: ChatCompletionEndpoint) -> None:
+        """
+        Opens settings.UPSTREAM_PREWARM_CONNECTIONS connections to the endpoint
+        so the first completions of the worker don't pay DNS, TCP and TLS setup.
+        """
+        if settings.UPSTREAM_PREWARM_CONNECTIONS <= 0:
+            return
+        session = self.get_session(endpoint)
+        timeout = aiohttp.ClientTimeout(total=settings.UPSTREAM_PREWARM_TIMEOUT)
+
+        async def _open_connection():
+            async with session.head(endpoint.url, timeout=timeout) as res:
+                await res.read()
+
+        results = await asyncio.gather(
+            *[_open_connection() for _ in range(settings.UPSTREAM_PREWARM_CONNECTIONS)],
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            logger.info(
+                f"Upstream pre-warm failed for {len(errors)} connection(s) "
+                f"endpoint={endpoint.name} error={errors[0]!r}"
+            )
+        _observe_pool(endpoint.name, session.connector)
+
+
+def post_json(
+    session: aiohttp.ClientSession, endpoint: ChatCompletionEndpoint, body: Dict
+):
+    """
+    Posts the body to the endpoint encoded with orjson instead of the stdlib
+    encoder aiohttp uses for json=.
+    """
+    return session.post(
+        endpoint.url,
+        headers={**(endpoint.headers or {}), "Content-Type": "application/json"},
+        data=orjson.dumps(body),
+    )
+
+
+def _create_session(endpoint: ChatCompletionEndpoint) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=settings.UPSTREAM_POOL_LIMIT,
+        limit_per_host=settings.UPSTREAM_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=settings.UPSTREAM_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=settings.UPSTREAM_DNS_CACHE_TTL,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(
+            total=settings.UPSTREAM_TOTAL_TIMEOUT,
+            sock_connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+        ),
+        trace_configs=[_get_trace_config(endpoint.name, connector)],
+    )
+
+
+def _get_trace_config(
+    endpoint_name: str, connector: aiohttp.TCPConnector
+) -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig(
+        trace_config_ctx_factory=lambda trace_request_ctx: SimpleNamespace(
+            queued_at=None
+        )
+    )
+
+    async def on_connection_queued_start(session, ctx, params):
+        ctx.queued_at = asyncio.get_running_loop().time()
+
+    async def on_connection_queued_end(session, ctx, params):
+        if ctx.queued_at is not None:
+            UPSTREAM_POOL_WAIT_TIME.labels(endpoint=endpoint_name).observe(
+                asyncio.get_running_loop().time() - ctx.queued_at
+            )
+
+    async def on_connection_create_end(session, ctx, params):
+        UPSTREAM_POOL_CONNECTIONS.labels(endpoint=endpoint_name, reused=False).inc()
+        _observe_pool(endpoint_name, connector)
+
+    async def on_connection_reuseconn(session, ctx, params):
+        UPSTREAM_POOL_CONNECTIONS.labels(endpoint=endpoint_name, reused=True).inc()
+        _observe_pool(endpoint_name, connector)
+
+    async def on_request_end(session, ctx, params):
+        _observe_pool(endpoint_name, connector)
+
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(on_connection_queued_end)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def _observe_pool(endpoint_name: str, connector: aiohttp.BaseConnector) -> None:
+    in_use, idle = _get_pool_stats(connector)
+    UPSTREAM_POOL_CONNECTIONS_IN_USE.labels(endpoint=endpoint_name).set(in_use)
+    UPSTREAM_POOL_CONNECTIONS_IDLE.labels(endpoint=endpoint_name).set(idle)
+
+
+def _get_pool_stats(connector: aiohttp.BaseConnector) -> Tuple[int, int]:
+    # aiohttp does not expose pool stats publicly
+    try:
+        in_use = len(connector._acquired)
+        idle = sum(len(conns) for conns in connector._conns.values())
+        return in_use, idle
+    except Exception:
+        return 0, 0
@@ -1,6 +1,12 @@
+import hashlib
+import json
 import os
-import random
 from dataclasses import dataclass
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from router.service.completion.entities import ChatCompletionRequest
 from settings import LLM_BASE_URL, PROVIDER_RATIO
 
 
@@ -11,13 +17,67 @@ class ChatCompletionEndpoint:
     headers: dict = None
 
 
-def get_chat_completion_endpoint() -> ChatCompletionEndpoint:
-    if random.random() < PROVIDER_RATIO:
-        return ChatCompletionEndpoint(
-            name="perplexity",
-            url="https://api.perplexity.ai/chat/completions",
-            headers={"Authorization": f'Bearer {os.getenv("PERPLEXITY_API_KEY")}'},
-        )
-    return ChatCompletionEndpoint(
-        name="llmOS_vllm", url=f"{LLM_BASE_URL}chat/completions"
+PERPLEXITY_ENDPOINT = ChatCompletionEndpoint(
+    name="perplexity",
+    url="https://api.perplexity.ai/chat/completions",
+    headers={"Authorization": f'Bearer {os.getenv("PERPLEXITY_API_KEY")}'},
+)
+LLMOS_VLLM_ENDPOINT = ChatCompletionEndpoint(
+    name="llmOS_vllm", url=f"{LLM_BASE_URL}chat/completions"
+)
+
+
+def get_chat_completion_endpoints() -> List[ChatCompletionEndpoint]:
+    return [PERPLEXITY_ENDPOINT, LLMOS_VLLM_ENDPOINT]
+
+
+def get_provider_weights() -> Dict[str, float]:
+    """
+    PROVIDER_RATIO is the static share of traffic for perplexity, the load
+    balancer policy decides on top of it.
+    """
+    ratio = min(max(PROVIDER_RATIO, 0.0), 1.0)
+    return {
+        PERPLEXITY_ENDPOINT.name: ratio,
+        LLMOS_VLLM_ENDPOINT.name: 1.0 - ratio,
+    }
+
+
+def format_request(request: ChatCompletionRequest) -> Dict:
+    """
+    Returns:
+        the request body sent upstream
+    """
+    # Clean up etc
+    request.model = "mistral-7b-instruct"
+    request_input = request.model_dump()
+
+    for m in request_input["messages"]:
+        if not m.get("function_call"):
+            m.pop("name", None)
+            m.pop("function_call", None)
+
+    # OpenAI API is annoying
+    formatted_dict = {}
+    for key, value in request_input.items():
+        if value:
+            formatted_dict[key] = value
+    # Dropped, the upstream would sample at its own default temperature
+    if request_input.get("temperature") == 0:
+        formatted_dict["temperature"] = 0
+    return formatted_dict
+
+
+def get_deterministic_request_key(formatted_dict: Dict) -> Optional[str]:
+    """
+    Returns:
+        hash of the canonical request body, None unless the request asks
+        for temperature 0, identical sampled requests can get different answers
+    """
+    # A missing temperature is the upstream default, which samples
+    if formatted_dict.get("temperature") != 0:
+        return None
+    canonical = json.dumps(
+        formatted_dict, sort_keys=True, separators=(",", ":"), ensure_ascii=False
     )
+    return hashlib.sha256(canonical.encode()).hexdigest()
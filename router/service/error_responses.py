@@ -1,3 +1,7 @@
+import math
+from typing import Dict
+from typing import Optional
+
 from starlette import status
 
 
@@ -16,6 +20,9 @@ class APIErrorResponse(Exception):
     def to_message(self) -> str:
         raise NotImplementedError
 
+    def to_headers(self) -> Dict[str, str]:
+        return {}
+
 
 InternalServerErrorCode = "internal_server_error"
 InternalServerErrorMessage = (
@@ -88,6 +95,27 @@ class BadGatewayAPIError(APIErrorResponse):
         )
 
 
+class ServiceUnavailableAPIError(APIErrorResponse):
+    """Raised when no upstream server is currently accepting requests"""
+
+    def __init__(self, retry_after: Optional[float] = None):
+        self.retry_after = retry_after
+
+    def to_status_code(self) -> status:
+        return status.HTTP_503_SERVICE_UNAVAILABLE
+
+    def to_code(self) -> str:
+        return "service_unavailable"
+
+    def to_message(self) -> str:
+        return "All LLM providers are currently unavailable, please retry later."
+
+    def to_headers(self) -> Dict[str, str]:
+        if self.retry_after is None:
+            return {}
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
 class AuthorizationMissingAPIError(APIErrorResponse):
     def __init__(self):
         pass
@@ -120,8 +148,15 @@ class InvalidCredentialsAPIError(APIErrorResponse):
 
 
 class RateLimitExceededAPIError(APIErrorResponse):
-    def __init__(self, message_extra: str):
+    def __init__(
+        self,
+        message_extra: str,
+        retry_after: Optional[float] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ):
         self.message_extra = message_extra
+        self.retry_after = retry_after
+        self.headers = headers or {}
 
     def to_status_code(self) -> status:
         return status.HTTP_429_TOO_MANY_REQUESTS
@@ -134,3 +169,35 @@ class RateLimitExceededAPIError(APIErrorResponse):
         if self.message_extra:
             result += f" - {self.message_extra}"
         return result
+
+    def to_headers(self) -> Dict[str, str]:
+        headers = dict(self.headers)
+        if self.retry_after is not None:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class ContextLengthExceededAPIError(APIErrorResponse):
+    """Raised when the prompt and max_tokens don't fit in the model context"""
+
+    def __init__(self, context_window: int, prompt_tokens: int, max_tokens: int):
+        self.context_window = context_window
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+
+    def to_status_code(self) -> status:
+        return status.HTTP_400_BAD_REQUEST
+
+    def to_code(self) -> str:
+        return "context_length_exceeded"
+
+    def to_message(self) -> str:
+        return (
+            f"This model's maximum context length is {self.context_window} "
+            f"tokens. However, you requested "
+            f"{self.prompt_tokens + self.max_tokens} tokens "
+            f"({self.prompt_tokens} in the messages, {self.max_tokens} in the "
+            f"completion). Please reduce the length of the messages or "
+            f"completion, or send 'X-Context-Overflow: trim' to drop the oldest "
+            f"messages."
+        )
@@ -23,6 +23,7 @@ async def custom_exception_handler(request: Request, error: Exception):
     return await http_headers.add_response_headers(
         JSONResponse(
             status_code=error.to_status_code(),
+            headers=error.to_headers(),
             content=jsonable_encoder(
                 {
                     "response": "NOK",
@@ -6,23 +6,17 @@ from starlette.types import ASGIApp
 
 import settings
 from router import api_logger
-from router.repository.demo_user_repository import DemoUserRepositoryFirebase
 from router.service.error_responses import APIErrorResponse
 from router.service.error_responses import RateLimitExceededAPIError
 from router.service.middleware import util
 from router.service.middleware.entitites import RequestStateKey
-from router.service.middleware.rate_limiter import RateLimiter
+from router.service.middleware.rate_limiter import DEMO_RATE_LIMIT
+from router.service.middleware.rate_limiter import rate_limiter
 from router.utils.http_headers import add_response_headers
 import time
 
 logger = api_logger.get()
 
-usage_repository = DemoUserRepositoryFirebase.instance()
-rate_limiter = RateLimiter(
-    max_calls_per_hour=settings.DEMO_API_KEY_ALLOWED_USAGE,
-    usage_repository=usage_repository,
-)
-
 
 class MainMiddleware(BaseHTTPMiddleware):
     def __init__(self, app: ASGIApp) -> None:
@@ -37,9 +31,9 @@ class MainMiddleware(BaseHTTPMiddleware):
 
         api_key = request.headers.get("authorization")
         formatted_ip = ip_address or request.client.host or "default"
-        logger.info(f"REQUEST RATE LIMITTING INFO: " f" {str(rate_limiter.calls)}")
         if api_key == settings.DEMO_API_KEY:
-            if rate_limiter.is_rate_limited(formatted_ip):
+            decision = rate_limiter.acquire(formatted_ip, DEMO_RATE_LIMIT)
+            if not decision.is_allowed:
                 """logger.error(
                     f"Error while handling request. request_id={request_id} "
                     f"request_path={request.url.path}"
@@ -49,7 +43,9 @@ class MainMiddleware(BaseHTTPMiddleware):
                     exc_info=is_exc_info
                 )"""
                 raise RateLimitExceededAPIError(
-                    "demo-api-key supports only 5 reqs per hour"
+                    f"demo-api-key supports only "
+                    f"{settings.DEMO_API_KEY_ALLOWED_USAGE} reqs per hour",
+                    retry_after=decision.retry_after,
                 )
         try:
             logger.info(
@@ -1,27 +1,48 @@
-import time
-from collections import defaultdict
+from prometheus_client import Counter
 
-from router.repository.demo_user_repository import DemoUserRepositoryFirebase
+import settings
+from router.utils.shared_gcra import RateLimit
+from router.utils.shared_gcra import RateLimitDecision
+from router.utils.shared_gcra import SharedGcra
+
+RATE_LIMIT_DECISIONS = Counter(
+    "llm_proxy_rate_limit_decisions_total",
+    "Total count of rate limit checks by limit and result (allowed or limited).",
+    ["limit", "result"],
+)
+
+RESULT_ALLOWED = "allowed"
+RESULT_LIMITED = "limited"
 
 
 class RateLimiter:
-    def __init__(
-        self, max_calls_per_hour, usage_repository: DemoUserRepositoryFirebase
-    ):
-        self.calls = defaultdict(list)
-        self.max_calls_per_hour = max_calls_per_hour
-        self.usage_repository = usage_repository
-
-    def is_rate_limited(self, formatted_ip: str):
-        count = self.usage_repository.get_last_hour_usage_count(ip_address=formatted_ip)
-        if count < self.max_calls_per_hour:
-            self.usage_repository.track_usage(formatted_ip)
-            return False
-        return True
-
-    def is_rate_limited_old(self, s):
-        now = time.time()
-        one_hour_ago = now - 3600
-        self.calls[s] = [t for t in self.calls[s] if t > one_hour_ago]
-        self.calls[s].append(now)
-        return len(self.calls[s]) > self.max_calls_per_hour
+    """
+    Rate limits shared by every worker on the host, see SharedGcra
+    """
+
+    def __init__(self, gcra: SharedGcra):
+        self.gcra = gcra
+
+    def acquire(
+        self, key: str, rate_limit: RateLimit, cost: float = 1, is_forced: bool = False
+    ) -> RateLimitDecision:
+        decision = self.gcra.acquire(key, rate_limit, cost, is_forced=is_forced)
+        RATE_LIMIT_DECISIONS.labels(
+            limit=rate_limit.name,
+            result=RESULT_ALLOWED if decision.is_allowed else RESULT_LIMITED,
+        ).inc()
+        return decision
+
+    def refund(self, key: str, rate_limit: RateLimit, cost: float) -> None:
+        self.gcra.refund(key, rate_limit, cost)
+
+
+DEMO_RATE_LIMIT = RateLimit(
+    name="demo",
+    limit=settings.DEMO_API_KEY_ALLOWED_USAGE,
+    period=3600,
+)
+
+rate_limiter = RateLimiter(
+    SharedGcra(path=settings.RATE_LIMITER_PATH, slots=settings.RATE_LIMITER_SLOTS)
+)
@@ -0,0 +1,163 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import replace
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from prometheus_client import Counter
+
+import settings
+from router import api_logger
+from router.repository.google_compute_repository import GoogleComputeRepository
+from router.repository.google_compute_repository import InstanceGroupStatus
+from router.repository.token_usage_repository import TokenUsageRepositoryFirestore
+from router.service.completion import model_registry
+
+APP_METRICS_REFRESH_FAILURES = Counter(
+    "llm_proxy_app_metrics_refresh_failures_total",
+    "Total count of failed /metrics-app refreshes by source (usage or autoscaler).",
+    ["source"],
+)
+
+SOURCE_USAGE = "usage"
+SOURCE_AUTOSCALER = "autoscaler"
+
+logger = api_logger.get()
+
+
+@dataclass(frozen=True)
+class AppMetricsSnapshot:
+    # Token usage rollup per model
+    model_usages: List[Dict] = field(default_factory=list)
+    compute_status: Optional[InstanceGroupStatus] = None
+    # Unix time of the last successful refresh of each source
+    refreshed_at: Dict[str, float] = field(default_factory=dict)
+    # Seconds the last refresh took
+    refresh_duration: Optional[float] = None
+
+
+class AppMetricsRefresher:
+    """
+    Collects the /metrics-app values every interval seconds in a background
+    task, the endpoint serves the latest snapshot. A source that fails to
+    refresh keeps its previous values, their age shows how stale they are.
+    """
+
+    def __init__(
+        self,
+        get_model_usages: Callable[[], List[Dict]],
+        get_compute_status: Callable[[], InstanceGroupStatus],
+        interval: float,
+    ):
+        self.get_model_usages = get_model_usages
+        self.get_compute_status = get_compute_status
+        self.interval = interval
+        self.snapshot = AppMetricsSnapshot()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def refresh(self) -> None:
+        started_at = time.perf_counter()
+        snapshot = self.snapshot
+        refreshed_at = dict(snapshot.refreshed_at)
+        try:
+            model_usages = await asyncio.to_thread(self.get_model_usages)
+            snapshot = replace(snapshot, model_usages=model_usages)
+            refreshed_at[SOURCE_USAGE] = time.time()
+        except Exception:
+            APP_METRICS_REFRESH_FAILURES.labels(source=SOURCE_USAGE).inc()
+            logger.error("Failed to fetch token usage stats", exc_info=True)
+        try:
+            compute_status = await asyncio.to_thread(self.get_compute_status)
+            snapshot = replace(snapshot, compute_status=compute_status)
+            refreshed_at[SOURCE_AUTOSCALER] = time.time()
+        except Exception:
+            APP_METRICS_REFRESH_FAILURES.labels(source=SOURCE_AUTOSCALER).inc()
+            logger.error("Failed to fetch autoscaler stats", exc_info=True)
+        self.snapshot = replace(
+            snapshot,
+            refreshed_at=refreshed_at,
+            refresh_duration=time.perf_counter() - started_at,
+        )
+
+    async def _run(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+
+def get_model_usages() -> List[Dict]:
+    """
+    Usage of every model with usage recorded, served models without usage
+    yet are reported as 0
+    """
+    usages = {
+        usage["model_name"]: usage
+        for usage in TokenUsageRepositoryFirestore.instance().get_usage_by_models()
+    }
+    for model in model_registry.get_models():
+        usages.setdefault(
+            model.name,
+            {
+                "model_name": model.name,
+                "completion_tokens": 0,
+                "prompt_tokens": 0,
+                "total_tokens": 0,
+            },
+        )
+    return sorted(usages.values(), key=lambda usage: usage["model_name"])
+
+
+def render(snapshot: AppMetricsSnapshot, now: Optional[float] = None) -> str:
+    if now is None:
+        now = time.time()
+    result = ""
+    for usage in snapshot.model_usages:
+        model_name = usage["model_name"]
+        for name in ("total", "completion", "prompt"):
+            result += (
+                f'\nllm_proxy_llm_{name}_tokens_grand_sum{{model_name="{model_name}"}} '
+                + str(usage[f"{name}_tokens"])
+            )
+    if snapshot.compute_status:
+        result += "\nllm_proxy_llm_autoscaler_target_size " + str(
+            snapshot.compute_status.target_size
+        )
+        for name, value in snapshot.compute_status.actions.items():
+            result += f"\nllm_proxy_llm_autoscaler_action_{name} " + str(value)
+    for source, refreshed_at in snapshot.refreshed_at.items():
+        result += (
+            f'\nllm_proxy_app_metrics_age_seconds{{source="{source}"}} '
+            + str(round(now - refreshed_at, 3))
+        )
+    if snapshot.refresh_duration is not None:
+        result += "\nllm_proxy_app_metrics_refresh_duration_seconds " + str(
+            round(snapshot.refresh_duration, 3)
+        )
+    return result
+
+
+app_metrics_refresher = AppMetricsRefresher(
+    get_model_usages=get_model_usages,
+    get_compute_status=lambda: (
+        GoogleComputeRepository.instance().get_instance_group_status()
+    ),
+    interval=settings.APP_METRICS_REFRESH_INTERVAL,
+)
@@ -3,6 +3,9 @@ import secrets
 from router.domain.user.entities import User
 from router.repository.user_repository import UserRepositoryFirebase
 from router.repository.user_repository import ValidatedUser
+from router.service.auth import signed_api_key
+from router.service.auth.api_key_filter import api_key_filter
+from router.service.auth.signed_api_key import api_key_signer
 from router.service.user.entities import CreateUserRequest
 from router.service.user.entities import GetUserResponse
 
@@ -12,11 +15,14 @@ def execute(
     payload: CreateUserRequest,
     user_repository: UserRepositoryFirebase,
 ) -> GetUserResponse:
+    existing_user = user_repository.get_user(validated_user.uid)
+    if existing_user:
+        _revoke_api_key(existing_user, user_repository)
     user_repository.create_user(
         User(
             uid=validated_user.uid,
             email=validated_user.email,
-            api_key=_create_api_key(),
+            api_key=_create_api_key(validated_user.uid),
             name=payload.name,
             user_role=payload.user_role,
             building=payload.building,
@@ -29,7 +35,28 @@ def execute(
     return GetUserResponse.from_user(user, usages=[])
 
 
-def _create_api_key():
+def _revoke_api_key(user: User, user_repository: UserRepositoryFirebase) -> None:
+    """
+    Signed keys stay valid without a lookup, the key being replaced has to
+    be revoked
+    """
+    if not user.api_key or not signed_api_key.is_signed(user.api_key):
+        return
+    key = api_key_signer.parse(user.api_key)
+    if key:
+        user_repository.revoke_api_key(user.uid, key.key_id)
+
+
+def _create_api_key(uid: str):
+    if api_key_signer.is_enabled():
+        return api_key_signer.create(uid)
+    api_key = _create_legacy_api_key()
+    # Other workers add it when their users listener sees the new user
+    api_key_filter.add(api_key)
+    return api_key
+
+
+def _create_legacy_api_key():
     def is_last_4_digits_alpha(_secret):
         return (
             _secret[-1].isalpha()
@@ -21,6 +21,39 @@ class UsageStatistics(BaseModel):
         )
 
 
+class UsageBucket(BaseModel):
+    start: int = Field(description="Bucket start, unix timestamp")
+    model: str = Field(description="Model name")
+    completion_tokens: int = Field(description="Completion tokens used")
+    prompt_tokens: int = Field(description="Prompt tokens used")
+    total_tokens: int = Field(description="Total tokens used")
+    requests: int = Field(description="Count of requests")
+
+    @classmethod
+    def from_rollup_dict(cls, rollup: Dict):
+        return UsageBucket(
+            start=rollup["start"],
+            model=rollup["model_name"],
+            completion_tokens=rollup.get("completion_tokens", 0),
+            prompt_tokens=rollup.get("prompt_tokens", 0),
+            total_tokens=rollup.get("total_tokens", 0),
+            requests=rollup.get("requests", 0),
+        )
+
+
+class GetUsageResponse(BaseModel):
+    granularity: str = Field(description="Bucket size, hour or day")
+    start: int = Field(description="Range start, unix timestamp")
+    end: int = Field(description="Range end (exclusive), unix timestamp")
+    buckets: List[UsageBucket] = Field(
+        description="Token usage per bucket and model, ordered by start and model"
+    )
+    next_page_token: Optional[str] = Field(
+        description="Pass as page_token to get the next page, none on the last page",
+        default=None,
+    )
+
+
 class GetUserResponse(BaseModel):
     email: str = Field(description="User email")
     api_key: str = Field(description="User api_key")
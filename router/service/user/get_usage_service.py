@@ -0,0 +1,107 @@
+import asyncio
+import time
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from prometheus_client import Counter
+
+import settings
+from router.repository.token_usage_repository import GRANULARITY_DAY
+from router.repository.token_usage_repository import GRANULARITY_SECONDS
+from router.repository.token_usage_repository import TokenUsageRepositoryFirestore
+from router.service import error_responses
+from router.service.user.entities import GetUsageResponse
+from router.service.user.entities import UsageBucket
+from router.utils.ttl_cache import TtlCache
+
+USAGE_TIMESERIES_CACHE_REQUESTS = Counter(
+    "llm_proxy_usage_timeseries_cache_requests_total",
+    "Total count of usage time-series cache lookups by result (hit or miss).",
+    ["result"],
+)
+
+RESULT_HIT = "hit"
+RESULT_MISS = "miss"
+
+MAX_PAGE_SIZE = 500
+# Range used when the request does not give a start, in buckets
+DEFAULT_BUCKETS = {"hour": 24, "day": 30}
+
+cache: TtlCache[GetUsageResponse] = TtlCache(
+    max_entries=settings.USAGE_TIMESERIES_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.USAGE_TIMESERIES_CACHE_TTL_SECONDS,
+)
+
+
+async def execute(
+    user_uid: str,
+    granularity: str = GRANULARITY_DAY,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    page_size: int = 100,
+    page_token: Optional[str] = None,
+) -> GetUsageResponse:
+    """
+    Token usage of the user per model in hourly or daily buckets, read from
+    the usage rollups, off the event loop. The range is aligned to whole
+    buckets.
+    """
+    if granularity not in GRANULARITY_SECONDS:
+        raise error_responses.ValidationAPIError("granularity")
+    if not 0 < page_size <= MAX_PAGE_SIZE:
+        raise error_responses.ValidationAPIError("page_size")
+    bucket_seconds = GRANULARITY_SECONDS[granularity]
+    if end is None:
+        end = int(time.time())
+    # End is exclusive, the bucket in progress is included
+    end = end - end % bucket_seconds + bucket_seconds
+    if start is None:
+        start = end - DEFAULT_BUCKETS[granularity] * bucket_seconds
+    start = start - start % bucket_seconds
+    if start >= end:
+        raise error_responses.ValidationAPIError("start")
+    start_after = _parse_page_token(page_token) if page_token else None
+
+    cache_key = (user_uid, granularity, start, end, page_size, page_token)
+    response = cache.get(cache_key)
+    if response is not None:
+        USAGE_TIMESERIES_CACHE_REQUESTS.labels(result=RESULT_HIT).inc()
+        return response
+    USAGE_TIMESERIES_CACHE_REQUESTS.labels(result=RESULT_MISS).inc()
+
+    repo = TokenUsageRepositoryFirestore.instance()
+    # One extra bucket tells if there is a next page
+    rollups = await asyncio.to_thread(
+        repo.get_usage_buckets,
+        user_uid,
+        granularity,
+        start,
+        end,
+        page_size + 1,
+        start_after,
+    )
+    next_page_token = None
+    if len(rollups) > page_size:
+        rollups = rollups[:page_size]
+        next_page_token = _get_page_token(rollups[-1])
+    response = GetUsageResponse(
+        granularity=granularity,
+        start=start,
+        end=end,
+        buckets=[UsageBucket.from_rollup_dict(rollup) for rollup in rollups],
+        next_page_token=next_page_token,
+    )
+    cache.set(cache_key, response)
+    return response
+
+
+def _get_page_token(rollup: Dict) -> str:
+    return f"{rollup['start']}:{rollup['model_name']}"
+
+
+def _parse_page_token(page_token: str) -> Tuple[int, str]:
+    start, _, model_name = page_token.partition(":")
+    if not start.isdigit() or not model_name:
+        raise error_responses.ValidationAPIError("page_token")
+    return int(start), model_name
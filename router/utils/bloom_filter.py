@@ -0,0 +1,52 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Set membership with false positives at about false_positive_rate while
+    it holds up to capacity items, and no false negatives.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.size_bits = max(
+            8,
+            math.ceil(
+                -capacity * math.log(false_positive_rate) / (math.log(2) ** 2)
+            ),
+        )
+        self.hash_count = max(1, round(self.size_bits / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size_bits / 8))
+        self.count = 0
+
+    def add(self, item: bytes) -> None:
+        is_new = False
+        for index in self._get_indexes(item):
+            mask = 1 << (index % 8)
+            if not self.bits[index // 8] & mask:
+                self.bits[index // 8] |= mask
+                is_new = True
+        if is_new:
+            self.count += 1
+
+    def __contains__(self, item: bytes) -> bool:
+        return all(
+            self.bits[index // 8] & (1 << (index % 8))
+            for index in self._get_indexes(item)
+        )
+
+    def get_size_bytes(self) -> int:
+        return len(self.bits)
+
+    def get_false_positive_rate(self) -> float:
+        """Expected false positive rate with the items added so far"""
+        return (
+            1 - math.exp(-self.hash_count * self.count / self.size_bits)
+        ) ** self.hash_count
+
+    def _get_indexes(self, item: bytes):
+        # Double hashing, k indexes from two 64 bit hashes
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size_bits for i in range(self.hash_count))
@@ -0,0 +1,170 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+# Slot: hash of the key and its theoretical arrival time (TAT)
+_SLOT = struct.Struct("<Qd")
+# A key is looked for in this many slots from its hash
+MAX_PROBES = 8
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    name: str
+    # Allowed cost per period, on average
+    limit: float
+    period: float
+    # Cost allowed at once, defaults to limit
+    burst: Optional[float] = None
+
+    def get_emission_interval(self) -> float:
+        return self.period / self.limit
+
+    def get_burst(self) -> float:
+        return self.burst if self.burst is not None else self.limit
+
+
+@dataclass(frozen=True)
+class RateLimitDecision:
+    is_allowed: bool
+    # Cost that could still be spent right now
+    remaining: float
+    # Seconds until the request would be allowed, 0 if allowed
+    retry_after: float
+    # Seconds until the full burst is available again
+    reset_after: float
+
+
+class SharedGcra:
+    """
+    GCRA rate limits of any number of keys, kept in a fixed size table of
+    slots in a memory mapped file, so every worker process on the host shares
+    them. Updates hold an exclusive flock on the file for a few microseconds,
+    no network I/O is involved.
+
+    A key's state is only its TAT, a key whose TAT has passed has its full
+    burst available, so its slot is free to reuse. When every probed slot is
+    in use the one closest to being free is taken over.
+    """
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = slots
+        self.fd: Optional[int] = None
+        self.map: Optional[mmap.mmap] = None
+        self.pid: Optional[int] = None
+
+    def acquire(
+        self,
+        key: str,
+        rate_limit: RateLimit,
+        cost: float = 1,
+        now: float = None,
+        is_forced: bool = False,
+    ) -> RateLimitDecision:
+        """
+        Spends cost from the limit of key if it is allowed, or anyway if
+        is_forced, eg once the real cost is known
+        """
+        if now is None:
+            now = time.time()
+        interval = rate_limit.get_emission_interval()
+        tolerance = rate_limit.get_burst() * interval
+        key_hash = _get_key_hash(rate_limit.name, key)
+        with self._lock():
+            slot, tat = self._find(key_hash, now)
+            new_tat = max(tat, now) + cost * interval
+            if new_tat - now > tolerance and not is_forced:
+                return RateLimitDecision(
+                    is_allowed=False,
+                    remaining=max(0.0, (tolerance - (tat - now)) / interval),
+                    retry_after=new_tat - now - tolerance,
+                    reset_after=max(0.0, tat - now),
+                )
+            self._write(slot, key_hash, new_tat)
+        return RateLimitDecision(
+            is_allowed=True,
+            remaining=max(0.0, (tolerance - (new_tat - now)) / interval),
+            retry_after=0.0,
+            reset_after=new_tat - now,
+        )
+
+    def refund(
+        self, key: str, rate_limit: RateLimit, cost: float, now: float = None
+    ) -> None:
+        """Gives back cost spent with acquire, eg once the real cost is known"""
+        if now is None:
+            now = time.time()
+        key_hash = _get_key_hash(rate_limit.name, key)
+        with self._lock():
+            slot, tat = self._find(key_hash, now)
+            if tat > now:
+                tat = max(now, tat - cost * rate_limit.get_emission_interval())
+                self._write(slot, key_hash, tat)
+
+    def _find(self, key_hash: int, now: float):
+        """
+        Returns:
+            slot of the key and its TAT, a free slot and 0 if it has none
+        """
+        start = key_hash % self.slots
+        free_slot = None
+        oldest_slot, oldest_tat = start, math.inf
+        for probe in range(MAX_PROBES):
+            slot = (start + probe) % self.slots
+            slot_hash, tat = _SLOT.unpack_from(self.map, slot * _SLOT.size)
+            if slot_hash == key_hash:
+                return slot, tat
+            if free_slot is None and (slot_hash == 0 or tat <= now):
+                free_slot = slot
+            if tat < oldest_tat:
+                oldest_slot, oldest_tat = slot, tat
+        return (free_slot if free_slot is not None else oldest_slot), 0.0
+
+    def _write(self, slot: int, key_hash: int, tat: float) -> None:
+        _SLOT.pack_into(self.map, slot * _SLOT.size, key_hash, tat)
+
+    def _lock(self):
+        self._open()
+        return _FileLock(self.fd)
+
+    def _open(self) -> None:
+        # Workers forked from a parent that used the table open their own map
+        if self.map is not None and self.pid == os.getpid():
+            return
+        size = self.slots * _SLOT.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != size:
+                # New file or a different table size, start empty
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.fd = fd
+        self.map = mmap.mmap(fd, size)
+        self.pid = os.getpid()
+
+
+class _FileLock:
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def __enter__(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *_):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+def _get_key_hash(name: str, key: str) -> int:
+    digest = hashlib.blake2b(f"{name}:{key}".encode(), digest_size=8).digest()
+    # 0 marks an empty slot
+    return int.from_bytes(digest, "little") or 1
@@ -0,0 +1,62 @@
+from typing import AsyncIterator
+
+from starlette.responses import StreamingResponse
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    When the client disconnects starlette stops sending, but the body
+    iterator is only closed if it was awaiting at that moment. Otherwise the
+    suspended generator, and the upstream request it reads, are left to the
+    garbage collector. This closes the body iterator as soon as the response
+    ends for any reason.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose:
+                await aclose()
+
+
+class _PrefetchedChunks:
+    """The first chunk, already read, followed by the rest of chunks"""
+
+    def __init__(self, chunks: AsyncIterator[bytes], first_chunk: bytes = None):
+        self.chunks = chunks
+        self.first_chunk = first_chunk
+
+    def __aiter__(self) -> "_PrefetchedChunks":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.first_chunk is not None:
+            chunk, self.first_chunk = self.first_chunk, None
+            return chunk
+        return await self.chunks.__anext__()
+
+    async def aclose(self) -> None:
+        # Closes chunks even if the response never started iterating
+        await self.chunks.aclose()
+
+
+async def start_stream(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Waits for the first chunk before the response is built, so an error
+    raised before it (eg. no endpoint, load shedding) reaches the exception
+    handlers and gets its own status code, instead of ending a 200 stream
+    that already sent its headers.
+
+    Returns:
+        the chunks, the first one included
+    """
+    try:
+        first_chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        return _PrefetchedChunks(chunks)
+    return _PrefetchedChunks(chunks, first_chunk)
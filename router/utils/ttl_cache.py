@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Callable
+from typing import Generic
+from typing import Hashable
+from typing import Optional
+from typing import Tuple
+from typing import TypeVar
+
+V = TypeVar("V")
+
+
+class TtlCache(Generic[V]):
+    """
+    LRU cache of up to max_entries values, each kept for ttl_seconds unless
+    set with its own ttl.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.entries: "OrderedDict[Hashable, Tuple[V, float]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= self.clock():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: V, ttl_seconds: Optional[float] = None) -> None:
+        if ttl_seconds is None:
+            ttl_seconds = self.ttl_seconds
+        self.entries[key] = (value, self.clock() + ttl_seconds)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def delete(self, key: Any) -> None:
+        self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
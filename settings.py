@@ -18,10 +18,172 @@ PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", None)
 DEMO_API_KEY = "Bearer demo-api-key"
 DEMO_API_KEY_ALLOWED_USAGE = 4
 
+# Rate limits are shared by the workers through this memory mapped file, it holds
+# the state of up to RATE_LIMITER_SLOTS keys at once
+RATE_LIMITER_PATH = os.getenv("RATE_LIMITER_PATH", "/tmp/llm_proxy_rate_limits")
+RATE_LIMITER_SLOTS = int(os.getenv("RATE_LIMITER_SLOTS", 65536))
+
 SEGMENT_WRITE_KEY = os.getenv("SEGMENT_WRITE_KEY", None)
 
 LLM_BASE_URL = os.getenv("LLM_BASE_URL", "http://34.36.255.140/v1/")
 PROVIDER_RATIO = float(os.getenv("PROVIDER_RATIO", "0.5"))
+# random | least_outstanding_requests | power_of_two_choices
+LOAD_BALANCER_POLICY = os.getenv("LOAD_BALANCER_POLICY", "power_of_two_choices")
+LOAD_BALANCER_EWMA_ALPHA = float(os.getenv("LOAD_BALANCER_EWMA_ALPHA", "0.3"))
+
+CIRCUIT_BREAKER_FAILURE_RATE_THRESHOLD = float(
+    os.getenv("CIRCUIT_BREAKER_FAILURE_RATE_THRESHOLD", "0.5")
+)
+CIRCUIT_BREAKER_MINIMUM_REQUESTS = int(os.getenv("CIRCUIT_BREAKER_MINIMUM_REQUESTS", 5))
+CIRCUIT_BREAKER_WINDOW_SECONDS = float(os.getenv("CIRCUIT_BREAKER_WINDOW_SECONDS", 30))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", 15))
+CIRCUIT_BREAKER_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_BREAKER_HALF_OPEN_PROBES", 1))
+
+# Adaptive limit of requests in flight per endpoint and worker, requests over
+# the limit wait in a queue that sheds them once waits stay over the target
+UPSTREAM_CONCURRENCY_INITIAL_LIMIT = int(
+    os.getenv("UPSTREAM_CONCURRENCY_INITIAL_LIMIT", 20)
+)
+UPSTREAM_CONCURRENCY_MIN_LIMIT = int(os.getenv("UPSTREAM_CONCURRENCY_MIN_LIMIT", 4))
+UPSTREAM_CONCURRENCY_MAX_LIMIT = int(os.getenv("UPSTREAM_CONCURRENCY_MAX_LIMIT", 256))
+# Recent latency over this multiple of the long term average lowers the limit
+UPSTREAM_CONCURRENCY_LATENCY_TOLERANCE = float(
+    os.getenv("UPSTREAM_CONCURRENCY_LATENCY_TOLERANCE", "1.5")
+)
+UPSTREAM_QUEUE_MAX_SIZE = int(os.getenv("UPSTREAM_QUEUE_MAX_SIZE", 100))
+UPSTREAM_QUEUE_TARGET_SECONDS = float(os.getenv("UPSTREAM_QUEUE_TARGET_SECONDS", 1))
+UPSTREAM_QUEUE_INTERVAL_SECONDS = float(
+    os.getenv("UPSTREAM_QUEUE_INTERVAL_SECONDS", 10)
+)
+UPSTREAM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT_SECONDS", 15))
+
+# Hedging of non-streaming completions: if the primary endpoint is slower than
+# its observed latency percentile, the request is also sent to another one
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "false").lower() == "true"
+HEDGE_LATENCY_PERCENTILE = float(os.getenv("HEDGE_LATENCY_PERCENTILE", 95))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 0.5))
+# Max share of requests that can be hedged
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.05"))
+
+# Streams raced on two endpoints, committing to the first one to emit a token
+STREAM_RACE_USER_IDS = [
+    uid for uid in os.getenv("STREAM_RACE_USER_IDS", "").split(",") if uid
+]
+# Max share of streams that can be raced
+STREAM_RACE_MAX_RATE = float(os.getenv("STREAM_RACE_MAX_RATE", "0.1"))
+
+# In-process cache of deterministic (temperature=0) completions
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(
+    os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)
+)
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 600))
+
+# Identical concurrent deterministic non-streaming requests share one upstream call
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+# Identical concurrent deterministic streaming requests share one upstream stream
+STREAM_BROADCAST_ENABLED = (
+    os.getenv("STREAM_BROADCAST_ENABLED", "true").lower() == "true"
+)
+# Buffered bytes per shared stream: the upstream is read at most this far ahead of
+# the fastest subscriber, slower ones lagging more than that are dropped
+STREAM_BROADCAST_MAX_BUFFER_BYTES = int(
+    os.getenv("STREAM_BROADCAST_MAX_BUFFER_BYTES", 1024 * 1024)
+)
+
+# Content of a completion stream kept for tracing, past the cap it is dropped
+STREAM_ACCUMULATOR_MAX_CONTENT_CHARS = int(
+    os.getenv("STREAM_ACCUMULATOR_MAX_CONTENT_CHARS", 64 * 1024)
+)
+
+# tokenizer.json of the served Mistral model, token counts are estimated and the
+# context window is not enforced without it
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH", "")
+# Token counts of messages are cached, chats send the same messages every turn
+TOKENIZER_CACHE_MAX_ENTRIES = int(os.getenv("TOKENIZER_CACHE_MAX_ENTRIES", 100000))
+
+# Context window of the served model, the smallest one of the providers
+MISTRAL_7B_INSTRUCT_CONTEXT_WINDOW = int(
+    os.getenv("MISTRAL_7B_INSTRUCT_CONTEXT_WINDOW", 16384)
+)
+
+# Token usage is written to Firestore in the background, in batches of up to
+# USAGE_LEDGER_BATCH_SIZE records (at most 83) or every USAGE_LEDGER_FLUSH_INTERVAL
+# seconds, requests wait once USAGE_LEDGER_MAX_QUEUE_SIZE records are queued
+USAGE_LEDGER_MAX_QUEUE_SIZE = int(os.getenv("USAGE_LEDGER_MAX_QUEUE_SIZE", 10000))
+USAGE_LEDGER_BATCH_SIZE = int(os.getenv("USAGE_LEDGER_BATCH_SIZE", 80))
+USAGE_LEDGER_FLUSH_INTERVAL = float(os.getenv("USAGE_LEDGER_FLUSH_INTERVAL", 1.0))
+
+# Usage time-series responses are cached, dashboards load the same ranges again
+USAGE_TIMESERIES_CACHE_MAX_ENTRIES = int(
+    os.getenv("USAGE_TIMESERIES_CACHE_MAX_ENTRIES", 10000)
+)
+USAGE_TIMESERIES_CACHE_TTL_SECONDS = float(
+    os.getenv("USAGE_TIMESERIES_CACHE_TTL_SECONDS", 60)
+)
+
+# Secrets of signed API keys, "<version>:<secret>" pairs separated by ",". New
+# keys are signed with the highest version, without secrets legacy keys are issued
+API_KEY_SIGNING_SECRETS = os.getenv("API_KEY_SIGNING_SECRETS", "")
+
+# Users of API keys are cached, unknown keys for a short time, changed users
+# are dropped from the cache by a listener on the users collection
+API_KEY_CACHE_MAX_ENTRIES = int(os.getenv("API_KEY_CACHE_MAX_ENTRIES", 100000))
+API_KEY_CACHE_TTL_SECONDS = float(os.getenv("API_KEY_CACHE_TTL_SECONDS", 300))
+API_KEY_CACHE_NEGATIVE_TTL_SECONDS = float(
+    os.getenv("API_KEY_CACHE_NEGATIVE_TTL_SECONDS", 10)
+)
+
+# Bloom filter of issued legacy API keys, unknown keys are rejected without a
+# lookup. Holds API_KEY_FILTER_CAPACITY keys at the false positive rate
+API_KEY_FILTER_CAPACITY = int(os.getenv("API_KEY_FILTER_CAPACITY", 1000000))
+API_KEY_FILTER_FALSE_POSITIVE_RATE = float(
+    os.getenv("API_KEY_FILTER_FALSE_POSITIVE_RATE", 0.001)
+)
+
+# Stytch session JWTs are verified with the project JWKS, refreshed every
+# STYTCH_JWKS_REFRESH_INTERVAL seconds. Validated sessions are cached until they
+# expire, at most STYTCH_SESSION_CACHE_MAX_TTL_SECONDS
+STYTCH_JWKS_REFRESH_INTERVAL = float(os.getenv("STYTCH_JWKS_REFRESH_INTERVAL", 3600))
+STYTCH_SESSION_CACHE_MAX_ENTRIES = int(
+    os.getenv("STYTCH_SESSION_CACHE_MAX_ENTRIES", 10000)
+)
+STYTCH_SESSION_CACHE_MAX_TTL_SECONDS = float(
+    os.getenv("STYTCH_SESSION_CACHE_MAX_TTL_SECONDS", 300)
+)
+
+# Per-user quotas of /v1/chat/completions, 0 is unlimited. Unlimited by
+# default, users are opted in with QUOTA_OVERRIDES, a JSON object of uid to the
+# fields that differ, eg {"uid": {"tokens_per_minute": 500000}}. Tokens are
+# debited up front with the prompt tokens and max_tokens
+# (QUOTA_DEFAULT_COMPLETION_TOKENS if not given) and reconciled with the usage.
+QUOTA_REQUESTS_PER_MINUTE = int(os.getenv("QUOTA_REQUESTS_PER_MINUTE", 0))
+QUOTA_TOKENS_PER_MINUTE = int(os.getenv("QUOTA_TOKENS_PER_MINUTE", 0))
+# Streams are counted by each worker, so a user can have up to this many
+# streams open per worker process
+QUOTA_MAX_CONCURRENT_STREAMS = int(os.getenv("QUOTA_MAX_CONCURRENT_STREAMS", 0))
+QUOTA_DEFAULT_COMPLETION_TOKENS = int(
+    os.getenv("QUOTA_DEFAULT_COMPLETION_TOKENS", 256)
+)
+QUOTA_OVERRIDES = os.getenv("QUOTA_OVERRIDES", "")
+
+# Upstream (LLM provider) HTTP connection pools, one per chat completion endpoint
+UPSTREAM_POOL_LIMIT = int(os.getenv("UPSTREAM_POOL_LIMIT", 100))
+# 0 - no per host limit
+UPSTREAM_POOL_LIMIT_PER_HOST = int(os.getenv("UPSTREAM_POOL_LIMIT_PER_HOST", 0))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", 60))
+UPSTREAM_DNS_CACHE_TTL = int(os.getenv("UPSTREAM_DNS_CACHE_TTL", 300))
+UPSTREAM_PREWARM_CONNECTIONS = int(os.getenv("UPSTREAM_PREWARM_CONNECTIONS", 2))
+UPSTREAM_PREWARM_TIMEOUT = float(os.getenv("UPSTREAM_PREWARM_TIMEOUT", 5))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 5))
+UPSTREAM_TOTAL_TIMEOUT = float(os.getenv("UPSTREAM_TOTAL_TIMEOUT", 300))
+
+# Seconds between refreshes of the token usage and autoscaler values of /metrics-app
+APP_METRICS_REFRESH_INTERVAL = float(os.getenv("APP_METRICS_REFRESH_INTERVAL", 15))
 
 GCP_PROJECT_ID = "sidekik-ai"
 GCP_ZONE = "us-west1-b"
@@ -0,0 +1,78 @@
+"""
+Microbenchmark of the per-chunk cost of proxying an upstream completion stream.
+
+Compares the previous line handling of completion_stream_service (decode, two
+json.loads, json.dumps) with router.service.completion.sse.SseFramer.
+
+To run: `python sse_benchmark.py`
+"""
+
+import json
+import timeit
+
+from router.service.completion.sse import SseFramer
+
+MODEL = "mistralai/Mistral-7B-Instruct-v0.2"
+CHUNKS = 500
+REPEAT = 20
+
+
+def _get_upstream_stream() -> bytes:
+    lines = []
+    for i in range(CHUNKS):
+        line = {
+            "id": "cmpl-9f2c1c7e8f8a4c0c9b2f1c6a7d1e2f3a",
+            "object": "chat.completion.chunk",
+            "created": 1707000000,
+            "model": "/models/mistral-7b-instruct-v0.2",
+            "choices": [
+                {"index": 0, "delta": {"content": f" token{i}"}, "finish_reason": None}
+            ],
+        }
+        lines.append(b"data: " + json.dumps(line).encode() + b"\n\n")
+    usage = {"prompt_tokens": 20, "completion_tokens": CHUNKS, "total_tokens": 520}
+    lines.append(
+        b"data: " + json.dumps({"model": "m", "choices": [], "usage": usage}).encode()
+    )
+    lines.append(b"\n\ndata: [DONE]\n\n")
+    return b"".join(lines)
+
+
+def run_previous(stream: bytes) -> None:
+    for line in stream.splitlines(keepends=True):
+        try:
+            decoded = line.decode()
+            if decoded[1] != "\n":
+                decoded_line = json.loads(decoded.split("data: ")[-1])
+                decoded_line["choices"][0]["delta"].get("content")
+                if decoded_line.get("usage"):
+                    pass
+        except:
+            pass
+        try:
+            decoded = line.decode()
+            decoded_line = json.loads(decoded.split("data: ")[-1])
+            decoded_line["model"] = MODEL
+            decoded = "data: " + json.dumps(decoded_line)
+            str.encode(decoded)
+        except:
+            pass
+
+
+def run_framer(stream: bytes, read_size: int = 1024) -> None:
+    framer = SseFramer(model=MODEL)
+    for i in range(0, len(stream), read_size):
+        framer.feed(stream[i:i + read_size])
+    framer.flush()
+
+
+def main():
+    stream = _get_upstream_stream()
+    chunk_count = stream.count(b"\n")
+    for name, fn in [("previous", run_previous), ("sse_framer", run_framer)]:
+        seconds = min(timeit.repeat(lambda: fn(stream), number=1, repeat=REPEAT))
+        print(f"{name:>12}: {seconds / chunk_count * 1e6:.2f} us per line")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import tokenizers
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+
+from router.domain.tokens.tokenizer import TOKENS_PER_MESSAGE
+from router.domain.tokens.tokenizer import TOKENS_PER_REQUEST
+from router.domain.tokens.tokenizer import Tokenizer
+from router.service.completion.entities import Message
+
+
+def _get_tokenizer(tmp_path) -> Tokenizer:
+    vocab = tokenizers.Tokenizer(
+        WordLevel({"hello": 0, "world": 1, "[UNK]": 2}, unk_token="[UNK]")
+    )
+    vocab.pre_tokenizer = Whitespace()
+    path = str(tmp_path / "tokenizer.json")
+    vocab.save(path)
+    return Tokenizer(tokenizer_path=path, cache_max_entries=2)
+
+
+def test_count_batch(tmp_path):
+    tokenizer = _get_tokenizer(tmp_path)
+    assert tokenizer.is_loaded()
+    assert tokenizer.count_batch(["hello world", "hello", ""]) == [2, 1, 0]
+
+
+def test_count_messages_caches_messages(tmp_path):
+    tokenizer = _get_tokenizer(tmp_path)
+    first = [Message(role="user", content="hello world")]
+    second = first + [
+        Message(role="assistant", content="hello"),
+        Message(role="user", content="world world world"),
+    ]
+    assert tokenizer.count_messages_batch([first, second]) == [
+        TOKENS_PER_REQUEST + 2 + TOKENS_PER_MESSAGE,
+        TOKENS_PER_REQUEST + 6 + 3 * TOKENS_PER_MESSAGE,
+    ]
+    # Least recently used message was evicted
+    assert len(tokenizer.cache) == 2
+
+
+def test_count_without_vocab_is_estimated():
+    tokenizer = Tokenizer(tokenizer_path="", cache_max_entries=10)
+    assert not tokenizer.is_loaded()
+    assert tokenizer.count("123456") == 2
@@ -0,0 +1,75 @@
+import asyncio
+
+from router.domain.tokens.usage_ledger import UsageLedger
+
+
+def _get_ledger(batches, **kwargs) -> UsageLedger:
+    options = {"max_queue_size": 100, "batch_size": 3, "flush_interval": 10}
+    options.update(kwargs)
+    return UsageLedger(write_batch=batches.append, **options)
+
+
+def test_writes_full_batches():
+    batches = []
+
+    async def run():
+        ledger = _get_ledger(batches)
+        for i in range(7):
+            await ledger.put({"i": i})
+        await asyncio.sleep(0.01)
+        # The last record waits for the flush interval
+        assert [len(batch) for batch in batches] == [3, 3]
+        await ledger.close()
+
+    asyncio.run(run())
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [record["i"] for batch in batches for record in batch] == list(range(7))
+
+
+def test_writes_after_flush_interval():
+    batches = []
+
+    async def run():
+        ledger = _get_ledger(batches, flush_interval=0.02)
+        await ledger.put({"i": 0})
+        await asyncio.sleep(0.1)
+        assert batches == [[{"i": 0}]]
+        await ledger.close()
+
+    asyncio.run(run())
+
+
+def test_put_waits_for_room_in_queue():
+    batches = []
+
+    async def run():
+        ledger = _get_ledger(batches, max_queue_size=2, batch_size=2)
+        await asyncio.wait_for(
+            asyncio.gather(*[ledger.put({"i": i}) for i in range(10)]), 1
+        )
+        await ledger.close()
+
+    asyncio.run(run())
+    assert sum(len(batch) for batch in batches) == 10
+
+
+def test_retries_failed_writes():
+    batches = []
+    attempts = []
+
+    def write_batch(batch):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise Exception("unavailable")
+        batches.append(batch)
+
+    async def run():
+        ledger = UsageLedger(
+            write_batch=write_batch, max_queue_size=10, batch_size=1, flush_interval=1
+        )
+        await ledger.put({"i": 0})
+        await ledger.close()
+
+    asyncio.run(run())
+    assert len(attempts) == 2
+    assert batches == [[{"i": 0}]]
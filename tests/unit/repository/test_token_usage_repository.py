@@ -0,0 +1,79 @@
+from router.repository.token_usage_repository import DB_KEY_TOKEN_USAGES_BY_MODEL
+from router.repository.token_usage_repository import DB_KEY_TOKEN_USAGES_BY_USER
+from router.repository.token_usage_repository import DB_KEY_TOKEN_USAGES_BY_USER_MODEL
+from router.repository.token_usage_repository import (
+    DB_KEY_TOKEN_USAGES_BY_USER_MODEL_DAY,
+)
+from router.repository.token_usage_repository import (
+    DB_KEY_TOKEN_USAGES_BY_USER_MODEL_HOUR,
+)
+from router.repository.token_usage_repository import get_rollups
+from router.repository.token_usage_repository import get_usage_record
+
+MODEL = "mistralai/Mistral-7B-Instruct-v0.2"
+USAGE = {"completion_tokens": 2, "prompt_tokens": 3, "total_tokens": 5}
+
+
+def _get_record(user_id: str, created_at: int):
+    record = get_usage_record(user_id, "provider", MODEL, USAGE)
+    record["created_at"] = created_at
+    return record
+
+
+def test_get_rollups():
+    day = 1700000000  # 2023-11-14
+    records = [
+        _get_record("user-1", day),
+        _get_record("user-1", day + 86400),
+        _get_record("user-2", day),
+    ]
+    rollups = get_rollups(records)
+
+    model_rollups = [
+        rollup
+        for (collection, _), rollup in rollups.items()
+        if collection == DB_KEY_TOKEN_USAGES_BY_MODEL
+    ]
+    assert model_rollups == [
+        {
+            "model_name": MODEL,
+            "completion_tokens": 6,
+            "prompt_tokens": 9,
+            "total_tokens": 15,
+            "requests": 3,
+        }
+    ]
+    user_rollups = {
+        rollup["user_id"]: rollup["total_tokens"]
+        for (collection, _), rollup in rollups.items()
+        if collection == DB_KEY_TOKEN_USAGES_BY_USER
+    }
+    assert user_rollups == {"user-1": 10, "user-2": 5}
+    user_model_rollups = {
+        (rollup["user_id"], rollup["model_name"]): rollup["requests"]
+        for (collection, _), rollup in rollups.items()
+        if collection == DB_KEY_TOKEN_USAGES_BY_USER_MODEL
+    }
+    assert user_model_rollups == {("user-1", MODEL): 2, ("user-2", MODEL): 1}
+    day_rollups = sorted(
+        (rollup["user_id"], rollup["day"], rollup["requests"])
+        for (collection, _), rollup in rollups.items()
+        if collection == DB_KEY_TOKEN_USAGES_BY_USER_MODEL_DAY
+    )
+    assert day_rollups == [
+        ("user-1", "2023-11-14", 1),
+        ("user-1", "2023-11-15", 1),
+        ("user-2", "2023-11-14", 1),
+    ]
+    hour_rollups = sorted(
+        (rollup["hour"], rollup["start"])
+        for (collection, _), rollup in rollups.items()
+        if collection == DB_KEY_TOKEN_USAGES_BY_USER_MODEL_HOUR
+    )
+    assert hour_rollups == [
+        ("2023-11-14T22", 1699999200),
+        ("2023-11-14T22", 1699999200),
+        ("2023-11-15T22", 1700085600),
+    ]
+    # Firestore document ids can't contain "/"
+    assert all("/" not in document_id for _, document_id in rollups)
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+from router.repository.user_repository import ValidatedUser
+from router.service.auth.api_key_cache import ApiKeyCache
+
+USER = ValidatedUser(uid="uid", email="user@example.com")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _get_cache(users, loads, clock=None) -> ApiKeyCache:
+    def load(api_key):
+        loads.append(api_key)
+        return users.get(api_key)
+
+    return ApiKeyCache(
+        load=load,
+        max_entries=10,
+        ttl_seconds=300,
+        negative_ttl_seconds=10,
+        clock=clock or FakeClock(),
+    )
+
+
+def test_caches_users_and_unknown_keys():
+    loads = []
+    clock = FakeClock()
+    cache = _get_cache({"lo-key": USER}, loads, clock)
+
+    async def run():
+        assert await cache.get("lo-key") == USER
+        assert await cache.get("lo-key") == USER
+        assert await cache.get("lo-unknown") is None
+        assert await cache.get("lo-unknown") is None
+        clock.now = 11
+        assert await cache.get("lo-unknown") is None
+
+    asyncio.run(run())
+    assert loads == ["lo-key", "lo-unknown", "lo-unknown"]
+
+
+def test_concurrent_lookups_share_load():
+    loads = []
+    cache = _get_cache({"lo-key": USER}, loads)
+
+    async def run():
+        return await asyncio.gather(*[cache.get("lo-key") for _ in range(5)])
+
+    assert asyncio.run(run()) == [USER] * 5
+    assert loads == ["lo-key"]
+
+
+def test_listener_invalidates_changed_user():
+    loads = []
+    users = {"lo-key": USER}
+    cache = _get_cache(users, loads)
+    listeners = []
+
+    class Watch:
+        def unsubscribe(self):
+            listeners.clear()
+
+    def listen(on_change):
+        listeners.append(on_change)
+        return Watch()
+
+    async def run():
+        cache.start(listen)
+        assert await cache.get("lo-key") == USER
+        assert await cache.get("lo-new") is None
+        # Key rotated, the listener calls back from its own thread
+        del users["lo-key"]
+        users["lo-new"] = USER
+        thread = threading.Thread(target=listeners[0], args=("uid", "lo-new"))
+        thread.start()
+        thread.join()
+        await asyncio.sleep(0)
+        assert await cache.get("lo-key") is None
+        assert await cache.get("lo-new") == USER
+        cache.close()
+
+    asyncio.run(run())
+    assert listeners == []
+    assert loads == ["lo-key", "lo-new", "lo-key", "lo-new"]
@@ -0,0 +1,36 @@
+from router.service.auth.api_key_filter import ApiKeyFilter
+from router.utils.bloom_filter import BloomFilter
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom_filter = BloomFilter(capacity=10000, false_positive_rate=0.01)
+    for i in range(10000):
+        bloom_filter.add(b"key-%d" % i)
+
+    assert all(b"key-%d" % i in bloom_filter for i in range(10000))
+    false_positives = sum(b"other-%d" % i in bloom_filter for i in range(10000))
+    assert false_positives < 200
+    assert 0.005 < bloom_filter.get_false_positive_rate() < 0.02
+    # About 9.6 bits per key at 1%
+    assert bloom_filter.get_size_bytes() == 11982
+
+
+def test_passes_every_key_until_loaded():
+    listened = []
+
+    def listen(on_change, include_existing, on_initial):
+        assert include_existing
+        listened.append((on_change, on_initial))
+
+    api_key_filter = ApiKeyFilter(capacity=100, false_positive_rate=0.001)
+    api_key_filter.start(listen)
+    on_change, on_initial = listened[0]
+    on_change("uid-1", "lo-key-1")
+    assert api_key_filter.might_contain("lo-unknown")
+
+    on_initial()
+    on_change("uid-2", "lo-key-2")
+    on_change("uid-3", None)
+    assert api_key_filter.might_contain("lo-key-1")
+    assert api_key_filter.might_contain("lo-key-2")
+    assert not api_key_filter.might_contain("lo-unknown")
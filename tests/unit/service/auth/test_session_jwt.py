@@ -0,0 +1,78 @@
+import asyncio
+import json
+import time
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from router.repository.user_repository import ValidatedUser
+from router.service.auth.session_jwt import SESSION_CLAIM
+from router.service.auth.session_jwt import JwksCache
+from router.service.auth.session_jwt import is_jwt
+from router.service.auth.session_jwt import verify
+
+PROJECT_ID = "project-test-1"
+ISSUERS = [f"stytch.com/{PROJECT_ID}"]
+PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def _get_jwks(kid: str):
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(PRIVATE_KEY.public_key()))
+    return {"keys": [{**jwk, "kid": kid, "alg": "RS256", "use": "sig"}]}
+
+
+def _get_jwt(kid: str = "key-1", expires_in: int = 300, audience=PROJECT_ID):
+    now = int(time.time())
+    claims = {
+        "sub": "user-1",
+        "aud": audience,
+        "iss": ISSUERS[0],
+        "iat": now,
+        "nbf": now,
+        "exp": now + expires_in,
+        SESSION_CLAIM: {
+            "authentication_factors": [
+                {"email_factor": {"email_address": "user@example.com"}}
+            ]
+        },
+    }
+    return jwt.encode(claims, PRIVATE_KEY, algorithm="RS256", headers={"kid": kid})
+
+
+def test_verify():
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return _get_jwks("key-1")
+
+    jwks_cache = JwksCache(fetch=fetch, refresh_interval=3600)
+
+    async def run():
+        valid = await verify(_get_jwt(), jwks_cache, PROJECT_ID, ISSUERS)
+        expired = await verify(
+            _get_jwt(expires_in=-10), jwks_cache, PROJECT_ID, ISSUERS
+        )
+        other_audience = await verify(
+            _get_jwt(audience="project-test-2"), jwks_cache, PROJECT_ID, ISSUERS
+        )
+        # Unknown keys refresh the JWKS, at most every MIN_REFRESH_INTERVAL
+        unknown_key = await verify(
+            _get_jwt(kid="key-2"), jwks_cache, PROJECT_ID, ISSUERS
+        )
+        await verify(_get_jwt(kid="key-2"), jwks_cache, PROJECT_ID, ISSUERS)
+        return valid, expired, other_audience, unknown_key
+
+    valid, expired, other_audience, unknown_key = asyncio.run(run())
+    user, expires_at = valid
+    assert user == ValidatedUser(uid="user-1", email="user@example.com")
+    assert expires_at > time.time()
+    assert expired is None
+    assert other_audience is None
+    assert unknown_key is None
+    assert len(fetches) == 1
+
+
+def test_is_jwt():
+    assert is_jwt(_get_jwt())
+    assert not is_jwt("mZAYn5aLEqKUlZ_Ad9U_fWr38GaAQ1oFAhT8ds245v7Q")
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from router.repository.user_repository import ValidatedUser
+from router.service import error_responses
+from router.service.auth.api_key_cache import ApiKeyCache
+from router.service.auth.api_key_filter import ApiKeyFilter
+from router.service.auth.signed_api_key import ApiKeySigner
+from router.service.auth.signed_api_key import RevokedApiKeys
+from router.service.auth.signed_api_key import get_secrets_by_version
+from router.service.auth.signed_api_key import is_signed
+from router.service.auth.validate_id_token import ApiKeyValidator
+
+UID = "user-test-1234.abcd"
+
+
+def _get_validator(signer: ApiKeySigner, users: dict) -> ApiKeyValidator:
+    def get_cache(load) -> ApiKeyCache:
+        return ApiKeyCache(
+            load=load, max_entries=10, ttl_seconds=300, negative_ttl_seconds=10
+        )
+
+    return ApiKeyValidator(
+        get_cache(lambda api_key: None),
+        signer,
+        RevokedApiKeys(),
+        ApiKeyFilter(capacity=10, false_positive_rate=0.01),
+        get_cache(users.get),
+    )
+
+
+def test_create_and_parse():
+    signer = ApiKeySigner({1: b"secret"})
+    api_key = signer.create(UID)
+    assert api_key.startswith("lo-1.")
+    assert is_signed(api_key)
+
+    key = signer.parse(api_key)
+    assert key.uid == UID
+    assert key.version == 1
+    assert key.key_id != signer.parse(signer.create(UID)).key_id
+
+
+def test_parse_rejects_forged_keys():
+    signer = ApiKeySigner({1: b"secret"})
+    api_key = signer.create(UID)
+    version, uid, key_id, signature = api_key[len("lo-"):].split(".")
+
+    other_uid = ApiKeySigner({1: b"secret"}).create("other-user").split(".")[1]
+    assert signer.parse(f"lo-{version}.{other_uid}.{key_id}.{signature}") is None
+    assert ApiKeySigner({1: b"other-secret"}).parse(api_key) is None
+    assert signer.parse(f"lo-2.{uid}.{key_id}.{signature}") is None
+    assert signer.parse(api_key + ".extra") is None
+    assert signer.parse("lo-a.b.c.d") is None
+
+
+def test_old_versions_stay_valid():
+    old_key = ApiKeySigner({1: b"secret"}).create(UID)
+    signer = ApiKeySigner({1: b"secret", 2: b"secret-2"})
+    assert signer.parse(old_key).uid == UID
+    assert signer.create(UID).startswith("lo-2.")
+
+
+def test_legacy_keys_are_not_signed():
+    assert not is_signed("lo-" + "a" * 48)
+
+
+def test_get_secrets_by_version():
+    assert get_secrets_by_version("1:abc, 2:de:f") == {1: b"abc", 2: b"de:f"}
+    assert get_secrets_by_version("") == {}
+
+
+def test_validator_resolves_user_of_signed_key():
+    signer = ApiKeySigner({1: b"secret"})
+    user = ValidatedUser(uid=UID, email="user@example.com")
+    validator = _get_validator(signer, {UID: user})
+    api_key = signer.create(UID)
+
+    async def run():
+        assert await validator.validate(f"Bearer {api_key}") == user
+        validator.revoked_api_keys.key_ids.add(signer.parse(api_key).key_id)
+        await validator.validate(f"Bearer {api_key}")
+
+    with pytest.raises(error_responses.InvalidCredentialsAPIError):
+        asyncio.run(run())
+
+
+def test_validator_rejects_signed_key_of_deleted_user():
+    signer = ApiKeySigner({1: b"secret"})
+    validator = _get_validator(signer, {})
+
+    with pytest.raises(error_responses.InvalidCredentialsAPIError):
+        asyncio.run(validator.validate(f"Bearer {signer.create(UID)}"))
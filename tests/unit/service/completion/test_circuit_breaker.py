@@ -0,0 +1,83 @@
+from router.service.completion.circuit_breaker import CircuitBreaker
+from router.service.completion.circuit_breaker import CircuitState
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _get_breaker(clock: FakeClock) -> CircuitBreaker:
+    return CircuitBreaker(
+        name="test",
+        failure_rate_threshold=0.5,
+        minimum_requests=4,
+        window_seconds=10,
+        open_seconds=5,
+        half_open_probes=1,
+        clock=clock,
+    )
+
+
+def test_circuit_opens_on_failure_rate():
+    breaker = _get_breaker(FakeClock())
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    assert not breaker.allow_request()
+
+
+def test_circuit_ignores_outcomes_outside_window():
+    clock = FakeClock()
+    breaker = _get_breaker(clock)
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now = 20
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_circuit_half_open_probe_closes():
+    clock = FakeClock()
+    breaker = _get_breaker(clock)
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now = 5
+    assert breaker.is_available()
+    assert breaker.allow_request()
+    assert breaker.state == CircuitState.HALF_OPEN
+    # Only one probe at a time
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_circuit_half_open_probe_failure_reopens():
+    clock = FakeClock()
+    breaker = _get_breaker(clock)
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now = 5
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    assert not breaker.is_available()
+
+
+def test_circuit_release_frees_probe():
+    clock = FakeClock()
+    breaker = _get_breaker(clock)
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now = 5
+    assert breaker.allow_request()
+    breaker.release()
+    assert breaker.allow_request()
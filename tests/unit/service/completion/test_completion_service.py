@@ -0,0 +1,178 @@
+import asyncio
+
+import pytest
+
+from router.service import error_responses
+from router.service.completion import completion_service
+from router.service.completion import hedging
+from router.service.completion.completion_service import UpstreamResponse
+from router.service.completion.concurrency_limiter import concurrency_limiters
+from router.service.completion.upstream_client import UpstreamError
+
+PRIMARY = completion_service.load_balancer.endpoints[0]
+HEDGE = completion_service.load_balancer.endpoints[1]
+
+
+class FakePost:
+    """
+    Requests follow scripts by endpoint name: an asyncio.Event to wait for
+    before answering, then a status to answer with or an exception to raise.
+    ends has the (endpoint name, how) of the requests that ended, in order.
+    """
+
+    def __init__(self):
+        self.scripts = {}
+        self.ends = []
+
+    async def post(self, endpoint, formatted_dict):
+        how = "done"
+        wait_for, answer = self.scripts[endpoint.name]
+        try:
+            if wait_for:
+                await wait_for.wait()
+            if isinstance(answer, Exception):
+                how = "failed"
+                raise answer
+            return UpstreamResponse(
+                status=answer,
+                body=endpoint.name.encode(),
+                provider=endpoint.name,
+                model=None,
+                usage=None,
+            )
+        except asyncio.CancelledError:
+            how = "cancelled"
+            raise
+        finally:
+            self.ends.append((endpoint.name, how))
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = FakePost()
+    monkeypatch.setattr(completion_service, "_post", upstream.post)
+    monkeypatch.setattr(hedging, "get_hedge_delay", lambda endpoint_stats: 0.01)
+    monkeypatch.setattr(hedging, "hedge_budget", hedging.HedgeBudget(max_rate=1))
+    monkeypatch.setattr(
+        completion_service.load_balancer, "choose", lambda exclude: HEDGE
+    )
+    monkeypatch.setattr(
+        completion_service.load_balancer,
+        "failover",
+        lambda endpoint, exclude: None,
+    )
+    return upstream
+
+
+async def _get_hedged_response():
+    return await completion_service._get_hedged_response(PRIMARY, {})
+
+
+def test_fast_primary_is_not_hedged(upstream):
+    upstream.scripts.update({PRIMARY.name: (None, 200)})
+
+    response = asyncio.run(_get_hedged_response())
+
+    assert response.provider == PRIMARY.name
+    assert upstream.ends == [(PRIMARY.name, "done")]
+
+
+def test_hedge_wins_and_primary_is_cancelled(upstream):
+    upstream.scripts.update(
+        {PRIMARY.name: (asyncio.Event(), 200), HEDGE.name: (None, 200)}
+    )
+
+    async def run():
+        response = await _get_hedged_response()
+        # The loser has ended by the time the winner is returned
+        assert upstream.ends == [(HEDGE.name, "done"), (PRIMARY.name, "cancelled")]
+        return response
+
+    assert asyncio.run(run()).provider == HEDGE.name
+
+
+def test_hedge_is_skipped_without_budget(upstream, monkeypatch):
+    monkeypatch.setattr(hedging, "hedge_budget", hedging.HedgeBudget(max_rate=0))
+    skipped = hedging.HEDGES_SKIPPED.labels(reason="budget")._value.get()
+    gate = asyncio.Event()
+    upstream.scripts.update({PRIMARY.name: (gate, 200)})
+
+    async def run():
+        asyncio.get_running_loop().call_later(0.05, gate.set)
+        return await _get_hedged_response()
+
+    assert asyncio.run(run()).provider == PRIMARY.name
+    assert upstream.ends == [(PRIMARY.name, "done")]
+    assert hedging.HEDGES_SKIPPED.labels(reason="budget")._value.get() == skipped + 1
+
+
+def test_hedged_request_fails_when_both_fail(upstream):
+    gate = asyncio.Event()
+    upstream.scripts.update(
+        {
+            PRIMARY.name: (gate, UpstreamError(PRIMARY.name, 500)),
+            HEDGE.name: (None, UpstreamError(HEDGE.name, 500)),
+        }
+    )
+
+    async def run():
+        asyncio.get_running_loop().call_later(0.05, gate.set)
+        return await _get_hedged_response()
+
+    with pytest.raises(error_responses.BadGatewayAPIError):
+        asyncio.run(run())
+    assert upstream.ends == [(HEDGE.name, "failed"), (PRIMARY.name, "failed")]
+
+
+class FakeLimiter:
+    def __init__(self):
+        self.releases = []
+
+    async def acquire(self) -> float:
+        return 0.0
+
+    def release(self, is_success, latency=None, is_stream=False):
+        self.releases.append((is_success, latency))
+
+
+class FakeResponse:
+    def __init__(self, status: int, body: bytes):
+        self.status = status
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def read(self) -> bytes:
+        return self.body
+
+
+@pytest.mark.parametrize(
+    "body,latency",
+    [
+        (b'{"usage": {"completion_tokens": 4, "total_tokens": 6}}', 0.5),
+        # No usage, no latency sample
+        (b'{"error": "overloaded"}', None),
+    ],
+)
+def test_limiter_is_fed_latency_per_completion_token(monkeypatch, body, latency):
+    limiter = FakeLimiter()
+    monkeypatch.setitem(concurrency_limiters, PRIMARY.name, limiter)
+    monkeypatch.setattr(completion_service.time, "perf_counter", lambda: 2.0)
+    monkeypatch.setattr(
+        completion_service,
+        "post_json",
+        lambda session, endpoint, formatted_dict: FakeResponse(200, body),
+    )
+
+    async def run():
+        try:
+            await completion_service._post(PRIMARY, {})
+        finally:
+            await completion_service.UpstreamClient.instance().close()
+
+    asyncio.run(run())
+    assert limiter.releases == [(True, latency)]
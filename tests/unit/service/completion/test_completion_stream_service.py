@@ -0,0 +1,327 @@
+import asyncio
+from typing import Optional
+
+import pytest
+
+import settings
+from router.repository.user_repository import ValidatedUser
+from router.service import error_responses
+from router.service.completion import completion_stream_service
+from router.service.completion import response_cache
+from router.service.completion import stream_broadcast
+from router.service.completion.completion_stream_service import ABORTED_STREAMS
+from router.service.completion.completion_stream_service import (
+    ABORTED_STREAM_TOKENS_SAVED,
+)
+from router.service.completion.completion_stream_service import StreamResult
+from router.service.completion.concurrency_limiter import ConcurrencyLimiter
+from router.service.completion.concurrency_limiter import concurrency_limiters
+from router.service.completion.entities import ChatCompletionRequest
+from router.service.completion.sse import SseLine
+from router.service.completion.upstream_client import UpstreamClient
+from router.service.completion.upstream_client import UpstreamError
+from router.service.completion.utils import ChatCompletionEndpoint
+from router.utils.streaming_response import start_stream
+
+FIRST = ChatCompletionEndpoint(name="first", url="http://first")
+SECOND = ChatCompletionEndpoint(name="second", url="http://second")
+
+
+class Fail:
+    """Script step of a fake upstream stream that fails with a server error"""
+
+    def __init__(self, error_body: Optional[bytes] = None):
+        self.error_body = error_body
+
+
+class FakeUpstream:
+    """
+    Streams follow scripts by endpoint name: steps are chunks to yield,
+    asyncio.Events to wait for or Fail. Responses have the status in
+    statuses, 200 by default. ends has the (endpoint name, how) of the
+    streams that ended, in order.
+    """
+
+    def __init__(self):
+        self.scripts = {}
+        self.statuses = {}
+        self.ends = []
+
+    async def stream(self, endpoint, formatted_dict, result):
+        how = "done"
+        result.status = self.statuses.get(endpoint.name, 200)
+        try:
+            for step in self.scripts[endpoint.name]:
+                if isinstance(step, asyncio.Event):
+                    await step.wait()
+                elif isinstance(step, Fail):
+                    how = "failed"
+                    result.error_body = step.error_body
+                    raise UpstreamError(endpoint.name, 500)
+                else:
+                    result.is_committed = True
+                    result.accumulator.add(SseLine(data=step, content=step.decode()))
+                    yield step
+        except GeneratorExit:
+            how = "closed"
+            raise
+        except asyncio.CancelledError:
+            how = "cancelled"
+            raise
+        finally:
+            self.ends.append((endpoint.name, how))
+
+
+class FakeTracker:
+    def __init__(self):
+        self.calls = []
+
+    async def track(self, user_id, provider, response_dict, cached=False):
+        self.calls.append((provider, response_dict["usage"], cached))
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = FakeUpstream()
+    monkeypatch.setattr(completion_stream_service, "_stream", upstream.stream)
+    monkeypatch.setattr(
+        completion_stream_service,
+        "get_chat_completion_endpoint",
+        lambda is_stream: FIRST,
+    )
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_ENABLED", False)
+    return upstream
+
+
+def _execute(tracker: FakeTracker, temperature: float = 0):
+    # Deterministic by default, so identical requests share the upstream stream
+    request = ChatCompletionRequest(
+        model="model",
+        stream=True,
+        temperature=temperature,
+        max_tokens=10,
+        messages=[{"role": "user", "content": "hi"}],
+    )
+    return completion_stream_service.execute(
+        request, tracker, ValidatedUser(uid="user", email=None)
+    )
+
+
+async def _collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+async def _race():
+    chunks = []
+    async for result, chunk in completion_stream_service._race_streams(
+        [FIRST, SECOND], {}
+    ):
+        chunks.append((result.endpoint.name, chunk))
+    return chunks
+
+
+def test_race_commits_to_first_endpoint_to_emit(upstream):
+    never = asyncio.Event()
+    upstream.scripts.update(first=[b"a", b"b"], second=[never, b"c"])
+
+    chunks = asyncio.run(_race())
+
+    assert chunks == [("first", b"a"), ("first", b"b")]
+    # The loser was cancelled while waiting for its first token
+    assert upstream.ends == [("second", "cancelled"), ("first", "done")]
+
+
+def test_race_photo_finish_closes_the_loser(upstream):
+    upstream.scripts.update(first=[b"a", b"b"], second=[b"c", b"d"])
+
+    chunks = asyncio.run(_race())
+
+    winners = {name for name, _ in chunks}
+    assert len(winners) == 1
+    assert [chunk for _, chunk in chunks] in ([b"a", b"b"], [b"c", b"d"])
+    # Both emitted a token, the loser is closed before the winner is read
+    loser = ({"first", "second"} - winners).pop()
+    assert upstream.ends == [(loser, "closed"), (winners.pop(), "done")]
+
+
+def test_race_passes_on_upstream_error_when_both_fail(upstream):
+    upstream.scripts.update(first=[Fail(error_body=b"error")], second=[Fail()])
+
+    chunks = asyncio.run(_race())
+
+    assert chunks == [("first", b"error")]
+
+
+def test_race_raises_when_both_fail_without_response(upstream):
+    upstream.scripts.update(first=[Fail()], second=[Fail()])
+
+    with pytest.raises(error_responses.BadGatewayAPIError):
+        asyncio.run(_race())
+
+
+@pytest.mark.parametrize("status,upstream_calls", [(200, 1), (429, 2)])
+def test_only_successful_streams_are_cached(
+    upstream, monkeypatch, status, upstream_calls
+):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(
+        response_cache,
+        "response_cache",
+        response_cache.ResponseCache(10, 1000, 1000, ttl_seconds=60),
+    )
+    upstream.scripts.update(first=[b"a", b"b"])
+    upstream.statuses.update(first=status)
+
+    async def run():
+        for _ in range(2):
+            assert await _collect(_execute(FakeTracker())) == [b"a", b"b"]
+
+    asyncio.run(run())
+    assert len(upstream.ends) == upstream_calls
+
+
+def test_empty_role_delta_does_not_commit_stream():
+    endpoint = completion_stream_service.load_balancer.endpoints[0]
+    result = StreamResult(endpoint=endpoint)
+
+    completion_stream_service._on_line(
+        endpoint, 0, result, SseLine(data=b"", content="")
+    )
+    assert not result.is_committed
+
+    completion_stream_service._on_line(
+        endpoint, 0, result, SseLine(data=b"", content="Hi")
+    )
+    assert result.is_committed
+
+
+def test_subscriber_leaving_shared_stream_does_not_abort_it(upstream):
+    tracker = FakeTracker()
+    aborted = ABORTED_STREAMS._value.get()
+
+    async def run():
+        gate = asyncio.Event()
+        upstream.scripts.update(first=[b"a", gate, b"b", b"c"])
+        owner, subscriber = _execute(tracker), _execute(tracker)
+        assert await owner.__anext__() == b"a"
+        assert await subscriber.__anext__() == b"a"
+        await subscriber.aclose()
+        gate.set()
+        assert await _collect(owner) == [b"b", b"c"]
+
+    asyncio.run(run())
+    assert upstream.ends == [("first", "done")]
+    assert ABORTED_STREAMS._value.get() == aborted
+    # The subscriber is tracked as served from the owner's stream
+    assert [cached for _, _, cached in tracker.calls] == [True, False]
+
+
+def test_lagging_subscriber_usage_is_tracked(upstream, monkeypatch):
+    monkeypatch.setattr(stream_broadcast.stream_broadcaster, "max_buffer_bytes", 2)
+    tracker = FakeTracker()
+
+    async def run():
+        gate = asyncio.Event()
+        upstream.scripts.update(first=[b"a", gate, b"b", b"c", b"d", b"e"])
+        owner, subscriber = _execute(tracker), _execute(tracker)
+        assert await owner.__anext__() == b"a"
+        assert await subscriber.__anext__() == b"a"
+        # The subscriber stops reading and falls behind
+        gate.set()
+        assert await _collect(owner) == [b"b", b"c", b"d", b"e"]
+        with pytest.raises(stream_broadcast.SubscriberLagError):
+            await subscriber.__anext__()
+
+    asyncio.run(run())
+    assert [cached for _, _, cached in tracker.calls] == [False, True]
+
+
+def test_last_subscriber_leaving_held_back_stream_aborts_it(upstream, monkeypatch):
+    monkeypatch.setattr(stream_broadcast.stream_broadcaster, "max_buffer_bytes", 2)
+    aborted = ABORTED_STREAMS._value.get()
+
+    async def run():
+        upstream.scripts.update(first=[b"a", b"b", b"c", b"d", b"e"])
+        chunks = _execute(FakeTracker())
+        assert await chunks.__anext__() == b"a"
+        # Let the pump read ahead until the buffer holds it back
+        for _ in range(20):
+            await asyncio.sleep(0)
+        await chunks.aclose()
+        for _ in range(20):
+            await asyncio.sleep(0)
+        # Before the loop shuts down and closes whatever generators are left
+        assert upstream.ends == [("first", "closed")]
+        assert ABORTED_STREAMS._value.get() == aborted + 1
+
+    asyncio.run(run())
+
+
+def test_client_disconnect_cancels_upstream_and_tracks_partial_usage(upstream):
+    tracker = FakeTracker()
+    aborted = ABORTED_STREAMS._value.get()
+    tokens_saved = ABORTED_STREAM_TOKENS_SAVED._value.get()
+
+    async def run():
+        upstream.scripts.update(first=[b"a", b"b", asyncio.Event(), b"c"])
+        chunks = _execute(tracker, temperature=1)
+        assert await chunks.__anext__() == b"a"
+        # What ClosingStreamingResponse does once the client is gone
+        await chunks.aclose()
+
+    asyncio.run(run())
+    assert upstream.ends == [("first", "closed")]
+    # One content chunk was read from upstream, one token without a vocab
+    [(provider, usage, cached)] = tracker.calls
+    assert (provider, usage["completion_tokens"], cached) == ("first", 1, False)
+    assert ABORTED_STREAMS._value.get() == aborted + 1
+    assert ABORTED_STREAM_TOKENS_SAVED._value.get() == tokens_saved + 9
+
+
+def test_shed_stream_fails_before_the_response_starts(monkeypatch):
+    endpoint = completion_stream_service.load_balancer.endpoints[0]
+    # Every slot is taken and there is no room to queue
+    limiter = ConcurrencyLimiter(
+        name=endpoint.name, initial_limit=1, min_limit=1, max_queue_size=0
+    )
+    limiter.in_flight = 1
+    monkeypatch.setitem(concurrency_limiters, endpoint.name, limiter)
+    monkeypatch.setattr(
+        completion_stream_service,
+        "get_chat_completion_endpoint",
+        lambda is_stream: endpoint,
+    )
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_ENABLED", False)
+
+    async def run():
+        try:
+            await start_stream(_execute(FakeTracker(), temperature=1))
+        finally:
+            await UpstreamClient.instance().close()
+
+    with pytest.raises(error_responses.ServiceUnavailableAPIError) as error:
+        asyncio.run(run())
+    assert "Retry-After" in error.value.to_headers()
+
+
+def test_exhausted_failover_fails_before_the_response_starts(upstream, monkeypatch):
+    def failover(failed_endpoint, exclude, is_stream):
+        return None if SECOND.name in exclude else SECOND
+
+    monkeypatch.setattr(completion_stream_service.load_balancer, "failover", failover)
+    upstream.scripts.update(first=[Fail()], second=[Fail()])
+
+    with pytest.raises(error_responses.BadGatewayAPIError):
+        asyncio.run(start_stream(_execute(FakeTracker(), temperature=1)))
+    assert upstream.ends == [("first", "failed"), ("second", "failed")]
+
+
+def test_no_endpoint_fails_before_the_response_starts(upstream, monkeypatch):
+    monkeypatch.setattr(
+        completion_stream_service,
+        "get_chat_completion_endpoint",
+        lambda is_stream: None,
+    )
+
+    with pytest.raises(error_responses.ServiceUnavailableAPIError):
+        asyncio.run(start_stream(_execute(FakeTracker(), temperature=1)))
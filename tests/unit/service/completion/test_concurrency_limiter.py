@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from router.service import error_responses
+from router.service.completion.concurrency_limiter import ConcurrencyLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _get_limiter(clock: Clock, **kwargs) -> ConcurrencyLimiter:
+    options = {
+        "initial_limit": 2,
+        "min_limit": 1,
+        "max_limit": 10,
+        "max_queue_size": 2,
+        "queue_target": 1,
+        "queue_interval": 10,
+        "queue_timeout": 15,
+    }
+    options.update(kwargs)
+    return ConcurrencyLimiter(name="endpoint", clock=clock, **options)
+
+
+def test_queued_request_gets_released_slot():
+    async def run():
+        limiter = _get_limiter(Clock())
+        await limiter.acquire()
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        limiter.release(is_success=None)
+        await asyncio.wait_for(waiter, 1)
+        assert limiter.in_flight == 2
+
+    asyncio.run(run())
+
+
+def test_sheds_when_queue_is_full():
+    async def run():
+        limiter = _get_limiter(Clock(), initial_limit=1, max_queue_size=1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(error_responses.ServiceUnavailableAPIError):
+            await limiter.acquire()
+        waiter.cancel()
+
+    asyncio.run(run())
+
+
+def test_sheds_long_waits_once_queue_is_standing():
+    clock = Clock()
+
+    async def run():
+        limiter = _get_limiter(clock, initial_limit=1, queue_timeout=100)
+        await limiter.acquire()
+        first = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        # The first interval had a request admitted right away
+        clock.now = 11
+        second = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not first.done()
+        # Nothing got through the next one
+        clock.now = 22
+        third = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        for waiter in (first, second):
+            with pytest.raises(error_responses.ServiceUnavailableAPIError):
+                await waiter
+        limiter.release(is_success=None)
+        await asyncio.wait_for(third, 1)
+
+    asyncio.run(run())
+
+
+def test_limit_follows_latency_and_failures():
+    limiter = _get_limiter(Clock(), initial_limit=4)
+    limiter.in_flight = 4
+    for _ in range(5):
+        limiter.in_flight += 1
+        limiter.release(is_success=True, latency=1.0)
+    assert limiter.get_limit() > 4
+
+    raised_limit = limiter.limit
+    for _ in range(5):
+        limiter.in_flight += 1
+        limiter.release(is_success=True, latency=10.0)
+    assert limiter.limit < raised_limit
+
+    lowered_limit = limiter.limit
+    limiter.in_flight += 1
+    limiter.release(is_success=False)
+    assert limiter.limit == pytest.approx(lowered_limit * 0.9)
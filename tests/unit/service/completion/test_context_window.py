@@ -0,0 +1,62 @@
+import pytest
+import tokenizers
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+
+from router.domain.tokens.tokenizer import Tokenizer
+from router.service import error_responses
+from router.service.completion import context_window
+from router.service.completion.entities import ChatCompletionRequest
+from router.service.completion.model_registry import ModelInfo
+
+
+@pytest.fixture(autouse=True)
+def tokenizer(tmp_path, monkeypatch):
+    vocab = tokenizers.Tokenizer(WordLevel({"[UNK]": 0}, unk_token="[UNK]"))
+    vocab.pre_tokenizer = Whitespace()
+    path = str(tmp_path / "tokenizer.json")
+    vocab.save(path)
+    monkeypatch.setattr(
+        context_window, "tokenizer", Tokenizer(tokenizer_path=path, cache_max_entries=10)
+    )
+    # Every message is its words + 4 template tokens, requests have 1 more
+    monkeypatch.setattr(
+        context_window.model_registry,
+        "get_model",
+        lambda name: ModelInfo(name=name, context_window=30),
+    )
+
+
+def _get_request(max_tokens: int) -> ChatCompletionRequest:
+    return ChatCompletionRequest(
+        model="model",
+        max_tokens=max_tokens,
+        messages=[
+            {"role": "system", "content": "be nice"},
+            {"role": "user", "content": "one two three"},
+            {"role": "assistant", "content": "four five"},
+            {"role": "user", "content": "six"},
+        ],
+    )
+
+
+def test_request_that_fits_is_unchanged():
+    request = _get_request(max_tokens=5)
+    context_window.apply(request)
+    assert len(request.messages) == 4
+
+
+def test_oversized_request_is_rejected():
+    with pytest.raises(error_responses.ContextLengthExceededAPIError):
+        context_window.apply(_get_request(max_tokens=10))
+
+
+def test_oversized_request_is_trimmed_by_turn():
+    request = _get_request(max_tokens=10)
+    context_window.apply(request, is_trim_requested=True)
+    assert [m.content for m in request.messages] == ["be nice", "six"]
+
+
+def test_request_that_cant_fit_is_rejected_when_trimming():
+    with pytest.raises(error_responses.ContextLengthExceededAPIError):
+        context_window.apply(_get_request(max_tokens=25), is_trim_requested=True)
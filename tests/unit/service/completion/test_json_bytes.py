@@ -0,0 +1,26 @@
+from router.service.completion import json_bytes
+
+BODY = (
+    b'{"id": "1", "model": "/models/mistral", "choices": [{"message": '
+    b'{"content": "a \\"model\\": \\"x\\" {"}}], "usage": {"prompt_tokens": 1, '
+    b'"details": {"cached": 0}, "total_tokens": 3}}'
+)
+
+
+def test_replace_value():
+    body, replaced = json_bytes.replace_value(BODY, b'"model"', b'"served"')
+    assert replaced == b'"/models/mistral"'
+    assert body == BODY.replace(b'"/models/mistral"', b'"served"')
+
+
+def test_get_object_with_nested_values():
+    assert json_bytes.get_object(BODY, b'"usage"') == {
+        "prompt_tokens": 1,
+        "details": {"cached": 0},
+        "total_tokens": 3,
+    }
+
+
+def test_missing_key():
+    assert json_bytes.find_value(b'{"content": "\\"usage\\": 1"}', b'"usage"') is None
+    assert json_bytes.get_object(b'{"usage": null}', b'"usage"') is None
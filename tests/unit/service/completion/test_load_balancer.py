@@ -0,0 +1,81 @@
+from router.service.completion.circuit_breaker import CircuitBreaker
+from router.service.completion.load_balancer import EndpointStats
+from router.service.completion.load_balancer import LeastOutstandingRequestsPolicy
+from router.service.completion.load_balancer import LoadBalancer
+from router.service.completion.load_balancer import PowerOfTwoChoicesPolicy
+from router.service.completion.utils import ChatCompletionEndpoint
+
+FAST = ChatCompletionEndpoint(name="fast", url="http://fast")
+SLOW = ChatCompletionEndpoint(name="slow", url="http://slow")
+WEIGHTS = {"fast": 0.5, "slow": 0.5}
+
+
+def test_least_outstanding_requests_picks_least_loaded():
+    stats = {"fast": EndpointStats(in_flight=3), "slow": EndpointStats(in_flight=1)}
+    result = LeastOutstandingRequestsPolicy().choose([FAST, SLOW], stats, WEIGHTS, False)
+    assert result == SLOW
+
+
+def test_least_outstanding_requests_skips_zero_weight():
+    stats = {"fast": EndpointStats(in_flight=3), "slow": EndpointStats()}
+    result = LeastOutstandingRequestsPolicy().choose(
+        [FAST, SLOW], stats, {"fast": 1.0, "slow": 0.0}, False
+    )
+    assert result == FAST
+
+
+def test_power_of_two_choices_prefers_lower_latency():
+    stats = {
+        "fast": EndpointStats(ewma_latency=0.1),
+        "slow": EndpointStats(ewma_latency=5.0),
+    }
+    results = [
+        PowerOfTwoChoicesPolicy().choose([FAST, SLOW], stats, WEIGHTS, False)
+        for _ in range(200)
+    ]
+    # Slow only wins when it is sampled twice
+    assert results.count(FAST) > results.count(SLOW)
+    assert results.count(SLOW) > 0
+
+
+def test_power_of_two_choices_uses_ttft_for_streams():
+    stats = {
+        "fast": EndpointStats(ewma_latency=5.0, ewma_ttft=0.1),
+        "slow": EndpointStats(ewma_latency=0.1, ewma_ttft=5.0),
+    }
+    results = [
+        PowerOfTwoChoicesPolicy().choose([FAST, SLOW], stats, WEIGHTS, True)
+        for _ in range(200)
+    ]
+    assert results.count(FAST) > results.count(SLOW)
+
+
+def test_load_balancer_tracks_in_flight_and_errors():
+    balancer = LoadBalancer([FAST, SLOW], WEIGHTS, LeastOutstandingRequestsPolicy())
+    started_at = balancer.on_request_start(FAST)
+    assert balancer.stats["fast"].in_flight == 1
+    balancer.on_request_end(FAST, started_at, is_success=False)
+    assert balancer.stats["fast"].in_flight == 0
+    assert balancer.stats["fast"].ewma_error_rate > 0
+    assert balancer.stats["fast"].ewma_latency is None
+
+
+def test_load_balancer_skips_open_circuit():
+    breaker = CircuitBreaker(name="fast", minimum_requests=1)
+    breaker.record_failure()
+    balancer = LoadBalancer(
+        [FAST, SLOW],
+        WEIGHTS,
+        LeastOutstandingRequestsPolicy(),
+        circuit_breakers={"fast": breaker},
+    )
+    assert balancer.choose() == SLOW
+    assert balancer.choose(exclude=["slow"]) is None
+
+
+def test_endpoint_stats_latency_percentile():
+    stats = EndpointStats()
+    assert stats.get_latency_percentile(95) is None
+    stats.latencies.extend(i / 100 for i in range(1, 101))
+    assert stats.get_latency_percentile(95) == 0.96
+    assert stats.get_latency_percentile(95, min_samples=200) is None
@@ -0,0 +1,87 @@
+import pytest
+
+from router.service import error_responses
+from router.service.completion import quotas
+from router.service.completion.entities import ChatCompletionRequest
+from router.service.middleware.rate_limiter import RateLimiter
+from router.utils.shared_gcra import SharedGcra
+
+QUOTA = quotas.Quota(
+    requests_per_minute=3, tokens_per_minute=1000, max_concurrent_streams=1
+)
+
+
+@pytest.fixture(autouse=True)
+def rate_limiter(tmp_path, monkeypatch):
+    rate_limiter = RateLimiter(SharedGcra(path=str(tmp_path / "limits"), slots=64))
+    monkeypatch.setattr(quotas, "rate_limiter", rate_limiter)
+    monkeypatch.setattr(quotas, "_quotas_by_user", {"user": QUOTA})
+    monkeypatch.setattr(quotas, "_estimate_tokens", lambda request: 400)
+    return rate_limiter
+
+
+def _get_request(stream: bool = False) -> ChatCompletionRequest:
+    return ChatCompletionRequest(
+        model="model", stream=stream, messages=[{"role": "user", "content": "hi"}]
+    )
+
+
+def test_limits_requests_per_minute():
+    for _ in range(3):
+        quotas.acquire("user", _get_request()).reconcile(10)
+    with pytest.raises(error_responses.RateLimitExceededAPIError) as error:
+        quotas.acquire("user", _get_request())
+
+    headers = error.value.to_headers()
+    assert headers["Retry-After"] == "20"
+    assert headers["X-RateLimit-Limit-Requests"] == "3"
+    assert headers["X-RateLimit-Remaining-Requests"] == "0"
+
+
+def test_reconciles_tokens_with_usage():
+    lease = quotas.acquire("user", _get_request())
+    assert lease.headers["X-RateLimit-Remaining-Tokens"] == "600"
+    lease.reconcile(100)
+    lease.close()
+
+    lease = quotas.acquire("user", _get_request())
+    assert lease.headers["X-RateLimit-Remaining-Tokens"] == "500"
+    lease.close()
+    # The estimate is given back when no usage was tracked
+    lease = quotas.acquire("user", _get_request())
+    assert lease.headers["X-RateLimit-Remaining-Tokens"] == "500"
+
+
+def test_limits_concurrent_streams():
+    lease = quotas.acquire("user", _get_request(stream=True))
+    with pytest.raises(error_responses.RateLimitExceededAPIError):
+        quotas.acquire("user", _get_request(stream=True))
+    # Other users and non-streaming requests have their own limits
+    quotas.acquire("other-user", _get_request(stream=True)).close()
+    quotas.acquire("user", _get_request()).close()
+
+    lease.close()
+    quotas.acquire("user", _get_request(stream=True)).close()
+
+
+def test_users_without_override_are_unlimited():
+    for _ in range(10):
+        lease = quotas.acquire("other", _get_request(stream=True))
+        assert lease.headers == {}
+
+
+def test_overrides_change_default_quota():
+    quotas_by_user = quotas.get_quotas_by_user('{"user": {"tokens_per_minute": 5}}')
+    assert quotas_by_user["user"].tokens_per_minute == 5
+    assert quotas_by_user["user"].requests_per_minute == (
+        quotas.DEFAULT_QUOTA.requests_per_minute
+    )
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    ["{", "[]", '{"user": {"tokens": 5}}', '{"user": {"tokens_per_minute": "5"}}'],
+)
+def test_invalid_overrides_are_rejected(overrides):
+    with pytest.raises(ValueError, match="QUOTA_OVERRIDES"):
+        quotas.get_quotas_by_user(overrides)
@@ -0,0 +1,70 @@
+from router.service.completion.entities import ChatCompletionRequest
+from router.service.completion.response_cache import CachedResponse
+from router.service.completion.response_cache import ResponseCache
+from router.service.completion.response_cache import get_cache_key
+from router.service.completion.utils import format_request
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _get_response(body: bytes) -> CachedResponse:
+    return CachedResponse(provider="provider", model="model", usage={}, body=body)
+
+
+def test_get_cache_key_is_canonical():
+    first = get_cache_key(
+        {"model": "m", "temperature": 0, "messages": [{"role": "user", "content": "a"}]}
+    )
+    second = get_cache_key(
+        {"messages": [{"content": "a", "role": "user"}], "temperature": 0, "model": "m"}
+    )
+    assert first is not None
+    assert first == second
+
+
+def test_get_cache_key_skips_sampled_requests():
+    assert get_cache_key({"model": "m", "temperature": 0.7}) is None
+    # The upstream samples at its default temperature
+    assert get_cache_key({"model": "m"}) is None
+
+
+def test_format_request_keeps_zero_temperature():
+    request = ChatCompletionRequest(
+        model="model", temperature=0, messages=[{"role": "user", "content": "a"}]
+    )
+    formatted_dict = format_request(request)
+    assert formatted_dict["temperature"] == 0
+    assert get_cache_key(formatted_dict) is not None
+
+
+def test_response_cache_expires_entries():
+    clock = FakeClock()
+    cache = ResponseCache(10, 1000, 1000, ttl_seconds=10, clock=clock)
+    cache.set("key", _get_response(b"body"))
+    assert cache.get("key").body == b"body"
+    clock.now = 10
+    assert cache.get("key") is None
+    assert cache.size == 0
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = ResponseCache(10, max_bytes=10, max_entry_bytes=10, ttl_seconds=10)
+    cache.set("first", _get_response(b"1234"))
+    cache.set("second", _get_response(b"1234"))
+    cache.get("first")
+    cache.set("third", _get_response(b"1234"))
+    assert cache.get("second") is None
+    assert cache.get("first") is not None
+    assert cache.get("third") is not None
+
+
+def test_response_cache_skips_oversized_entries():
+    cache = ResponseCache(10, max_bytes=100, max_entry_bytes=3, ttl_seconds=10)
+    cache.set("key", _get_response(b"1234"))
+    assert cache.get("key") is None
@@ -0,0 +1,57 @@
+import asyncio
+
+from router.service.completion.single_flight import SingleFlight
+
+
+def test_single_flight_shares_call():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        single_flight = SingleFlight()
+        return await asyncio.gather(
+            single_flight.do("key", fn), single_flight.do("key", fn)
+        )
+
+    results = asyncio.run(run())
+    assert results == [("result", True), ("result", False)]
+    assert len(calls) == 1
+
+
+def test_single_flight_continues_when_waiter_cancelled():
+    async def fn():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        single_flight = SingleFlight()
+        first = asyncio.ensure_future(single_flight.do("key", fn))
+        second = asyncio.ensure_future(single_flight.do("key", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == ("result", False)
+
+
+def test_single_flight_cancels_call_without_waiters():
+    finished = []
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        finished.append(1)
+
+    async def run():
+        single_flight = SingleFlight()
+        waiter = asyncio.ensure_future(single_flight.do("key", fn))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0.02)
+        return single_flight.calls
+
+    assert asyncio.run(run()) == {}
+    assert finished == []
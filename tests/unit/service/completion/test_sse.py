@@ -0,0 +1,72 @@
+import json
+
+from router.service.completion.sse import SseFramer
+
+MODEL = "mistralai/Mistral-7B-Instruct-v0.2"
+
+
+def _chunk(content=None, usage=None) -> bytes:
+    line = {
+        "id": "cmpl-1",
+        "object": "chat.completion.chunk",
+        "model": "/models/mistral",
+        "choices": [{"index": 0, "delta": {"content": content}}],
+    }
+    if usage is not None:
+        line["usage"] = usage
+    return b"data: " + json.dumps(line).encode() + b"\n\n"
+
+
+def test_framer_rewrites_model():
+    framer = SseFramer(model=MODEL)
+    lines = framer.feed(_chunk("Hello"))
+    assert [line.data for line in lines][1] == b"\n"
+    payload = json.loads(lines[0].data[len(b"data: "):])
+    assert payload["model"] == MODEL
+    assert payload["choices"][0]["delta"]["content"] == "Hello"
+    assert lines[0].content == "Hello"
+    assert framer.upstream_model == "/models/mistral"
+
+
+def test_framer_splits_lines_across_reads():
+    framer = SseFramer(model=MODEL)
+    data = _chunk("a") + _chunk('quote " and \\ "model": x') + b"data: [DONE]\n\n"
+    lines = []
+    for i in range(0, len(data), 7):
+        lines.extend(framer.feed(data[i:i + 7]))
+    lines.extend(framer.flush())
+    assert [line.content for line in lines if line.content is not None] == [
+        "a",
+        'quote " and \\ "model": x',
+    ]
+    assert lines[-2].data == b"data: [DONE]\n"
+
+
+def test_framer_reads_delta_content_only():
+    framer = SseFramer(model=MODEL)
+    line = {
+        "model": "pplx",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": "Hello wor"},
+                "delta": {"role": "assistant", "content": "wor"},
+            }
+        ],
+    }
+    (line, _) = framer.feed(b"data: " + json.dumps(line).encode() + b"\n\n")
+    assert line.content == "wor"
+
+
+def test_framer_reads_usage():
+    framer = SseFramer(model=MODEL)
+    usage = {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}
+    (line, _) = framer.feed(_chunk(usage=usage))
+    assert line.content is None
+    assert line.usage == usage
+
+
+def test_framer_passes_unterminated_line_on_flush():
+    framer = SseFramer(model=MODEL)
+    assert framer.feed(b": keep-alive") == []
+    assert [line.data for line in framer.flush()] == [b": keep-alive"]
@@ -0,0 +1,28 @@
+from router.service.completion.sse import SseLine
+from router.service.completion.stream_accumulator import StreamAccumulator
+
+
+def _add_lines(accumulator: StreamAccumulator) -> None:
+    accumulator.add(SseLine(data=b"\n"))
+    for content in ["Hello", ", ", "world"]:
+        accumulator.add(SseLine(data=b"", content=content))
+    accumulator.add(SseLine(data=b"", usage={"total_tokens": 3}))
+
+
+def test_accumulator_keeps_content_and_usage():
+    accumulator = StreamAccumulator(max_content_chars=100)
+    _add_lines(accumulator)
+    assert accumulator.get_content() == "Hello, world"
+    assert accumulator.get_completion_tokens() == 3
+    assert accumulator.usage == {"total_tokens": 3}
+    assert not accumulator.is_over_cap()
+
+
+def test_accumulator_truncates_content_over_cap():
+    accumulator = StreamAccumulator(max_content_chars=7)
+    _add_lines(accumulator)
+    assert accumulator.get_content() == "Hello, "
+    assert accumulator.dropped_chars == 5
+    assert accumulator.get_completion_tokens() == 3
+    assert accumulator.is_over_cap()
+
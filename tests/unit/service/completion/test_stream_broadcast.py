@@ -0,0 +1,163 @@
+import asyncio
+
+import pytest
+
+from router.service.completion.stream_broadcast import StreamBroadcaster
+from router.service.completion.stream_broadcast import SubscriberLagError
+
+
+class Source:
+    """Yields the items put in it until it is ended"""
+
+    def __init__(self):
+        self.items = asyncio.Queue()
+        self.pulled = 0
+        self.is_closed = False
+
+    def put(self, *items: bytes) -> None:
+        for item in items:
+            self.items.put_nowait(item)
+
+    def end(self) -> None:
+        self.items.put_nowait(None)
+
+    async def stream(self):
+        try:
+            while True:
+                item = await self.items.get()
+                if item is None:
+                    return
+                self.pulled += 1
+                yield item
+        finally:
+            self.is_closed = True
+
+
+async def _settle():
+    """Lets every task run until it waits for the source or a reader"""
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+async def _collect(items):
+    return [item async for item in items]
+
+
+def _get_items(count: int):
+    return [b"%d" % i for i in range(count)]
+
+
+def test_subscribers_share_stream():
+    async def run():
+        source = Source()
+        opened = []
+
+        def source_factory():
+            opened.append(1)
+            return source.stream()
+
+        broadcaster = StreamBroadcaster(get_size=len, max_buffer_bytes=1024)
+        first, is_owner = broadcaster.subscribe("key", source_factory)
+        first_task = asyncio.ensure_future(_collect(first))
+        source.put(*_get_items(3))
+        await _settle()
+        # Joins late and replays what was already streamed
+        second, is_second_owner = broadcaster.subscribe("key", source_factory)
+        second_task = asyncio.ensure_future(_collect(second))
+        source.put(b"3", b"4")
+        source.end()
+        results = await asyncio.gather(first_task, second_task)
+
+        assert (is_owner, is_second_owner) == (True, False)
+        assert results[0] == results[1] == _get_items(5)
+        assert len(opened) == 1
+        assert broadcaster.streams == {}
+
+    asyncio.run(run())
+
+
+def test_slow_subscriber_is_dropped():
+    async def run():
+        source = Source()
+        broadcaster = StreamBroadcaster(get_size=len, max_buffer_bytes=3)
+        fast, _ = broadcaster.subscribe("key", source.stream)
+        slow, _ = broadcaster.subscribe("key", source.stream)
+        fast_task = asyncio.ensure_future(_collect(fast))
+        source.put(b"0")
+        assert await slow.__anext__() == b"0"
+        # The slow subscriber stops reading
+        source.put(*_get_items(10)[1:])
+        source.end()
+
+        assert await fast_task == _get_items(10)
+        with pytest.raises(SubscriberLagError):
+            await slow.__anext__()
+
+    asyncio.run(run())
+
+
+def test_only_subscriber_holds_source_back():
+    async def run():
+        source = Source()
+        broadcaster = StreamBroadcaster(get_size=len, max_buffer_bytes=3)
+        items, _ = broadcaster.subscribe("key", source.stream)
+        source.put(*_get_items(10))
+        source.end()
+        assert await items.__anext__() == b"0"
+        await _settle()
+        # Read up to the buffer limit ahead of the subscriber, and no further
+        assert source.pulled == 5
+
+        assert await _collect(items) == _get_items(10)[1:]
+
+    asyncio.run(run())
+
+
+def test_last_subscriber_leaving_closes_held_back_source():
+    async def run():
+        source = Source()
+        broadcaster = StreamBroadcaster(get_size=len, max_buffer_bytes=3)
+        items, _ = broadcaster.subscribe("key", source.stream)
+        source.put(*_get_items(10))
+        assert await items.__anext__() == b"0"
+        await _settle()
+        # The pump waits for the subscriber to read on
+        assert source.pulled == 5
+        await items.aclose()
+        await _settle()
+
+        assert source.is_closed
+        assert broadcaster.streams == {}
+
+    asyncio.run(run())
+
+
+def test_full_buffer_is_not_joinable():
+    async def run():
+        source = Source()
+        broadcaster = StreamBroadcaster(get_size=len, max_buffer_bytes=2)
+        first, _ = broadcaster.subscribe("key", source.stream)
+        first_task = asyncio.ensure_future(_collect(first))
+        source.put(*_get_items(5))
+        await _settle()
+        second, is_second_owner = broadcaster.subscribe("key", Source().stream)
+        source.end()
+        await first_task
+        await second.aclose()
+        return is_second_owner
+
+    assert asyncio.run(run()) is True
+
+
+def test_source_error_reaches_subscribers():
+    async def failing_source():
+        yield b"0"
+        raise ValueError("upstream failed")
+
+    async def run():
+        broadcaster = StreamBroadcaster(get_size=len, max_buffer_bytes=1024)
+        items, _ = broadcaster.subscribe("key", failing_source)
+        return await _collect(items)
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
@@ -0,0 +1,57 @@
+import asyncio
+
+from router.repository.google_compute_repository import InstanceGroupStatus
+from router.service.monitoring.app_metrics import AppMetricsRefresher
+from router.service.monitoring.app_metrics import render
+
+USAGE = {
+    "model_name": "model-a",
+    "completion_tokens": 1,
+    "prompt_tokens": 2,
+    "total_tokens": 3,
+}
+
+
+def test_failed_source_keeps_previous_values():
+    statuses = [InstanceGroupStatus(target_size=2, actions={"creating": 1})]
+
+    def get_compute_status():
+        if not statuses:
+            raise Exception("unavailable")
+        return statuses.pop()
+
+    refresher = AppMetricsRefresher(
+        get_model_usages=lambda: [USAGE],
+        get_compute_status=get_compute_status,
+        interval=60,
+    )
+
+    async def run():
+        await refresher.refresh()
+        first = refresher.snapshot
+        await refresher.refresh()
+        return first, refresher.snapshot
+
+    first, second = asyncio.run(run())
+    assert second.compute_status == first.compute_status
+    assert second.refreshed_at["autoscaler"] == first.refreshed_at["autoscaler"]
+    assert second.refreshed_at["usage"] > first.refreshed_at["usage"]
+
+
+def test_render():
+    refresher = AppMetricsRefresher(
+        get_model_usages=lambda: [USAGE],
+        get_compute_status=lambda: InstanceGroupStatus(
+            target_size=2, actions={"creating": 1}
+        ),
+        interval=60,
+    )
+    asyncio.run(refresher.refresh())
+    refreshed_at = refresher.snapshot.refreshed_at["usage"]
+
+    lines = render(refresher.snapshot, now=refreshed_at + 5).strip().split("\n")
+    assert 'llm_proxy_llm_total_tokens_grand_sum{model_name="model-a"} 3' in lines
+    assert 'llm_proxy_llm_prompt_tokens_grand_sum{model_name="model-a"} 2' in lines
+    assert "llm_proxy_llm_autoscaler_target_size 2" in lines
+    assert "llm_proxy_llm_autoscaler_action_creating 1" in lines
+    assert 'llm_proxy_app_metrics_age_seconds{source="usage"} 5.0' in lines
@@ -0,0 +1,75 @@
+import asyncio
+
+from router.service.user import get_usage_service
+
+HOUR = 3600
+
+
+class FakeRepository:
+    def __init__(self, rollups):
+        self.rollups = rollups
+        self.calls = 0
+
+    def get_usage_buckets(self, user_id, granularity, start, end, limit, start_after):
+        self.calls += 1
+        rollups = [r for r in self.rollups if start <= r["start"] < end]
+        if start_after:
+            rollups = [
+                r for r in rollups if (r["start"], r["model_name"]) > start_after
+            ]
+        return rollups[:limit]
+
+
+def _get_rollup(start: int, model_name: str):
+    return {
+        "start": start,
+        "model_name": model_name,
+        "completion_tokens": 1,
+        "prompt_tokens": 2,
+        "total_tokens": 3,
+        "requests": 1,
+    }
+
+
+def _use_repository(monkeypatch, repo):
+    get_usage_service.cache.clear()
+    monkeypatch.setattr(
+        get_usage_service.TokenUsageRepositoryFirestore, "instance", lambda: repo
+    )
+
+
+def test_pages_buckets(monkeypatch):
+    repo = FakeRepository(
+        [_get_rollup(HOUR * i, model) for i in range(3) for model in ("a", "b")]
+    )
+    _use_repository(monkeypatch, repo)
+
+    buckets = []
+    page_token = None
+    while True:
+        response = asyncio.run(
+            get_usage_service.execute(
+                "user",
+                "hour",
+                start=0,
+                end=HOUR * 3 - 1,
+                page_size=4,
+                page_token=page_token,
+            )
+        )
+        buckets += [(bucket.start, bucket.model) for bucket in response.buckets]
+        page_token = response.next_page_token
+        if page_token is None:
+            break
+    assert response.end == HOUR * 3
+    assert buckets == [(HOUR * i, model) for i in range(3) for model in ("a", "b")]
+
+
+def test_caches_responses(monkeypatch):
+    repo = FakeRepository([_get_rollup(0, "a")])
+    _use_repository(monkeypatch, repo)
+
+    first = asyncio.run(get_usage_service.execute("user", "day", start=0, end=100))
+    second = asyncio.run(get_usage_service.execute("user", "day", start=0, end=100))
+    assert first == second
+    assert repo.calls == 1
@@ -0,0 +1,45 @@
+import pytest
+
+from router.utils.shared_gcra import RateLimit
+from router.utils.shared_gcra import SharedGcra
+
+RATE_LIMIT = RateLimit(name="test", limit=4, period=3600)
+
+
+def test_allows_burst_then_one_per_interval(tmp_path):
+    gcra = SharedGcra(path=str(tmp_path / "limits"), slots=64)
+    decisions = [gcra.acquire("ip", RATE_LIMIT, now=1000) for _ in range(5)]
+
+    assert [d.is_allowed for d in decisions] == [True] * 4 + [False]
+    assert [d.remaining for d in decisions[:4]] == [3, 2, 1, 0]
+    assert decisions[4].retry_after == pytest.approx(900)
+    assert gcra.acquire("ip", RATE_LIMIT, now=1899).is_allowed is False
+    assert gcra.acquire("ip", RATE_LIMIT, now=1900).is_allowed is True
+    # Keys have their own limits
+    assert gcra.acquire("other-ip", RATE_LIMIT, now=1900).is_allowed is True
+
+
+def test_workers_share_limits(tmp_path):
+    path = str(tmp_path / "limits")
+    worker_1 = SharedGcra(path=path, slots=64)
+    worker_2 = SharedGcra(path=path, slots=64)
+    for _ in range(2):
+        assert worker_1.acquire("ip", RATE_LIMIT, now=1000).is_allowed
+        assert worker_2.acquire("ip", RATE_LIMIT, now=1000).is_allowed
+    assert not worker_1.acquire("ip", RATE_LIMIT, now=1000).is_allowed
+
+
+def test_refund(tmp_path):
+    gcra = SharedGcra(path=str(tmp_path / "limits"), slots=64)
+    tokens = RateLimit(name="tokens", limit=1000, period=60)
+    assert gcra.acquire("user", tokens, cost=800, now=1000).is_allowed
+    assert not gcra.acquire("user", tokens, cost=300, now=1000).is_allowed
+    gcra.refund("user", tokens, cost=500, now=1000)
+    assert gcra.acquire("user", tokens, cost=300, now=1000).remaining == 400
+
+
+def test_reuses_slots_of_drained_keys(tmp_path):
+    gcra = SharedGcra(path=str(tmp_path / "limits"), slots=8)
+    for i in range(100):
+        assert gcra.acquire(f"ip-{i}", RATE_LIMIT, now=1000 + i * 3600).is_allowed
+    assert gcra.acquire("ip-99", RATE_LIMIT, now=1000 + 99 * 3600).remaining == 2
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from router.service import error_responses
+from router.utils.streaming_response import ClosingStreamingResponse
+from router.utils.streaming_response import start_stream
+
+
+async def disconnect_after_first_chunk(response) -> list:
+    """
+    Runs the response for a client that disconnects once it got the first
+    chunk, while the server is still sending the second one
+
+    Returns:
+        the body chunks sent
+    """
+    sent = []
+    first_chunk_sent = asyncio.Event()
+
+    async def receive():
+        await first_chunk_sent.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] != "http.response.body":
+            return
+        sent.append(message["body"])
+        if len(sent) == 1:
+            first_chunk_sent.set()
+        else:
+            # The client is gone, the send never completes
+            await asyncio.Event().wait()
+
+    scope = {"type": "http", "asgi": {"spec_version": "2.0"}}
+    await response(scope, receive, send)
+    return sent
+
+
+def test_body_iterator_is_closed_on_disconnect():
+    ends = []
+
+    async def body():
+        try:
+            yield b"a"
+            yield b"b"
+            yield b"c"
+        finally:
+            ends.append("closed")
+
+    sent = asyncio.run(disconnect_after_first_chunk(ClosingStreamingResponse(body())))
+
+    assert sent == [b"a", b"b"]
+    # Suspended at a yield, only an explicit aclose() runs the finally
+    assert ends == ["closed"]
+
+
+def test_error_before_first_chunk_is_raised_before_the_response():
+    ends = []
+
+    async def chunks():
+        try:
+            raise error_responses.ServiceUnavailableAPIError(retry_after=1)
+            yield b"a"
+        finally:
+            ends.append("closed")
+
+    with pytest.raises(error_responses.ServiceUnavailableAPIError) as error:
+        asyncio.run(start_stream(chunks()))
+
+    assert error.value.to_status_code() == 503
+    assert error.value.to_headers() == {"Retry-After": "1"}
+    assert ends == ["closed"]
+
+
+def test_started_stream_passes_on_chunks_and_closes_them():
+    ends = []
+
+    async def chunks():
+        try:
+            yield b"a"
+            yield b"b"
+        finally:
+            ends.append("closed")
+
+    async def run():
+        started = await start_stream(chunks())
+        assert [chunk async for chunk in started] == [b"a", b"b"]
+        # Closed even when the response never iterates it
+        unread = await start_stream(chunks())
+        await unread.aclose()
+
+    asyncio.run(run())
+    assert ends == ["closed", "closed"]